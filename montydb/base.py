@@ -130,6 +130,11 @@ def _index_list(key_or_list, direction=None):
         return key_or_list
 
 
+def _gen_index_name(keys):
+    """Generate an index name from the set of fields it is over."""
+    return u"_".join([u"%s_%s" % item for item in keys])
+
+
 def _index_document(index_list):
     """Helper to generate an index specifying document.
 
@@ -3,6 +3,7 @@ import sys
 
 from . import errors, _version
 from .base import BaseObject, ClientOptions
+from .client_session import ClientSession
 from .configure import provide_storage, provide_repository, session_config
 from .database import MontyDatabase
 from .types import string_types
@@ -99,6 +100,40 @@ class MontyClient(BaseObject):
     def close(self):
         self._storage.close()
 
+    def start_session(self, causal_consistency=True, **kwargs):
+        """Start a session for grouping operations into a transaction
+
+        Only storage engine that supports transaction could start one
+        from the returned session.
+
+        """
+        return ClientSession(self)
+
+    def save_snapshot(self, path):
+        """Write all databases into a snapshot file at `path`
+
+        Only memory storage supports snapshot, see `load_snapshot`.
+
+        """
+        self._snapshot_storage().save_snapshot(path)
+
+    def load_snapshot(self, path):
+        """Replace all databases with the ones in snapshot file at `path`
+
+        Only memory storage supports snapshot, and the snapshot could only
+        be loaded with the same `use_bson` setting it was saved with.
+
+        """
+        self._snapshot_storage().load_snapshot(path)
+
+    def _snapshot_storage(self):
+        # Look up on class, storage attributes are taken as database names
+        if getattr(type(self._storage), "save_snapshot", None) is None:
+            raise errors.OperationFailure(
+                "%s storage does not support snapshot."
+                % self._storage.nice_name())
+        return self._storage
+
     def database_names(self):
         """
         Return a list of database names.
@@ -0,0 +1,95 @@
+
+from .errors import InvalidOperation
+
+
+class _TransactionContext(object):
+    """Commit the transaction on exit, or abort it if error raised"""
+
+    def __init__(self, session):
+        self.__session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__session.in_transaction:
+            if exc_val is None:
+                self.__session.commit_transaction()
+            else:
+                self.__session.abort_transaction()
+
+
+class ClientSession(object):
+
+    def __init__(self, client):
+        """A session for grouping operations into one storage transaction
+
+        Unlike MongoDB, operations are not bound to session by passing
+        `session` argument. All operations made from the thread that started
+        the transaction are in that transaction, until it's committed or
+        aborted. Use `MontyClient.start_session` to get one.
+
+        Args:
+            client (MontyClient): The client that starts this session.
+
+        """
+        self._client = client
+        self._in_transaction = False
+        self._ended = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end_session()
+
+    @property
+    def client(self):
+        return self._client
+
+    @property
+    def has_ended(self):
+        return self._ended
+
+    @property
+    def in_transaction(self):
+        return self._in_transaction
+
+    def _check_ended(self):
+        if self._ended:
+            raise InvalidOperation("Cannot use ended session")
+
+    def start_transaction(self):
+        """Start a transaction, could be used as context manager"""
+        self._check_ended()
+        if self._in_transaction:
+            raise InvalidOperation("Transaction already in progress")
+
+        self._client._storage.begin_transaction()
+        self._in_transaction = True
+
+        return _TransactionContext(self)
+
+    def commit_transaction(self):
+        self._check_ended()
+        if not self._in_transaction:
+            raise InvalidOperation("No transaction started")
+
+        self._in_transaction = False
+        self._client._storage.commit_transaction()
+
+    def abort_transaction(self):
+        self._check_ended()
+        if not self._in_transaction:
+            raise InvalidOperation("No transaction started")
+
+        self._in_transaction = False
+        self._client._storage.abort_transaction()
+
+    def end_session(self):
+        """Abort the transaction in progress and end this session"""
+        if self._ended:
+            return
+        if self._in_transaction:
+            self.abort_transaction()
+        self._ended = True
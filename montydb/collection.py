@@ -3,6 +3,9 @@ from copy import deepcopy
 
 from .base import (
     BaseObject,
+    _index_list,
+    _index_document,
+    _gen_index_name,
     validate_is_mapping,
     validate_ok_for_update,
     validate_ok_for_replace,
@@ -18,8 +21,10 @@ from .engine.update import Updator
 from .types import (
     abc,
     bson,
+    iteritems,
     string_types,
     is_duckument_type,
+    copy_document,
     Counter,
     on_err_close,
 )
@@ -27,6 +32,7 @@ from .storage import StorageDuplicateKeyError
 from .errors import (
     DuplicateKeyError,
     BulkWriteError,
+    OperationFailure,
     WriteError,
 )
 
@@ -38,6 +44,11 @@ from .results import (
 )
 
 
+def _validate_id(doc_id):
+    if isinstance(doc_id, (list, tuple)):
+        raise WriteError("can't use an array for _id", code=2)
+
+
 NotImplementeds = {
     "aggregate",
     "aggregate_raw_batches",
@@ -48,13 +59,7 @@ NotImplementeds = {
     "find_one_and_delete",
     "find_one_and_replace",
     "find_one_and_update",
-    "create_index",
-    "create_indexes",
-    "drop_index",
-    "drop_indexes",
     "reindex",
-    "list_indexes",
-    "index_information",
     "rename",
     "options",
     "map_reduce",
@@ -134,14 +139,12 @@ class MontyCollection(BaseObject):
 
         if "_id" not in document:
             document["_id"] = bson.ObjectId()
+        _validate_id(document["_id"])
 
         try:
             result = self._storage.write_one(self, document)
-        except StorageDuplicateKeyError:
-            message = (
-                "E11000 duplicate key error collection: %s index: "
-                '_id_ dup key: { : "%s" }' % (self.full_name, str(document["_id"]))
-            )
+        except StorageDuplicateKeyError as e:
+            message = self._duplicate_key_message(e.index_name, document["_id"])
             details = {"index": 0, "code": 11000, "errmsg": message}
             raise DuplicateKeyError(message, code=11000, details=details)
 
@@ -157,27 +160,47 @@ class MontyCollection(BaseObject):
         if bypass_document_validation:
             pass
 
-        def set_id(doc):
-            if "_id" not in doc:
-                doc["_id"] = bson.ObjectId()
-            # Keep _id in track for error message
-            return doc["_id"]
+        invalid = []
 
-        counter = Counter(iter(documents), job_on_each=set_id)
+        def valid_docs():
+            # Stop at the document that has invalid `_id`, so the storage
+            # commits the ones before it like there are no more documents.
+            for doc in documents:
+                if "_id" not in doc:
+                    doc["_id"] = bson.ObjectId()
+                try:
+                    _validate_id(doc["_id"])
+                except WriteError as e:
+                    invalid.append(e)
+                    return
+                yield doc
+
+        # Keep _id in track for error message
+        counter = Counter(valid_docs(), job_on_each=lambda doc: doc["_id"])
 
         try:
             result = self._storage.write_many(self, counter, ordered)
-        except StorageDuplicateKeyError:
-            message = (
-                "E11000 duplicate key error collection: %s index: "
-                '_id_ dup key: { : "%s" }' % (self.full_name, str(counter.data))
-            )
-            index = counter.count - 1
+            if invalid:
+                raise invalid[0]
+        except (StorageDuplicateKeyError, WriteError) as e:
+            if isinstance(e, WriteError):
+                # The invalid one is not counted, all before are inserted
+                index = counter.count
+                code, message = e.code, str(e)
+            else:
+                # Storage that writes out of order tells which one failed
+                index = e.position
+                if index is None:
+                    index, dup_id = counter.count - 1, counter.data
+                else:
+                    dup_id = documents[index]["_id"]
+                code = 11000
+                message = self._duplicate_key_message(e.index_name, dup_id)
             result = {
                 "writeErrors": [
                     {
                         "index": index,
-                        "code": 11000,
+                        "code": code,
                         "errmsg": message,
                         "op": documents[index],
                     }
@@ -219,6 +242,7 @@ class MontyCollection(BaseObject):
             if upsert:
                 if "_id" not in replacement:
                     replacement["_id"] = bson.ObjectId()
+                _validate_id(replacement["_id"])
                 raw_result["upserted"] = replacement["_id"]
                 raw_result["n"] = 1
                 self._storage.write_one(self, replacement, check_keys=False)
@@ -226,7 +250,10 @@ class MontyCollection(BaseObject):
             raw_result["n"] = 1
             if fw.doc != replacement:
                 replacement["_id"] = fw.doc["_id"]
-                self._storage.update_one(self, replacement)
+                try:
+                    self._storage.update_one(self, replacement)
+                except StorageDuplicateKeyError as e:
+                    self._raise_duplicate_key(e, replacement["_id"])
                 raw_result["nModified"] = 1
 
         return UpdateResult(raw_result)
@@ -234,7 +261,7 @@ class MontyCollection(BaseObject):
     def _internal_scan_query(self, query_spec):
         """An internal document generator for update"""
         queryfilter = QueryFilter(query_spec)
-        documents = self._storage.query(MontyCursor(self), 0)
+        documents = MontyCursor(self, query_spec)._fetch()
         first_matched = None
         for doc in documents:
             if queryfilter(doc):
@@ -268,6 +295,7 @@ class MontyCollection(BaseObject):
         document = _remove_dollar_key(deepcopy(query_spec))
         if "_id" not in document:
             document["_id"] = bson.ObjectId()
+        _validate_id(document["_id"])
         raw_result["upserted"] = document["_id"]
         raw_result["n"] = 1
 
@@ -275,6 +303,22 @@ class MontyCollection(BaseObject):
         updator(fieldwalker, do_insert=True)
         self._storage.write_one(self, fieldwalker.doc)
 
+    def _duplicate_key_message(self, index_name, doc_id):
+        message = "E11000 duplicate key error collection: %s index: %s" % (
+            self.full_name, index_name
+        )
+        if index_name == "_id_":
+            message += ' dup key: { : "%s" }' % str(doc_id)
+        return message
+
+    def _raise_duplicate_key(self, error, doc_id):
+        message = "E11000 duplicate key error collection: %s index: %s" % (
+            self.full_name, error.index_name
+        )
+        if doc_id is not None:
+            message += ' dup document: { _id: "%s" }' % str(doc_id)
+        raise DuplicateKeyError(message, code=11000)
+
     def _no_id_update(self, updator, filter=None):
         id_operator = updator.operations.get("_id")
         doc_id = (filter or {}).get("_id")
@@ -317,7 +361,10 @@ class MontyCollection(BaseObject):
 
             raw_result["n"] = 1
             if updator(fw):
-                self._storage.update_one(self, fw.doc)
+                try:
+                    self._storage.update_one(self, fw.doc)
+                except StorageDuplicateKeyError as e:
+                    self._raise_duplicate_key(e, fw.doc["_id"])
                 raw_result["nModified"] = 1
 
         return UpdateResult(raw_result)
@@ -364,7 +411,10 @@ class MontyCollection(BaseObject):
                 raw_result["n"] = n
                 raw_result["nModified"] = m
 
-            self._storage.update_many(self, update_docs())
+            try:
+                self._storage.update_many(self, update_docs())
+            except StorageDuplicateKeyError as e:
+                self._raise_duplicate_key(e, None)
 
         return UpdateResult(raw_result)
 
@@ -373,7 +423,7 @@ class MontyCollection(BaseObject):
 
         queryfilter = QueryFilter(filter)
         storage = self._storage
-        documents = storage.query(MontyCursor(self), 0)
+        documents = MontyCursor(self, filter)._fetch()
 
         for doc in documents:
             if queryfilter(doc):
@@ -388,7 +438,7 @@ class MontyCollection(BaseObject):
 
         queryfilter = QueryFilter(filter)
         storage = self._storage
-        documents = storage.query(MontyCursor(self), 0)
+        documents = MontyCursor(self, filter)._fetch()
 
         doc_ids = set()
         for doc in documents:
@@ -445,7 +495,7 @@ class MontyCollection(BaseObject):
                     res.append(weighted)
             return res
 
-        documents = self._storage.query(MontyCursor(self), 0)
+        documents = MontyCursor(self, filter)._fetch()
 
         if filter:
             queryfilter = QueryFilter(filter)
@@ -456,7 +506,108 @@ class MontyCollection(BaseObject):
             for doc in documents:
                 result += get_value(doc)
 
-        return [weighted.value for weighted in sorted(result)]
+        values = [weighted.value for weighted in sorted(result)]
+        if self._storage.shares_documents:
+            values = [copy_document(value) for value in values]
+        return values
+
+    def create_index(self, keys, **kwargs):
+        """Create an index on this collection
+
+        Only ascending/descending indexes and the `name` and `unique`
+        options are supported, and it depends on storage engine.
+
+        """
+        keys = _index_list(keys)
+        index_doc = _index_document(keys)
+        keys = list(iteritems(index_doc))
+        name = kwargs.get("name") or _gen_index_name(keys)
+
+        for field, direction in keys:
+            if direction not in (1, -1):
+                raise OperationFailure(
+                    "Unknown index plugin %r" % (direction,), code=67
+                )
+
+        if [field for field, _ in keys] == ["_id"]:
+            return u"_id_"
+
+        unique = bool(kwargs.get("unique", False))
+        for index in self.list_indexes():
+            same_keys = list(iteritems(index["key"])) == keys
+            same_name = index["name"] == name
+            if same_keys and same_name:
+                if bool(index.get("unique")) == unique:
+                    return name
+            if same_keys or same_name:
+                raise OperationFailure(
+                    "Index with name: %s already exists with different "
+                    "options" % name,
+                    code=85,
+                )
+
+        try:
+            self._storage.create_index(self, name, keys, unique)
+        except StorageDuplicateKeyError:
+            raise DuplicateKeyError(
+                "E11000 duplicate key error collection: %s index: %s"
+                % (self.full_name, name),
+                code=11000,
+            )
+
+        return name
+
+    def create_indexes(self, indexes, **kwargs):
+        """Create one or more indexes, takes a list of `IndexModel`"""
+        names = list()
+        for index in indexes:
+            document = getattr(index, "document", index)
+            options = dict(
+                (k, v) for k, v in iteritems(document) if k != "key"
+            )
+            names.append(
+                self.create_index(list(iteritems(document["key"])), **options)
+            )
+        return names
+
+    def drop_index(self, index_or_name):
+        """ """
+        name = index_or_name
+        if isinstance(index_or_name, list):
+            name = _gen_index_name(index_or_name)
+
+        if not isinstance(name, string_types):
+            raise TypeError("index_or_name must be an index name or list")
+
+        if name == "_id_":
+            raise OperationFailure("cannot drop _id index", code=72)
+
+        if name not in [index["name"] for index in self.list_indexes()]:
+            raise OperationFailure("index not found with name [%s]" % name,
+                                   code=27)
+
+        self._storage.drop_index(self, name)
+
+    def drop_indexes(self):
+        """ """
+        for index in self.list_indexes():
+            if index["name"] != "_id_":
+                self._storage.drop_index(self, index["name"])
+
+    def list_indexes(self):
+        """ """
+        id_index = {"v": 2, "key": {"_id": 1}, "name": "_id_"}
+        return iter([id_index] + self._storage.list_indexes(self))
+
+    def index_information(self):
+        """ """
+        info = dict()
+        for index in self.list_indexes():
+            index = dict(index)
+            name = index.pop("name")
+            index["key"] = list(iteritems(index["key"]))
+            info[name] = index
+        return info
 
     def drop(self):
         self._database.drop_collection(self._name)
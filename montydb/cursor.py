@@ -1,15 +1,18 @@
 import warnings
 import copy
 from collections import deque
+from itertools import islice
 
 from .errors import InvalidOperation, OperationFailure
-from .engine.queries import QueryFilter, ordering
+from .engine.queries import QueryFilter, ordering, validate_sort_specifier
 from .engine.project import Projector
+from .storage import id_lookup_keys, keystring
 from .types import (
     bson,
     RE_PATTERN_TYPE,
     iteritems,
     integer_types,
+    copy_document,
 )
 from .base import (
     validate_boolean,
@@ -267,6 +270,58 @@ class MontyCursor(object):
     def _clone_base(self):
         return self.__class__(self._collection)
 
+    def _fetch(self, max_scan=0):
+        """Fetch decoded documents that may match the query from storage
+
+        If the query could be answered by `_id` lookup, only documents
+        stored under those `_id` are fetched and returned in `_id` order,
+        like scanning the `_id` index. Otherwise all documents are scanned.
+
+        """
+        keys = None
+        if "_id" in self._spec:
+            keys = id_lookup_keys(self._spec["_id"])
+        if keys is None:
+            storage = self._collection.database.client._storage
+            return storage.query(self, max_scan)
+
+        documents = self._fetch_ids(keys)
+        if max_scan:
+            return islice(documents, max_scan)
+        return documents
+
+    def _fetch_ids(self, keys, reverse=False):
+        storage = self._collection.database.client._storage
+        return sorted(storage.query_ids(self, keys),
+                      key=lambda doc: keystring.encode(doc["_id"]),
+                      reverse=reverse)
+
+    def _fetch_ordered(self, direction):
+        """Fetch documents in `_id` order, or return None if not able to
+
+        Documents come from `_id` lookup, or streamed from storage that
+        keeps them in key order.
+
+        """
+        keys = None
+        if "_id" in self._spec:
+            keys = id_lookup_keys(self._spec["_id"])
+        if keys is not None:
+            return self._fetch_ids(keys, reverse=direction < 0)
+
+        storage = self._collection.database.client._storage
+        return storage.query_ordered(self, direction < 0)
+
+    def _id_direction(self):
+        """Return 1 or -1 if documents are sorted by `_id` first, or 0"""
+        if not self._ordering:
+            return 0
+        for direction in self._ordering.values():
+            validate_sort_specifier(direction)
+        path, direction = next(iter(self._ordering.items()))
+        # `_id` is unique, following sort keys take no effect.
+        return direction if path == "_id" else 0
+
     def __check_okay_to_chain(self):
         if self._retrieved or self._id is not None:
             raise InvalidOperation("cannot set options after executing query")
@@ -304,18 +359,36 @@ class MontyCursor(object):
 
         # Fetch from storage
         # (NOTE) Documents return from storage should be decoded.
-        storage = self._collection.database.client._storage
-        documents = storage.query(self, max_scan)
+        documents = None
+        # Documents scanned in `_id` order are already sorted, unless
+        # only the first `max_scan` documents in storage should be sorted.
+        direction = 0 if max_scan else self._id_direction()
+        if direction:
+            documents = self._fetch_ordered(direction)
+        in_order = documents is not None
+        if not in_order:
+            documents = self._fetch(max_scan)
+        # Stop scanning once enough documents matched, if there is no
+        # need to sort them all.
+        wanted = 0
+        if self._limit and (in_order or not self._ordering):
+            wanted = self._skip + abs(self._limit)
         # Filtering
         fieldwalkers = []
         for doc in documents:
             if queryfilter(doc):
                 fieldwalkers.append(queryfilter.fieldwalker)
+                if len(fieldwalkers) == wanted:
+                    break
 
-        self._doc_count = len(fieldwalkers)
+        if wanted and len(fieldwalkers) == wanted:
+            # Scan stopped early, total count is unknown.
+            self._doc_count = None
+        else:
+            self._doc_count = len(fieldwalkers)
 
         # Sorting
-        if self._ordering:
+        if self._ordering and not in_order:
             fieldwalkers = ordering(fieldwalkers, self._ordering)
 
         # Limit and Skip
@@ -332,7 +405,10 @@ class MontyCursor(object):
             for fw in fieldwalkers:
                 projector(fw)
 
-        self._data = deque(fw.doc for fw in fieldwalkers)
+        documents = (fw.doc for fw in fieldwalkers)
+        if self._collection.database.client._storage.shares_documents:
+            documents = (copy_document(doc) for doc in documents)
+        self._data = deque(documents)
         self._retrieved += len(fieldwalkers)
         # (NOTE) cursor id should return from storage, but ignore for now.
         self._id = 0
@@ -408,6 +484,12 @@ class MontyCursor(object):
             self.__query()
         if with_limit_and_skip:
             return self._doc_count_with_skip_limit
+        if self._doc_count is None:
+            # Scan was stopped early by limit, count all matched documents.
+            clone = self.clone()
+            clone._limit = 0
+            clone.__query()
+            self._doc_count = clone._doc_count
         return self._doc_count
 
     def limit(self, limit):
@@ -2,7 +2,13 @@
 import os
 from abc import abstractmethod
 from ..types import ConfigParser
-from ..types import bson
+from ..types import (
+    bson,
+    is_duckument_type,
+
+    RE_PATTERN_TYPE,
+)
+from . import keystring
 
 
 class StorageError(Exception):
@@ -10,7 +16,111 @@ class StorageError(Exception):
 
 
 class StorageDuplicateKeyError(StorageError):
-    """Raise when an insert or update fails due to a duplicate key error."""
+    """Raise when an insert or update fails due to a duplicate key error.
+
+    Args:
+        index_name (str): Name of the index that has the duplicated key,
+            default "_id_".
+
+    Storage that does not insert documents of `write_many` in order sets
+    `position` to the position of the duplicated one.
+
+    """
+
+    def __init__(self, index_name="_id_"):
+        super(StorageDuplicateKeyError, self).__init__(index_name)
+        self.index_name = index_name
+        self.position = None
+
+
+def _id_lookup_key(value):
+    """Return the key that stores an `_id` equal to `value`, or None
+
+    Regular expression matches instead of comparing, and array could not
+    be `_id`, so they could not be looked up.
+
+    """
+    if isinstance(value, (list, tuple, RE_PATTERN_TYPE)):
+        return None
+    if bson.bson_used and isinstance(value, bson.Regex):
+        return None
+    return keystring.encode(value)
+
+
+def id_lookup_keys(spec):
+    """Return encoded `_id` keys that could match `_id` query `spec`
+
+    Only equality and `$in` are supported, documents that stored under
+    returned keys are a superset of the ones that match the query. Return
+    None if the query could not be answered by `_id` lookup.
+
+    """
+    if not is_duckument_type(spec):
+        values = [spec]
+    elif not spec or not all(op[:1] == "$" for op in spec):
+        return None
+    elif "$eq" in spec:
+        values = [spec["$eq"]]
+    elif "$in" in spec and isinstance(spec["$in"], (list, tuple)):
+        values = spec["$in"]
+    else:
+        return None
+
+    keys = list()
+    for value in values:
+        key = _id_lookup_key(value)
+        if key is None:
+            return None
+        if key not in keys:
+            keys.append(key)
+
+    return keys
+
+
+_RANGE_TAGS = (
+    keystring.TAG_NUMBER,
+    keystring.TAG_STRING,
+    keystring.TAG_OBJECTID,
+    keystring.TAG_DATE,
+)
+
+
+def id_key_range(spec):
+    """Return half-open range (lower, upper) of keys for `_id` in `spec`
+
+    Range comparisons on `_id` in query `spec` are bounded in the type of
+    compared value like MongoDB does, and strict bounds are taken as
+    non-strict, so documents in the range are a superset of the ones that
+    match. Return None if there's no range comparison could be used.
+
+    """
+    spec = (spec or {}).get("_id")
+    if not is_duckument_type(spec) or \
+            not all(op[:1] == "$" for op in spec):
+        return None
+
+    lower = upper = None
+    for op, value in spec.items():
+        if op not in ("$gt", "$gte", "$lt", "$lte"):
+            continue
+        key = _id_lookup_key(value)
+        if key is None or key[:1] not in _RANGE_TAGS:
+            continue
+        if key == keystring.encode(float("nan")):
+            continue
+        tag_lower, tag_upper = keystring.type_range(key)
+        if op in ("$gt", "$gte"):
+            bound = (key, tag_upper)
+        else:
+            # Keys are never prefix of each other, any key that greater
+            # than `key` is greater than `key + END`.
+            bound = (tag_lower, key + keystring.END)
+        lower = bound[0] if lower is None else max(lower, bound[0])
+        upper = bound[1] if upper is None else min(upper, bound[1])
+
+    if lower is None:
+        return None
+    return lower, upper
 
 
 class AbstractStorage(object):
@@ -19,6 +129,10 @@ class AbstractStorage(object):
 
     config_fname = "monty.storage.cfg"
 
+    # Documents returned from query are the stored objects, and should be
+    # copied before handed to user.
+    shares_documents = False
+
     def __init__(self, repository, storage_config):
         self.is_opened = True
         self._repository = repository
@@ -112,6 +226,19 @@ class AbstractStorage(object):
         """
         pass
 
+    def begin_transaction(self):
+        """Begin a transaction for operations made in current thread"""
+        raise NotImplementedError("'%s' storage does not support "
+                                  "transaction." % self.nice_name())
+
+    def commit_transaction(self):
+        raise NotImplementedError("'%s' storage does not support "
+                                  "transaction." % self.nice_name())
+
+    def abort_transaction(self):
+        raise NotImplementedError("'%s' storage does not support "
+                                  "transaction." % self.nice_name())
+
     @property
     def repository(self):
         return self._repository
@@ -215,6 +342,20 @@ class AbstractCollection(object):
     def delete_many(self):
         return NotImplemented
 
+    def list_indexes(self):
+        """Return secondary index documents, storage without index support
+        has none.
+        """
+        return []
+
+    def create_index(self, name, keys, unique=False):
+        raise NotImplementedError("'%s' storage does not support secondary "
+                                  "index." % self._database._storage.nice_name())
+
+    def drop_index(self, name):
+        raise NotImplementedError("'%s' storage does not support secondary "
+                                  "index." % self._database._storage.nice_name())
+
 
 class AbstractCursor(object):
 
@@ -232,3 +373,22 @@ class AbstractCursor(object):
     @abstractmethod
     def query(self):
         return NotImplemented
+
+    def query_ids(self, keys):
+        """Return decoded documents that stored under encoded `_id` `keys`
+
+        Missing keys are skipped. Storage that can not look up documents
+        by key may return all documents, they are filtered afterward.
+
+        """
+        return self.query(0)
+
+    def query_ordered(self, reverse=False):
+        """Return decoded documents in `_id` order, or None if not able to
+
+        Like `query`, documents may be a superset of the ones that match,
+        but should be sorted by `_id` key, descending if `reverse`. So the
+        sort on `_id` could be streamed from storage.
+
+        """
+        return None
@@ -1,56 +1,299 @@
 
 import os
+import gzip
 import shutil
+import binascii
+import tempfile
+import warnings
+import threading
 from collections import OrderedDict
 from itertools import islice
+try:
+    import lzma
+except ImportError:
+    # Python 2
+    lzma = None
 
-from ..types import unicode_, bson
+from ..types import unicode_, to_bytes, bson
 from . import (
     AbstractStorage,
     AbstractDatabase,
     AbstractCollection,
     AbstractCursor,
 
+    StorageError,
     StorageDuplicateKeyError,
+    id_key_range,
+    keystring,
 )
 
 
 FLATFILE_DB_EXT = ".json"
+FLATFILE_JOURNAL_EXT = ".journal"
+
+# Not in Python 2, where `os.rename` replaces existing file on POSIX
+_replace = getattr(os, "replace", os.rename)
+
+# Compressed collection files are told by the leading magic bytes, so
+# files written before changing `compression` could still be read.
+FLATFILE_COMPRESSIONS = {
+    "gzip": (b"\x1f\x8b", gzip.open),
+    "lzma": (b"\xfd7zXZ\x00", lzma.open if lzma else None),
+}
+
+
+def _open(file_path, mode="rb", compression=None):
+    """Open collection file in binary `mode`, compressed or not
+
+    Args:
+        file_path (str): Path of collection file.
+        mode (str): "rb" or "wb". Default "rb"
+        compression (str): Compression for writing, "gzip", "lzma" or
+            None. Reading detects compression from the file content.
+
+    """
+    if mode == "rb":
+        with open(file_path, "rb") as fp:
+            magic = fp.read(6)
+        for name, (prefix, opener) in FLATFILE_COMPRESSIONS.items():
+            if magic.startswith(prefix):
+                if opener is None:
+                    raise StorageError("Could not decompress %s, %s is "
+                                       "not available." % (file_path, name))
+                return opener(file_path, mode)
+    elif compression:
+        return FLATFILE_COMPRESSIONS[compression][1](file_path, mode)
+    return open(file_path, mode)
 
 
 def _read_pretty(file_path):
-    with open(file_path, "r") as fp:
-        lines = [line.strip() for line in fp.readlines()]
-        if lines:
-            serialized = "".join(lines)
-            return bson.json_loads(serialized)
+    """Yield documents from collection file, one line at a time
+
+    `_write_pretty` puts each document on its own line, between the lines
+    of brackets, so documents are parsed one by one without reading the
+    whole file into memory.
+
+    Raise ValueError if the file is not in that layout, e.g. edited by hand.
+
+    """
+    with _open(file_path) as fp:
+        for line in fp:
+            line = line.decode("utf-8").strip()
+            if line in ("[", "]", ""):
+                continue
+            if line.endswith(","):
+                line = line[:-1]
+            doc = bson.json_loads(line)
+            if not isinstance(doc, dict):
+                raise ValueError("Not one document per line.")
+            yield doc
+
+
+def _read_json(file_path):
+    """Return documents from collection file in any JSON layout"""
+    with _open(file_path) as fp:
+        serialized = fp.read().decode("utf-8")
+    return bson.json_loads(serialized) if serialized.strip() else []
+
+
+def _write_pretty(file_path, documents, compression=None):
+    """Write documents one per line, compressed while writing if required
+
+    Documents are written to a temporary file next to the collection file,
+    which is synced and then renamed over, so the collection file is never
+    left half written.
+
+    """
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(file_path)),
+        prefix=os.path.basename(file_path) + ".",
+        suffix=".tmp")
+    os.close(fd)
+    try:
+        if os.path.isfile(file_path):
+            shutil.copymode(file_path, temp_path)
+        with _open(temp_path, "wb", compression) as fp:
+            fp.write(b"[\n")
+            for i, doc in enumerate(documents.values()):
+                if i:
+                    fp.write(b",\n")
+                fp.write(to_bytes(bson.json_dumps(bson.document_decode(doc))))
+            fp.write(b"\n]")
+        with open(temp_path, "ab") as fp:
+            os.fsync(fp.fileno())
+        _replace(temp_path, file_path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+def _read_journal(file_path):
+    """Yield (key, encoded document or None if deleted) from journal"""
+    with open(file_path, "rb") as fp:
+        for line in fp:
+            try:
+                record = bson.json_loads(line.decode("utf-8"))
+            except ValueError:
+                # Incomplete line, the write was interrupted.
+                continue
+            if "put" in record:
+                doc = record["put"]
+                yield keystring.encode(doc["_id"]), bson.document_encode(doc)
+            else:
+                yield binascii.unhexlify(record["delete"]), None
+
+
+def _write_journal(file_path, changes):
+    """Append one JSON line per changed document to journal"""
+    lines = []
+    for key, doc in changes.items():
+        if doc is None:
+            record = {"delete": binascii.hexlify(key).decode("ascii")}
         else:
-            return []
+            record = {"put": bson.document_decode(doc)}
+        lines.append(to_bytes(bson.json_dumps(record)) + b"\n")
+
+    with open(file_path, "a+b") as fp:
+        fp.seek(0, os.SEEK_END)
+        if fp.tell():
+            fp.seek(-1, os.SEEK_END)
+            if fp.read(1) != b"\n":
+                # Start a new line after the interrupted one
+                lines.insert(0, b"\n")
+        fp.write(b"".join(lines))
 
 
-def _write_pretty(file_path, documents):
-    serialized = []
-    for doc in documents.values():
-        serialized.append(bson.json_dumps(bson.document_decode(doc)))
+class FlatFileFlusher(object):
+    """Background thread that flushes modified collections to disk
+
+    Collections are flushed every `interval` seconds, or as soon as one of
+    them is marked urgent.
+
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name="montydb-flatfile-flusher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def mark(self, engine, urgent=False):
+        with self._lock:
+            self._dirty.add(engine)
+        if urgent:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
 
-    with open(file_path, "w") as fp:
-        fp.write("[\n{}\n]".format(",\n".join(serialized)))
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for engine in dirty:
+            try:
+                engine.flush()
+            except Exception as e:
+                # Try again in next round, `close` flushes in the caller's
+                # thread so the error will be raised there.
+                self.mark(engine)
+                warnings.warn("Failed to flush %s in background: %s"
+                              % (engine.file_path, e))
+
+    def stop(self):
+        """Stop the thread after a last flush"""
+        self._stopped = True
+        self._wake.set()
+        self._thread.join()
 
 
 class FlatFileKVEngine(object):
 
-    def __init__(self, file_path, conn_config):
+    def __init__(self, file_path, conn_config, flusher=None):
         """
         """
         self.file_path = file_path
+        self.journal_path = file_path + FLATFILE_JOURNAL_EXT
 
         self.__conn_config = conn_config
-        self.__cache = OrderedDict()
+        self.__flusher = flusher
+        # Documents are loaded on first read or write, see `_loaded`
+        self.__cache = None
+        self.__changes = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__flush_lock = threading.RLock()
+        self.__dropped = False
         self.modified_count = 0
+        self.journal_count = 0
+        self.size = 0
+
+    def _loaded(self):
+        """Return cached documents, load them from disk if not yet
+
+        Must be called with `__lock` held.
+
+        """
+        if self.__cache is not None:
+            return self.__cache
+
+        cache = OrderedDict()
+        self.journal_count = 0
 
         if os.path.isfile(self.file_path):
-            for doc in _read_pretty(self.file_path):
-                self.__cache[doc["_id"]] = bson.document_encode(doc)
+            try:
+                self._load(cache, _read_pretty(self.file_path))
+            except ValueError:
+                cache.clear()
+                self._load(cache, _read_json(self.file_path))
+
+        if os.path.isfile(self.journal_path):
+            for id, doc in _read_journal(self.journal_path):
+                if doc is None:
+                    cache.pop(id, None)
+                else:
+                    cache[id] = doc
+                self.journal_count += 1
+
+        self.__cache = cache
+        self.size = sum(len(doc) for doc in cache.values())
+        return cache
+
+    def _load(self, cache, documents):
+        for doc in documents:
+            id = keystring.encode(doc["_id"])
+            if id in cache:
+                # e.g. `1` and `1.0`, which were different keys before
+                raise StorageError("Documents that have equal `_id` "
+                                   "found in %s." % self.file_path)
+            cache[id] = bson.document_encode(doc)
+
+    @property
+    def is_loaded(self):
+        return self.__cache is not None
+
+    def unload(self):
+        """Flush and drop cached documents, until next read or write
+
+        Return False if the documents were modified while flushing, and
+        kept in memory.
+
+        """
+        self.flush()
+        with self.__flush_lock:
+            with self.__lock:
+                if self.modified_count or self.__changes:
+                    return False
+                self.__cache = None
+                self.journal_count = 0
+                self.size = 0
+                return True
 
     @classmethod
     def touch(cls, file_path):
@@ -60,32 +303,125 @@ class FlatFileKVEngine(object):
 
     @property
     def document_count(self):
-        return len(self.__cache)
+        return len(self.read())
+
+    @property
+    def journaling(self):
+        return self.__conn_config["journal"]
 
     def flush(self):
-        _write_pretty(self.file_path, self.__cache)
-        self.modified_count = 0
+        """Write modified documents to disk
+
+        In journal mode, only the changes since last flush are appended to
+        the journal, and the journal is folded into the collection file by
+        `compact` once it has more than `journal_limit` records. Otherwise
+        the whole collection file is rewritten.
+
+        Documents are taken from the cache at once and written without
+        holding the cache, so writes could go on while flushing. If the
+        write failed, taken changes are put back before the newer ones, to
+        be written by next flush.
+
+        """
+        with self.__flush_lock:
+            if self.__dropped or self.__cache is None:
+                return
+            with self.__lock:
+                modified_count, self.modified_count = self.modified_count, 0
+                if self.journaling:
+                    changes, self.__changes = self.__changes, OrderedDict()
+                else:
+                    documents = self.__cache.copy()
+
+            try:
+                if not self.journaling:
+                    _write_pretty(self.file_path, documents,
+                                  self.__conn_config.get("compression"))
+                    return
+                if changes:
+                    _write_journal(self.journal_path, changes)
+            except Exception:
+                with self.__lock:
+                    self.modified_count += modified_count
+                    if self.journaling:
+                        changes.update(self.__changes)
+                        self.__changes = changes
+                raise
+
+            self.journal_count += len(changes)
+            if self.journal_count > self.__conn_config["journal_limit"]:
+                self.compact()
+
+    def compact(self):
+        """Rewrite collection file with cached documents and drop journal
+        """
+        with self.__flush_lock:
+            if self.__dropped or self.__cache is None:
+                return
+            with self.__lock:
+                documents = self.__cache.copy()
+                self.__changes = OrderedDict()
+            _write_pretty(self.file_path, documents,
+                          self.__conn_config.get("compression"))
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
+            self.journal_count = 0
+
+    def close(self):
+        """Flush and fold the journal into the collection file
+
+        Documents are loaded for folding if they are not, e.g. unloaded
+        over memory budget, so the journal would not grow across runs.
+
+        """
+        self.flush()
+        if not self.__dropped and os.path.isfile(self.journal_path):
+            self.read()
+            self.compact()
+
+    def drop(self):
+        """Stop writing to disk, wait for the flush in progress if any"""
+        with self.__flush_lock:
+            self.__dropped = True
+
+    def _modified(self, count):
+        """Flush or have the flusher flush, if modified more than cached"""
+        self.modified_count += count
+        urgent = self.modified_count > self.__conn_config["cache_modified"]
+        if self.__flusher is not None:
+            self.__flusher.mark(self, urgent)
+        return urgent and self.__flusher is None
 
     def read(self):
-        return self.__cache
+        with self.__lock:
+            return self._loaded()
 
     def _id_existed(self, id):
-        if id in self.__cache:
+        if id in self.read():
             return True
 
     def write(self, documents):
         """`documents` should be `OrderedDict` type"""
-        self.modified_count += len(documents)
-        self.__cache.update(documents)
-
-        if self.modified_count > self.__conn_config["cache_modified"]:
+        with self.__lock:
+            cache = self._loaded()
+            for id, doc in documents.items():
+                self.size += len(doc) - len(cache.get(id, b""))
+            cache.update(documents)
+            if self.journaling:
+                self.__changes.update(documents)
+            flush = self._modified(len(documents))
+
+        if flush:
             self.flush()
 
     def delete(self, doc_id):
-        self.modified_count += 1
-        del self.__cache[doc_id]
+        with self.__lock:
+            self.size -= len(self._loaded().pop(doc_id))
+            if self.journaling:
+                self.__changes[doc_id] = None
+            flush = self._modified(1)
 
-        if self.modified_count > self.__conn_config["cache_modified"]:
+        if flush:
             self.flush()
 
 
@@ -95,10 +431,45 @@ class FlatFileStorage(AbstractStorage):
 
     def __init__(self, repository, storage_config):
         super(FlatFileStorage, self).__init__(repository, storage_config)
+        self._lock = threading.RLock()
         self._init_cache_manager()
 
     def _init_cache_manager(self):
         self._cache_manager = {}
+        self._flusher = None
+        self._recently_used = OrderedDict()
+
+    def _get_flusher(self):
+        """Return the background flusher, or None if not enabled"""
+        interval = self._config["flush_interval"]
+        with self._lock:
+            if interval > 0 and self._flusher is None:
+                self._flusher = FlatFileFlusher(interval)
+            return self._flusher
+
+    def _touch(self, engine):
+        """Mark `engine` as most recently used, and unload idle engines
+
+        If loaded documents are larger than `memory_budget`, the least
+        recently used engines other than `engine` are flushed and unloaded.
+
+        """
+        budget = self._config["memory_budget"]
+        if budget <= 0:
+            return
+        with self._lock:
+            self._recently_used.pop(engine, None)
+            self._recently_used[engine] = None
+            idle = [e for e in self._recently_used
+                    if e is not engine and e.is_loaded]
+            loaded = sum(e.size for e in idle) + engine.size
+
+        for idle_engine in idle:
+            if loaded <= budget:
+                break
+            size = idle_engine.size
+            if idle_engine.unload():
+                loaded -= size
 
     def _db_path(self, db_name):
         """
@@ -111,21 +482,53 @@ class FlatFileStorage(AbstractStorage):
         return "flatfile"
 
     @classmethod
-    def config(cls, cache_modified=0, **kwargs):
+    def config(cls, cache_modified=0, journal=False, journal_limit=1000,
+               flush_interval=0, memory_budget=0, compression=None,
+               **kwargs):
         """
 
         Args:
             cache_modified (int): Default 0
+            journal (bool): Append changes to a journal file instead of
+                rewriting the collection file on flush. Default False
+            journal_limit (int): How many journal records before folding
+                the journal into the collection file. Default 1000
+            flush_interval (float): Seconds between flushes that done by
+                a background thread, 0 to flush in the writing thread.
+                Default 0
+            memory_budget (int): Bytes of documents that kept in memory,
+                least recently used collections are unloaded when over
+                budget. 0 means no limit. Default 0
+            compression (str): Compress collection files with "gzip" or
+                "lzma". Default None
 
         """
-        return {
+        config = {
             "cache_modified": int(cache_modified),
+            "journal": str(journal).lower() in ("true", "1"),
+            "journal_limit": int(journal_limit),
+            "flush_interval": float(flush_interval),
+            "memory_budget": int(memory_budget),
         }
+        if compression:
+            if compression not in FLATFILE_COMPRESSIONS:
+                raise ValueError("Unknown FlatFile compression %r, should "
+                                 "be one of %s." % (
+                                     compression,
+                                     sorted(FLATFILE_COMPRESSIONS)))
+            if FLATFILE_COMPRESSIONS[compression][1] is None:
+                raise ValueError("FlatFile compression %r is not available."
+                                 % compression)
+            config["compression"] = compression
+
+        return config
 
     def close(self):
+        if self._flusher is not None:
+            self._flusher.stop()
         for db in self._cache_manager:
             for col in self._cache_manager[db]:
-                self._cache_manager[db][col].flush()
+                self._cache_manager[db][col].close()
         self._init_cache_manager()
         self.is_opened = False
 
@@ -135,10 +538,11 @@ class FlatFileStorage(AbstractStorage):
 
     def database_drop(self, db_name):
         db_path = self._db_path(db_name)
+        for engine in self._cache_manager.pop(db_name, {}).values():
+            engine.drop()
+            self._recently_used.pop(engine, None)
         if os.path.isdir(db_path):
             shutil.rmtree(db_path)
-        if db_name in self._cache_manager:
-            del self._cache_manager[db_name]
 
     def database_list(self):
         return [
@@ -154,7 +558,8 @@ class FlatFileDatabase(AbstractDatabase):
     def __init__(self, storage, subject):
         super(FlatFileDatabase, self).__init__(storage, subject)
         if self._name not in storage._cache_manager:
-            storage._cache_manager[self._name] = {}
+            with storage._lock:
+                storage._cache_manager.setdefault(self._name, {})
         self._db_path = storage._db_path(self._name)
 
     @property
@@ -179,16 +584,22 @@ class FlatFileDatabase(AbstractDatabase):
         FlatFileKVEngine.touch(self._col_path(col_name))
 
     def collection_drop(self, col_name):
-        if self.collection_exists(col_name):
-            os.remove(self._col_path(col_name))
+        col_path = self._col_path(col_name)
         if col_name in self._cache_manager:
-            del self._cache_manager[col_name]
+            engine = self._cache_manager.pop(col_name)
+            engine.drop()
+            self._storage._recently_used.pop(engine, None)
+        if self.collection_exists(col_name):
+            os.remove(col_path)
+        if os.path.isfile(col_path + FLATFILE_JOURNAL_EXT):
+            os.remove(col_path + FLATFILE_JOURNAL_EXT)
 
     def collection_list(self):
         if not self.database_exists():
             return []
         return [os.path.splitext(name)[0]
-                for name in os.listdir(unicode_(self._db_path))]
+                for name in os.listdir(unicode_(self._db_path))
+                if name.endswith(FLATFILE_DB_EXT)]
 
 
 FlatFileStorage.contractor_cls = FlatFileDatabase
@@ -199,13 +610,19 @@ class FlatFileCollection(AbstractCollection):
     """
 
     def __init__(self, database, subject):
-        config = database._storage._config
+        storage = database._storage
         super(FlatFileCollection, self).__init__(database, subject)
 
         self._col_path = self._database._col_path(self._name)
         if self._name not in database._cache_manager:
-            database._cache_manager[self._name] = FlatFileKVEngine(
-                self._col_path, config)
+            with storage._lock:
+                # Other thread may have loaded it while waiting for lock
+                if self._name not in database._cache_manager:
+                    database._cache_manager[self._name] = FlatFileKVEngine(
+                        self._col_path,
+                        storage._config,
+                        storage._get_flusher())
+        storage._touch(self._flatfile)
 
     @property
     def _flatfile(self):
@@ -222,7 +639,7 @@ class FlatFileCollection(AbstractCollection):
     def write_one(self, doc, check_keys=True):
         _doc = OrderedDict()
         _id = doc["_id"]
-        b_id = bson.id_encode(_id)
+        b_id = keystring.encode(_id)
         if self._flatfile._id_existed(b_id):
             raise StorageDuplicateKeyError()
 
@@ -238,7 +655,7 @@ class FlatFileCollection(AbstractCollection):
         has_duplicated_key = False
         for doc in docs:
             _id = doc["_id"]
-            b_id = bson.id_encode(_id)
+            b_id = keystring.encode(_id)
             if b_id in _docs or self._flatfile._id_existed(b_id):
                 has_duplicated_key = True
                 break
@@ -255,22 +672,22 @@ class FlatFileCollection(AbstractCollection):
 
     def update_one(self, doc):
         _doc = OrderedDict()
-        _doc[bson.id_encode(doc["_id"])] = self._encode_doc(doc)
+        _doc[keystring.encode(doc["_id"])] = self._encode_doc(doc)
         self._flatfile.write(_doc)
 
     def update_many(self, docs):
         _docs = OrderedDict()
         for doc in docs:
-            _docs[bson.id_encode(doc["_id"])] = self._encode_doc(doc)
+            _docs[keystring.encode(doc["_id"])] = self._encode_doc(doc)
 
         self._flatfile.write(_docs)
 
     def delete_one(self, id):
-        self._flatfile.delete(bson.id_encode(id))
+        self._flatfile.delete(keystring.encode(id))
 
     def delete_many(self, ids):
         for id in ids:
-            self._flatfile.delete(bson.id_encode(id))
+            self._flatfile.delete(keystring.encode(id))
 
 
 FlatFileDatabase.contractor_cls = FlatFileCollection
@@ -282,6 +699,7 @@ class FlatFileCursor(AbstractCursor):
 
     def __init__(self, collection, subject):
         super(FlatFileCursor, self).__init__(collection, subject)
+        self._key_range = id_key_range(subject._spec)
 
     @property
     def _flatfile(self):
@@ -289,11 +707,27 @@ class FlatFileCursor(AbstractCursor):
 
     def query(self, max_scan):
         cache = self._flatfile.read()
-        docs = (self._decode_doc(doc) for doc in cache.values())
+        if self._key_range is None or max_scan:
+            docs = (self._decode_doc(doc) for doc in cache.values())
+        else:
+            docs = (self._decode_doc(doc) for key, doc in cache.items()
+                    if keystring.in_range(key, self._key_range))
         if not max_scan:
             return docs
         else:
             return islice(docs, max_scan)
 
+    def query_ids(self, keys):
+        cache = self._flatfile.read()
+        return [self._decode_doc(cache[key]) for key in keys if key in cache]
+
+    def query_ordered(self, reverse=False):
+        cache = self._flatfile.read()
+        keys = sorted(cache, reverse=reverse)
+        if self._key_range is not None:
+            keys = [key for key in keys
+                    if keystring.in_range(key, self._key_range)]
+        return (self._decode_doc(cache[key]) for key in keys if key in cache)
+
 
 FlatFileCollection.contractor_cls = FlatFileCursor
@@ -0,0 +1,216 @@
+"""Order-preserving key encoding
+
+Values are encoded into bytes that compare in the same order as MongoDB
+(and `montydb.engine.weighted`) compares the values, so the storage that
+keeps keys sorted keeps documents in `_id` order. Equal values are encoded
+into the same key, e.g. `1`, `1.0` and `Decimal128("1")`, and no key is a
+prefix of other key.
+
+"""
+import math
+import struct
+import decimal
+import calendar
+import datetime
+from fractions import Fraction
+
+from ..types import (
+    bson,
+    string_types,
+    integer_types,
+    is_duckument_type,
+
+    RE_PATTERN_TYPE,
+    re_int_flag_to_str,
+)
+
+
+TAG_MINKEY = b"\x01"
+TAG_NULL = b"\x05"
+TAG_NUMBER = b"\x10"
+TAG_STRING = b"\x20"
+TAG_OBJECT = b"\x30"
+TAG_ARRAY = b"\x38"
+TAG_BINARY = b"\x40"
+TAG_OBJECTID = b"\x48"
+TAG_BOOL = b"\x50"
+TAG_DATE = b"\x58"
+TAG_TIMESTAMP = b"\x60"
+TAG_REGEX = b"\x68"
+TAG_CODE = b"\x70"
+TAG_CODE_W_SCOPE = b"\x78"
+TAG_OTHER = b"\x7f"
+TAG_MAXKEY = b"\xf0"
+
+END = b"\x00"
+
+_NAN = b"\x00" * 16  # NaN sorts before all numbers
+
+
+def flip_sign(packed):
+    """Make big-endian packed double sort as unsigned bytes"""
+    packed = bytearray(packed)
+    if packed[0] & 0x80:
+        packed = bytearray(b ^ 0xFF for b in packed)
+    else:
+        packed[0] |= 0x80
+    return bytes(packed)
+
+
+def pack_int64(value):
+    return struct.pack(">Q", value + (1 << 63))
+
+
+def pack_string(value):
+    if not isinstance(value, bytes):
+        value = value.encode("utf-8")
+    # Escape NUL so that the terminator sorts before any character
+    return value.replace(b"\x00", b"\x00\xff") + b"\x00\x00"
+
+
+def _pack_beyond_double(value, approx):
+    """Pack number that rounds to zero or infinity in double
+
+    The exact decimal digits follow the rounded double and a remainder of
+    one step toward the nearest non-zero finite doubles, so the number is
+    ordered between those and zero (or infinity).
+
+    """
+    value = decimal.Decimal(value)
+    # Digits are shifted by one, so the terminator sorts before them
+    digits = bytearray(d + 1 for d in value.as_tuple()[1]).rstrip(b"\x01")
+    packed = pack_int64(value.adjusted()) + bytes(digits) + END
+    if value < 0:
+        packed = bytes(bytearray(b ^ 0xFF for b in bytearray(packed)))
+    step = 1 if (value > 0) == (not approx) else -1
+    return (flip_sign(struct.pack(">d", approx or 0.0))
+            + pack_int64(step) + packed)
+
+
+def pack_number(value):
+    """Pack number into 16 bytes, the nearest double and the remainder
+
+    The remainder is scaled by the unit in the last place of the double,
+    so large integers and decimals which could not be represented exactly
+    by double are still ordered and told apart. Numbers that round to zero
+    or infinity are followed by their exact digits.
+
+    """
+    if bson.bson_used and isinstance(value, bson.Decimal128):
+        value = value.to_decimal()
+        if value.is_nan():
+            return _NAN
+    try:
+        approx = float(value)
+    except OverflowError:
+        approx = float("inf") if value > 0 else float("-inf")
+    if approx != approx:
+        return _NAN
+    if (not approx or math.isinf(approx)) and abs(value) != abs(approx):
+        return _pack_beyond_double(value, approx)
+
+    remainder = 0
+    if approx and not math.isinf(approx):
+        exact = Fraction(value) - Fraction(approx)
+        if exact:
+            exponent = math.frexp(approx)[1]
+            ulp = Fraction(2) ** max(exponent - 53, -1074)
+            scaled = exact / ulp * (1 << 62)
+            # Round half up, `round` returns float in Python 2
+            remainder = ((scaled.numerator * 2 + scaled.denominator)
+                         // (scaled.denominator * 2))
+
+    return (flip_sign(struct.pack(">d", approx or 0.0))
+            + pack_int64(remainder))
+
+
+def pack_datetime(value):
+    if value.utcoffset() is not None:
+        value = value - value.utcoffset()
+    millis = (calendar.timegm(value.timetuple()) * 1000
+              + value.microsecond // 1000)
+    return pack_int64(millis)
+
+
+def _pack_object(value):
+    elements = list()
+    for key, val in value.items():
+        val = encode(val)
+        # Elements compare by value type first, then field name and value
+        elements.append(val[:1] + pack_string(key) + val[1:])
+    return b"".join(elements) + END
+
+
+def _pack_array(value):
+    return b"".join(encode(val) for val in value) + END
+
+
+def encode(value):
+    """Encode `value` into an order-preserving key
+
+    Args:
+        value: Any value that could be stored as `_id`.
+
+    Returns:
+        bytes: The key.
+
+    """
+    if value is None:
+        return TAG_NULL
+    if isinstance(value, bool):
+        return TAG_BOOL + (b"\x01" if value else b"\x00")
+    if isinstance(value, (integer_types, float)):
+        return TAG_NUMBER + pack_number(value)
+    if isinstance(value, bson.ObjectId):
+        return TAG_OBJECTID + value.binary
+    if isinstance(value, datetime.datetime):
+        return TAG_DATE + pack_datetime(value)
+    if isinstance(value, RE_PATTERN_TYPE):
+        return (TAG_REGEX + pack_string(value.pattern)
+                + pack_string(re_int_flag_to_str(value.flags)))
+
+    if bson.bson_used:
+        if isinstance(value, bson.Decimal128):
+            return TAG_NUMBER + pack_number(value)
+        if isinstance(value, bson.Code):
+            if value.scope is None:
+                return TAG_CODE + pack_string(value)
+            return (TAG_CODE_W_SCOPE + pack_string(value)
+                    + _pack_object(value.scope))
+        if isinstance(value, bson.Binary):
+            return TAG_BINARY + pack_string(bytes(value)) + \
+                struct.pack(">B", value.subtype)
+        if isinstance(value, bson.Timestamp):
+            return TAG_TIMESTAMP + struct.pack(">II", value.time, value.inc)
+        if isinstance(value, bson.Regex):
+            return (TAG_REGEX + pack_string(value.pattern)
+                    + pack_string(re_int_flag_to_str(value.flags)))
+        if isinstance(value, bson.MinKey):
+            return TAG_MINKEY
+        if isinstance(value, bson.MaxKey):
+            return TAG_MAXKEY
+
+    if isinstance(value, string_types):
+        return TAG_STRING + pack_string(value)
+    if isinstance(value, bytes):
+        return TAG_BINARY + pack_string(value) + b"\x00"
+    if is_duckument_type(value):
+        return TAG_OBJECT + _pack_object(value)
+    if isinstance(value, (list, tuple)):
+        return TAG_ARRAY + _pack_array(value)
+
+    return TAG_OTHER + pack_string(bson.id_encode(value))
+
+
+def type_range(key):
+    """Return (lower, upper) bounds of keys that have the same type as `key`
+    """
+    tag = key[:1]
+    return tag, struct.pack(">B", ord(tag) + 1)
+
+
+def in_range(key, key_range):
+    """Return True if `key` is in half-open `key_range` (lower, upper)"""
+    lower, upper = key_range
+    return ((lower is None or key >= lower)
+            and (upper is None or key < upper))
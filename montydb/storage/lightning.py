@@ -1,21 +1,447 @@
 
 import os
+import json
 import lmdb
 import shutil
+import hashlib
+import threading
+import itertools
 from itertools import islice
-
-from ..types import unicode_, to_bytes, bson
+from contextlib import contextmanager
+from collections import OrderedDict
+
+from ..engine.field_walker import FieldWalker
+from ..errors import OperationFailure
+from ..types import (
+    unicode_,
+    to_bytes,
+    bson,
+    is_duckument_type,
+)
 from . import (
     AbstractStorage,
     AbstractDatabase,
     AbstractCollection,
     AbstractCursor,
 
+    StorageError,
     StorageDuplicateKeyError,
+    id_key_range,
+    keystring,
 )
 
 
 LMDB_DB_EXT = ".mdb"
+LMDB_LOCK_EXT = "-lock"
+LMDB_SCAN_BATCH = 1000
+LMDB_MAX_DBS = 67  # documents, meta, index list and 64 indexes
+LMDB_MAX_INDEXES = LMDB_MAX_DBS - 3
+LMDB_META_DB = to_bytes("meta")
+LMDB_KEY_FORMAT = to_bytes("key_format")
+LMDB_INDEX_FORMAT = to_bytes("index_format")
+LMDB_INDEX_DB = to_bytes("indexes")
+LMDB_INDEX_KEY_MAX = 480  # LMDB default max key size is 511 bytes
+
+
+"""Index keys are `keystring` encoded field values"""
+
+# Null is not looked up, an array of embedded documents that some of them
+# lack the field has no null entry, but matches null like missing field.
+_LOOKUP_TAGS = (
+    keystring.TAG_BOOL,
+    keystring.TAG_NUMBER,
+    keystring.TAG_STRING,
+    keystring.TAG_OBJECTID,
+    keystring.TAG_DATE,
+)
+
+_RANGE_TAGS = (
+    keystring.TAG_NUMBER,
+    keystring.TAG_STRING,
+    keystring.TAG_OBJECTID,
+    keystring.TAG_DATE,
+)
+
+_NAN_KEY = keystring.encode(float("nan"))
+
+
+def _lookup_key(value):
+    """Return index key of query `value`, or None if it can't be looked up
+    """
+    key = keystring.encode(value)
+    if key[:1] not in _LOOKUP_TAGS or key == _NAN_KEY:
+        return None
+    return key[:LMDB_INDEX_KEY_MAX]
+
+
+class LMDBIndex(object):
+    """Secondary index, which entries are stored in a named sub-database
+
+    Each document has at least one entry `(key, document key)`, key is the
+    concatenated `keystring` keys of all indexed fields, which is exact and
+    unambiguous since no key is a prefix of other key. Array elements are
+    indexed separately (multikey), null and missing field are indexed as
+    null. The sub-database is `dupsort`, so documents that have the same
+    key are stored as sorted duplicates.
+
+    """
+
+    def __init__(self, name, keys, unique=False):
+        self.name = name
+        self.keys = [(field, direction) for field, direction in keys]
+        self.unique = bool(unique)
+        self.dbname = to_bytes("index."
+                               + hashlib.md5(to_bytes(name)).hexdigest())
+
+    @classmethod
+    def from_json(cls, name, serialized):
+        data = json.loads(bytes(serialized).decode("utf-8"))
+        return cls(bytes(name).decode("utf-8"), data["keys"], data["unique"])
+
+    def to_json(self):
+        return to_bytes(json.dumps({"keys": self.keys,
+                                    "unique": self.unique}))
+
+    @property
+    def fields(self):
+        return [field for field, _ in self.keys]
+
+    @property
+    def document(self):
+        doc = {"v": 2, "key": OrderedDict(self.keys), "name": self.name}
+        if self.unique:
+            doc["unique"] = True
+        return doc
+
+    def entries(self, doc):
+        """Return full index keys of `doc`, may longer than key size limit
+        """
+        null = keystring.encode(None)
+        field_values = list()
+        for field in self.fields:
+            values = list()
+            fieldwalker = FieldWalker(doc)
+            for value in fieldwalker.go(field).get().value.iter_flat():
+                value = keystring.encode(value)
+                if value not in values:
+                    values.append(value)
+            field_values.append(values or [null])
+
+        return [b"".join(keys) for keys in itertools.product(*field_values)]
+
+
+def _indexed_conditions(spec, indexes):
+    """Yield (index, database, field spec) of fields that indexed first"""
+    for field, sub_spec in spec.items():
+        if field == "$and" and isinstance(sub_spec, (list, tuple)):
+            for sub in sub_spec:
+                if is_duckument_type(sub):
+                    for condition in _indexed_conditions(sub, indexes):
+                        yield condition
+            continue
+        if field[:1] == "$":
+            continue
+        for index, db in indexes:
+            if index.fields[0] == field:
+                yield index, db, sub_spec
+                break
+
+
+def _lookup_bounds(spec):
+    """Return a list of key bounds for each operator in field `spec`
+
+    Bounds of one operator are a list of (lower, upper, is_prefix) for
+    `_scan_bounds`, `$in` has one bound per value. Every operator gets its
+    own lookup, since multikey entries of one document may satisfy
+    different operators.
+
+    """
+    if not is_duckument_type(spec):
+        spec = {"$eq": spec}
+    elif not all(op[:1] == "$" for op in spec):
+        return []
+
+    bounds = list()
+    for op, value in spec.items():
+        if op == "$in" and isinstance(value, (list, tuple)):
+            keys = [_lookup_key(v) for v in value]
+            if None not in keys:
+                bounds.append([(key, None, True) for key in keys])
+            continue
+        if op not in ("$eq", "$gt", "$gte", "$lt", "$lte"):
+            continue
+        key = _lookup_key(value)
+        if key is None:
+            continue
+        if op == "$eq":
+            bounds.append([(key, None, True)])
+        elif key[:1] in _RANGE_TAGS:
+            # Non-strict bounds, in case of rounded numbers or truncated
+            # keys, and only in the same type like MongoDB does.
+            tag = key[:1]
+            if op in ("$gt", "$gte"):
+                bounds.append([(key, tag, False)])
+            else:
+                bounds.append([(tag, key, False)])
+    return bounds
+
+
+def _scan_bounds(cursor, bounds):
+    """Return document keys of index entries in `bounds`
+
+    Each bound is (lower, upper, is_prefix). If `is_prefix`, entries start
+    with `lower` are collected. Otherwise entries from `lower` to `upper`
+    are collected, `upper` is either a one byte type tag which the entries
+    should be in, or the inclusive key that entries stop after.
+
+    """
+    ids = set()
+    for lower, upper, is_prefix in bounds:
+        found = cursor.set_range(lower)
+        while found:
+            key = bytes(cursor.key())
+            if is_prefix:
+                if not key.startswith(lower):
+                    break
+            elif len(upper) == 1:
+                if key[:1] != upper:
+                    break
+            elif key[:len(upper)] > upper:
+                break
+            ids.add(bytes(cursor.value()))
+            found = cursor.next()
+    return ids
+
+
+def _upgrade(env, db):
+    """Re-key documents and rebuild index entries in old formats
+
+    Files that created before keys were encoded by `keystring` have no key
+    format in meta database, their documents are re-keyed. Files that have
+    no index format were indexed by rounded numbers, their index entries
+    are rebuilt. Both are done in one transaction, and the formats are
+    written, so is new file.
+
+    """
+    meta_db = env.open_db(LMDB_META_DB)
+    with env.begin(meta_db) as txn:
+        if txn.get(LMDB_INDEX_FORMAT) is not None:
+            return
+
+    index_list_db = env.open_db(LMDB_INDEX_DB)
+    with env.begin(index_list_db) as txn:
+        indexes = [LMDBIndex.from_json(name, value)
+                   for name, value in txn.cursor()]
+    index_dbs = [(index, env.open_db(index.dbname, dupsort=True))
+                 for index in indexes]
+
+    def rekey(txn):
+        items = [(bytes(k), bytes(v)) for k, v in txn.cursor(db=db)]
+        txn.drop(db, delete=False)
+        for old_key, encoded_doc in items:
+            doc = bson.document_decode(encoded_doc)
+            key = keystring.encode(doc["_id"])
+            if not txn.put(key, encoded_doc, overwrite=False, db=db):
+                # e.g. `1` and `1.0`, which were different keys before
+                raise StorageError("Documents that have equal `_id` found "
+                                   "in %s, could not be migrated." % env.path())
+        txn.put(LMDB_KEY_FORMAT, b"keystring", db=meta_db)
+
+    def reindex(txn):
+        for index, index_db in index_dbs:
+            txn.drop(index_db, delete=False)
+        for id, encoded_doc in txn.cursor(db=db):
+            id = bytes(id)
+            doc = bson.document_decode(encoded_doc)
+            for index, index_db in index_dbs:
+                for key in index.entries(doc):
+                    txn.put(key[:LMDB_INDEX_KEY_MAX], id,
+                            dupdata=False, db=index_db)
+        txn.put(LMDB_INDEX_FORMAT, b"keystring", db=meta_db)
+
+    def upgrade(txn):
+        if txn.get(LMDB_INDEX_FORMAT, db=meta_db) is not None:
+            return  # upgraded by other process
+        if txn.get(LMDB_KEY_FORMAT, db=meta_db) is None:
+            rekey(txn)
+        reindex(txn)
+
+    while True:
+        try:
+            with env.begin(db, write=True) as txn:
+                return upgrade(txn)
+        except lmdb.MapFullError:
+            # Not shared yet, no other transaction in this process.
+            env.set_mapsize(env.info()["map_size"] * 2)
+
+
+class LMDBIndexesChanged(Exception):
+    """Raise when indexes were created or dropped by other process"""
+
+
+class LMDBEnvironments(object):
+    """Registry of opened LMDB environments, keyed by file path
+
+    Opening an environment maps the file and reads the meta pages, and
+    LMDB does not allow one file being opened twice in the same process,
+    so each environment is opened once and shared by all readers and
+    writers until it's closed.
+
+    Map of an environment could only be resized while there's no
+    transaction in progress in this process, so transactions should be
+    began with `transaction` and map resized with `resize`.
+
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self._envs = dict()
+        self._indexes = dict()
+        self._users = dict()
+        self._resizing = set()
+        self._resize_counts = dict()
+        self._lock = threading.Condition()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """Drop environments that inherited from parent process
+
+        An environment must not be used in forked child process. Closing
+        it only releases child's own mapping and locks, and is required
+        before the same file could be opened again in this process.
+
+        """
+        if self._pid != os.getpid():
+            inherited = list(self._envs.values())
+            self._reset()
+            for env, _ in inherited:
+                env.close()
+
+    def open(self, path, options, dbname):
+        """Return cached (environment, database) of `path`, open if needed"""
+        self._check_fork()
+        with self._lock:
+            if path not in self._envs:
+                env = lmdb.open(path, **options)
+                db = env.open_db(dbname)
+                try:
+                    _upgrade(env, db)
+                except Exception:
+                    env.close()
+                    raise
+                self._envs[path] = (env, db)
+                self._load_indexes(path, env)
+            return self._envs[path]
+
+    def _load_indexes(self, path, env):
+        index_db = env.open_db(LMDB_INDEX_DB)
+        with env.begin(index_db) as txn:
+            indexes = [LMDBIndex.from_json(name, value)
+                       for name, value in txn.cursor()]
+        self._indexes[path] = (index_db, dict(
+            (index.name, (index, env.open_db(index.dbname, dupsort=True)))
+            for index in indexes
+        ))
+
+    def indexes(self, path):
+        """Return (index list database, {name: (index, database)})"""
+        with self._lock:
+            return self._indexes[path]
+
+    def reload_indexes(self, path, environment):
+        """Reload indexes of `path`, call it with no transaction in progress
+        """
+        env, _ = environment
+        with self._lock:
+            self._load_indexes(path, env)
+
+    @contextmanager
+    def transaction(self, path, environment, write=False, buffers=False):
+        """Begin a transaction that won't overlap with map resizing"""
+        env, db = environment
+        with self._lock:
+            while path in self._resizing:
+                self._lock.wait()
+            self._users[path] = self._users.get(path, 0) + 1
+        try:
+            with env.begin(db, write=write, buffers=buffers) as txn:
+                yield txn
+        finally:
+            with self._lock:
+                self._users[path] -= 1
+                self._lock.notify_all()
+
+    def resize(self, path, environment, map_size):
+        """Grow map of `path` to `map_size` once no transaction in progress
+
+        Args:
+            path (str): Collection file path.
+            environment (tuple): (environment, database) of `path`.
+            map_size (int): New map size, nothing changed if the map has
+                already grown to this size. If 0, adopt the size that set
+                by other process.
+
+        """
+        env, _ = environment
+        with self._lock:
+            if path in self._resizing:
+                # Resized by other thread, just wait for it.
+                while path in self._resizing:
+                    self._lock.wait()
+                return
+
+            self._resizing.add(path)
+            try:
+                while self._users.get(path):
+                    self._lock.wait()
+                if not map_size:
+                    env.set_mapsize(0)
+                elif env.info()["map_size"] < map_size:
+                    env.set_mapsize(map_size)
+                    self._resize_counts[path] = \
+                        self._resize_counts.get(path, 0) + 1
+            finally:
+                self._resizing.discard(path)
+                self._lock.notify_all()
+
+    def resize_count(self, dir_path):
+        """Return how many times the map grew for files under `dir_path`
+
+        Only counts the environments that are currently opened.
+
+        """
+        prefix = os.path.join(dir_path, "")
+        with self._lock:
+            return sum(count for path, count in self._resize_counts.items()
+                       if path.startswith(prefix))
+
+    def close(self, path):
+        self._check_fork()
+        with self._lock:
+            env, _ = self._envs.pop(path, (None, None))
+            self._indexes.pop(path, None)
+            self._resize_counts.pop(path, None)
+        if env is not None:
+            env.close()
+
+    def close_under(self, dir_path):
+        """Close all environments that opened from `dir_path`"""
+        self._check_fork()
+        prefix = os.path.join(dir_path, "")
+        with self._lock:
+            paths = [path for path in self._envs if path.startswith(prefix)]
+            envs = [self._envs.pop(path)[0] for path in paths]
+            for path in paths:
+                self._indexes.pop(path, None)
+            for path in paths:
+                self._resize_counts.pop(path, None)
+        for env in envs:
+            env.close()
+
+
+environments = LMDBEnvironments()
 
 
 class LMDBKVEngine(object):
@@ -23,66 +449,324 @@ class LMDBKVEngine(object):
 
     dbname = to_bytes("documents")
 
-    def __init__(self, options=None):
+    def __init__(self, path, options, max_map_size=0):
         """
+        Args:
+            path (str): Collection file path.
+            options (dict): Options for opening LMDB environment.
+            max_map_size (int): Ceiling of map growth, 0 for no limit.
+
         """
-        opt = options or dict()
+        self._path = path
+        self.opt = options
+        self.max_map_size = max_map_size
+
+    @classmethod
+    def env_options(cls, config):
+        opt = dict(config)
+        opt.pop("max_map_size", None)
         opt.update({
             "subdir": False,
-            "max_dbs": 1,
+            "max_dbs": LMDB_MAX_DBS,
         })
-        self.opt = opt
-        self._path = None
+        return opt
 
-    def set_path(self, path):
-        self._path = path
+    def open(self):
+        """Return cached (environment, database) of this collection"""
+        return environments.open(self._path, self.opt, self.dbname)
+
+    def _run(self, environment, work, write=False, buffers=False):
+        """Run `work(txn)` in a transaction and return its result
 
-    def open(self, readonly=None):
-        opt = self.opt.copy()
-        if readonly is not None:
-            opt["readonly"] = readonly
+        If the map is full, it will be grown geometrically until reaching
+        `max_map_size`, and the transaction is retried. `work` should not
+        have side effect other than the transaction.
 
-        return lmdb.open(self._path, **opt)
+        """
+        env, _ = environment
+        while True:
+            try:
+                with environments.transaction(self._path,
+                                              environment,
+                                              write=write,
+                                              buffers=buffers) as txn:
+                    return work(txn)
+
+            except lmdb.MapFullError:
+                map_size = env.info()["map_size"]
+                if self.max_map_size and map_size >= self.max_map_size:
+                    raise
+                map_size *= 2
+                if self.max_map_size:
+                    map_size = min(map_size, self.max_map_size)
+                environments.resize(self._path, environment, map_size)
+
+            except lmdb.MapResizedError:
+                environments.resize(self._path, environment, 0)
+
+            except LMDBIndexesChanged:
+                environments.reload_indexes(self._path, environment)
+
+    def _indexes(self, txn):
+        """Return opened indexes, make sure they are up to date in `txn`"""
+        index_db, indexes = environments.indexes(self._path)
+        names = [bytes(name).decode("utf-8") for name in
+                 txn.cursor(db=index_db).iternext(keys=True, values=False)]
+        if sorted(names) != sorted(indexes):
+            raise LMDBIndexesChanged()
+        return [index for index in indexes.values()]
+
+    def _has_duplicate(self, txn, index, db, id, key):
+        """Return True if other document has the same index `key`"""
+        cursor = txn.cursor(db=db)
+        if not cursor.set_key(key[:LMDB_INDEX_KEY_MAX]):
+            return False
+        for other_id in cursor.iternext_dup():
+            if other_id == id:
+                continue
+            if len(key) < LMDB_INDEX_KEY_MAX:
+                return True
+            # Key was truncated, compare with the full keys.
+            other = bson.document_decode(txn.get(other_id))
+            if key in index.entries(other):
+                return True
+        return False
+
+    def _index_doc(self, txn, indexes, id, doc, old_doc=None):
+        """Update index entries of one document
+
+        Return the name of violated unique index without changing anything,
+        or None if entries are updated.
+
+        """
+        entries = [index.entries(doc) if doc is not None else []
+                   for index, _ in indexes]
+        for (index, db), keys in zip(indexes, entries):
+            if index.unique:
+                for key in keys:
+                    if self._has_duplicate(txn, index, db, id, key):
+                        return index.name
+
+        for (index, db), keys in zip(indexes, entries):
+            if old_doc is not None:
+                for key in index.entries(old_doc):
+                    txn.delete(key[:LMDB_INDEX_KEY_MAX], id, db=db)
+            for key in keys:
+                txn.put(key[:LMDB_INDEX_KEY_MAX], id, dupdata=False, db=db)
+        return None
+
+    def iter_docs(self, decode, key_range=None, reverse=False):
+        """Iterate documents in batches of `LMDB_SCAN_BATCH`
+
+        Values are read as buffers that point into the memory map, and
+        decoded by `decode` before the read transaction ends, so no bytes
+        copy is made for each document. Read transaction is not kept open
+        between batches, so the map could be resized while documents are
+        being consumed.
+
+        Args:
+            decode (callable): Document decoder.
+            key_range (tuple): Optional half-open range (lower, upper) of
+                keys, either bound could be None.
+            reverse (bool): Iterate in descending key order.
 
-    def iter_docs(self):
+        """
         if not os.path.isfile(self._path):
             return
 
-        with self.open(readonly=True) as env:
-            db = env.open_db(self.dbname)
-            with env.begin(db, write=False) as txn:
-                cursor = txn.cursor()
-                for encoded_doc in cursor.iternext(keys=False, values=True):
-                    yield encoded_doc
+        environment = self.open()
+        lower, upper = key_range or (None, None)
+        next_key = [None]
+
+        def seek_forward(cursor):
+            if next_key[0] is not None:
+                return cursor.set_range(next_key[0])
+            if lower is not None:
+                return cursor.set_range(lower)
+            return cursor.first()
+
+        def seek_backward(cursor):
+            # Position at the last key that is not greater than the next
+            # key, or less than the upper bound.
+            key = next_key[0] if next_key[0] is not None else upper
+            if key is None:
+                return cursor.last()
+            if not cursor.set_range(key):
+                return cursor.last()
+            if next_key[0] is None or bytes(cursor.key()) != key:
+                return cursor.prev()
+            return True
+
+        def in_range(cursor):
+            if reverse:
+                return lower is None or bytes(cursor.key()) >= lower
+            return upper is None or bytes(cursor.key()) < upper
+
+        def read_batch(txn):
+            cursor = txn.cursor()
+            found = seek_backward(cursor) if reverse else seek_forward(cursor)
+            batch = []
+            while found and len(batch) < LMDB_SCAN_BATCH:
+                if not in_range(cursor):
+                    found = False
+                    break
+                batch.append(decode(cursor.value()))
+                found = cursor.prev() if reverse else cursor.next()
+            # Buffers are invalid once transaction ended, copy the key.
+            next_key[0] = bytes(cursor.key()) if found else None
+            return batch
+
+        while True:
+            batch = self._run(environment, read_batch, buffers=True)
+            for doc in batch:
+                yield doc
+            if next_key[0] is None:
+                return
+
+    def get_docs(self, ids, decode):
+        if not os.path.isfile(self._path):
+            return []
+
+        def read(txn):
+            encoded_docs = (txn.get(id) for id in ids)
+            return [decode(doc) for doc in encoded_docs if doc is not None]
+
+        return self._run(self.open(), read, buffers=True)
+
+    def write(self, environment, items, overwrite=False):
+        """Write documents and their index entries in one transaction
 
-    def write(self, environment, pairs, overwrite=False):
+        Args:
+            environment (tuple): (environment, database) of this collection.
+            items (iterable): (id, encoded document, document) triples.
+            overwrite (bool): Replace existing documents.
+
+        """
         if not os.path.isfile(self._path):
             return
 
-        dup = False
-        with environment as env:
-            db = env.open_db(self.dbname)
-            with env.begin(db, write=True) as txn:
-                for doc_id, encoded_doc in pairs:
-                    id = bson.id_encode(doc_id)
-                    if not txn.put(id, encoded_doc, overwrite=overwrite):
-                        dup = True
-                        break
-        if dup:
-            raise StorageDuplicateKeyError()
+        items = iter(items)
+        consumed = []
+
+        def replay():
+            # Items may come from a generator, keep them for retrying.
+            for item in list(consumed):
+                yield item
+            for item in items:
+                consumed.append(item)
+                yield item
+
+        def put(txn):
+            indexes = self._indexes(txn)
+            for doc_id, encoded_doc, doc in replay():
+                id = keystring.encode(doc_id)
+                old = txn.get(id)
+                if old is not None and not overwrite:
+                    return "_id_"
+                if indexes:
+                    if old is not None:
+                        old = bson.document_decode(old)
+                    violated = self._index_doc(txn, indexes, id, doc, old)
+                    if violated is not None:
+                        return violated
+                txn.put(id, encoded_doc)
+            return None
+
+        violated = self._run(environment, put, write=True)
+        if violated is not None:
+            raise StorageDuplicateKeyError(violated)
 
     def delete(self, environment, doc_ids):
         if not os.path.isfile(self._path):
             return
 
-        with environment as env:
-            db = env.open_db(self.dbname, reverse_key=False)
-            with env.begin(db, write=True) as txn:
-                cursor = txn.cursor()
-                for doc_id in doc_ids:
-                    id = bson.id_encode(doc_id)
-                    if cursor.set_key(id):
-                        cursor.delete()
+        doc_ids = list(doc_ids)
+
+        def remove(txn):
+            indexes = self._indexes(txn)
+            for doc_id in doc_ids:
+                id = keystring.encode(doc_id)
+                old = txn.get(id)
+                if old is None:
+                    continue
+                if indexes:
+                    old = bson.document_decode(old)
+                    self._index_doc(txn, indexes, id, None, old)
+                txn.delete(id)
+
+        self._run(environment, remove, write=True)
+
+    def list_indexes(self):
+        if not os.path.isfile(self._path):
+            return []
+        return self._run(self.open(), self._indexes)
+
+    def create_index(self, index):
+        """Create secondary `index` and index all existing documents"""
+        environment = self.open()
+        env, doc_db = environment
+        # Open (create) the sub-database outside of the build transaction,
+        # so the handle is still valid after the transaction ended.
+        db = env.open_db(index.dbname, dupsort=True)
+        index_db, _ = environments.indexes(self._path)
+
+        def build(txn):
+            for id, encoded_doc in txn.cursor(db=doc_db):
+                id = bytes(id)
+                doc = bson.document_decode(encoded_doc)
+                if self._index_doc(txn, [(index, db)], id, doc) is not None:
+                    return False
+            txn.put(to_bytes(index.name), index.to_json(), db=index_db)
+            return True
+
+        try:
+            if not self._run(environment, build, write=True):
+                self._run(environment,
+                          lambda txn: txn.drop(db, delete=True),
+                          write=True)
+                raise StorageDuplicateKeyError(index.name)
+        finally:
+            environments.reload_indexes(self._path, environment)
+
+    def drop_index(self, name):
+        environment = self.open()
+        index_db, _ = environments.indexes(self._path)
+
+        def drop(txn):
+            for index, db in self._indexes(txn):
+                if index.name == name:
+                    txn.drop(db, delete=True)
+                    txn.delete(to_bytes(name), db=index_db)
+
+        self._run(environment, drop, write=True)
+        environments.reload_indexes(self._path, environment)
+
+    def index_lookup(self, spec):
+        """Return sorted document keys that may match `spec` from indexes
+
+        Equality, `$in` and range comparisons on the first field of index
+        are looked up with cursor `set_range` seeks. Return None if none of
+        them could be used.
+
+        """
+        if not spec or not os.path.isfile(self._path):
+            return None
+
+        def lookup(txn):
+            indexes = self._indexes(txn)
+            if not indexes:
+                return None
+            found = None
+            for index, db, field_spec in _indexed_conditions(spec, indexes):
+                for bounds in _lookup_bounds(field_spec):
+                    ids = _scan_bounds(txn.cursor(db=db), bounds)
+                    found = ids if found is None else found & ids
+            return None if found is None else sorted(found)
+
+        return self._run(self.open(), lookup)
+
+    def close(self):
+        environments.close(self._path)
 
 
 class LMDBStorage(AbstractStorage):
@@ -91,7 +775,7 @@ class LMDBStorage(AbstractStorage):
 
     def __init__(self, repository, storage_config):
         super(LMDBStorage, self).__init__(repository, storage_config)
-        self._conn = LMDBKVEngine(self._config)
+        self._env_options = LMDBKVEngine.env_options(self._config)
 
     def _db_path(self, db_name):
         """
@@ -104,19 +788,35 @@ class LMDBStorage(AbstractStorage):
         return "lightning"
 
     @classmethod
-    def config(cls, map_size=10485760, **kwargs):
+    def config(cls, map_size=10485760, max_map_size=0, **kwargs):
         """
         """
         return {
             "map_size": int(map_size),
+            "max_map_size": int(max_map_size),
         }
 
+    @property
+    def map_resize_count(self):
+        """How many times opened collection maps grew in this process"""
+        return environments.resize_count(self._repository)
+
     def database_create(self, db_name):
-        if not os.path.isdir(self._db_path(db_name)):
-            os.makedirs(self._db_path(db_name))
+        db_path = self._db_path(db_name)
+        try:
+            os.makedirs(db_path)
+        except OSError:
+            # Could be created by other thread
+            if not os.path.isdir(db_path):
+                raise
+
+    def close(self):
+        environments.close_under(self._repository)
+        super(LMDBStorage, self).close()
 
     def database_drop(self, db_name):
         db_path = self._db_path(db_name)
+        environments.close_under(db_path)
         if os.path.isdir(db_path):
             shutil.rmtree(db_path)
 
@@ -134,7 +834,6 @@ class LMDBDatabase(AbstractDatabase):
     def __init__(self, storage, subject):
         super(LMDBDatabase, self).__init__(storage, subject)
         self._db_path = storage._db_path(self._name)
-        self._conn = storage._conn
 
     def _col_path(self, col_name):
         """
@@ -148,17 +847,25 @@ class LMDBDatabase(AbstractDatabase):
     def collection_exists(self, col_name):
         return os.path.isfile(self._col_path(col_name))
 
+    def _col_conn(self, col_name):
+        return LMDBKVEngine(self._col_path(col_name),
+                            self._storage._env_options,
+                            self._storage._config["max_map_size"])
+
     def collection_create(self, col_name):
         if not self.database_exists():
             self._storage.database_create(self._name)
-        self._conn.set_path(self._col_path(col_name))
-        environment = self._conn.open()
+        environment = self._col_conn(col_name).open()
 
         return environment
 
     def collection_drop(self, col_name):
+        col_path = self._col_path(col_name)
+        self._col_conn(col_name).close()
         if self.collection_exists(col_name):
-            os.remove(self._col_path(col_name))
+            os.remove(col_path)
+        if os.path.isfile(col_path + LMDB_LOCK_EXT):
+            os.remove(col_path + LMDB_LOCK_EXT)
 
     def collection_list(self):
         if not self.database_exists():
@@ -177,8 +884,7 @@ class LMDBCollection(AbstractCollection):
 
     def __init__(self, database, subject):
         super(LMDBCollection, self).__init__(database, subject)
-        self._conn = database._conn
-        self._conn.set_path(database._col_path(self._name))
+        self._conn = database._col_conn(self._name)
 
     def _ensure_table(func):
         def make_table(self, *args, **kwargs):
@@ -194,7 +900,7 @@ class LMDBCollection(AbstractCollection):
 
         id = doc["_id"]
         encoded = self._encode_doc(doc, check_keys)
-        self._conn.write(env, [(id, encoded)])
+        self._conn.write(env, [(id, encoded, doc)])
 
         return id
 
@@ -206,7 +912,7 @@ class LMDBCollection(AbstractCollection):
         def produce_encoded_docs():
             for doc in docs:
                 id = doc["_id"]
-                yield id, self._encode_doc(doc, check_keys)
+                yield id, self._encode_doc(doc, check_keys), doc
                 ids.append(id)
 
         self._conn.write(env, produce_encoded_docs())
@@ -218,14 +924,14 @@ class LMDBCollection(AbstractCollection):
 
         id = doc["_id"]
         encoded = self._encode_doc(doc)
-        self._conn.write(env, [(id, encoded)], overwrite=True)
+        self._conn.write(env, [(id, encoded, doc)], overwrite=True)
 
     def update_many(self, docs):
         env = self._conn.open()
 
         def produce_encoded_docs():
             for doc in docs:
-                yield doc["_id"], self._encode_doc(doc)
+                yield doc["_id"], self._encode_doc(doc), doc
 
         self._conn.write(env, produce_encoded_docs(), overwrite=True)
 
@@ -237,6 +943,32 @@ class LMDBCollection(AbstractCollection):
         env = self._conn.open()
         self._conn.delete(env, ids)
 
+    def list_indexes(self):
+        return [index.document for index, _ in self._conn.list_indexes()]
+
+    @_ensure_table
+    def create_index(self, name, keys, unique=False, env=None):
+        """Create secondary index and index existing documents
+
+        Args:
+            name (str): Index name.
+            keys (list): List of (field, direction) pairs.
+            unique (bool): Reject documents that have duplicated keys.
+
+        """
+        if len(self._conn.list_indexes()) >= LMDB_MAX_INDEXES:
+            raise OperationFailure(
+                "add index fails, too many indexes for %s, lightning storage "
+                "supports at most %d secondary indexes per collection"
+                % (self._name, LMDB_MAX_INDEXES),
+                code=67,
+            )
+        self._conn.create_index(LMDBIndex(name, keys, unique))
+
+    def drop_index(self, name):
+        if self._database.collection_exists(self._name):
+            self._conn.drop_index(name)
+
 
 LMDBDatabase.contractor_cls = LMDBCollection
 
@@ -248,14 +980,31 @@ class LMDBCursor(AbstractCursor):
     def __init__(self, collection, subject):
         super(LMDBCursor, self).__init__(collection, subject)
         self._conn = self._collection._conn
+        self._spec = subject._spec
 
     def query(self, max_scan):
-        docs = (self._decode_doc(doc) for doc in self._conn.iter_docs())
-
-        if not max_scan:
-            return docs
-        else:
+        # Documents scanned should not be reduced when `max_scan` is set.
+        if max_scan:
+            docs = self._conn.iter_docs(self._decode_doc)
             return islice(docs, max_scan)
+        return self.query_ordered()
+
+    def query_ids(self, keys):
+        return self._conn.get_docs(keys, self._decode_doc)
+
+    def query_ordered(self, reverse=False):
+        key_range = id_key_range(self._spec)
+        keys = self._conn.index_lookup(self._spec)
+        if keys is not None:
+            # Document keys from index lookup are sorted
+            if key_range is not None:
+                keys = [key for key in keys
+                        if keystring.in_range(key, key_range)]
+            if reverse:
+                keys.reverse()
+            return self._conn.get_docs(keys, self._decode_doc)
+
+        return self._conn.iter_docs(self._decode_doc, key_range, reverse)
 
 
 LMDBCollection.contractor_cls = LMDBCursor
@@ -1,26 +1,125 @@
 
+import os
+import time
+import struct
+import tempfile
 from itertools import islice
 from collections import OrderedDict
 
-from ..types import bson
+from ..types import bson, text_type, copy_document
 from . import (
     AbstractStorage,
     AbstractDatabase,
     AbstractCollection,
     AbstractCursor,
 
+    StorageError,
     StorageDuplicateKeyError,
+    id_key_range,
+    keystring,
 )
 
 
 _repo = OrderedDict()
 _config = {"_": {}}
+# Eviction states of bounded collections, by (db name, collection name)
+_bounds = dict()
+
+_clock = getattr(time, "monotonic", time.time)
+# Not in Python 2, where `os.rename` replaces existing file on POSIX
+_replace = getattr(os, "replace", os.rename)
+
+MEMORY_SNAPSHOT_MAGIC = b"MONTYSNAP"
+MEMORY_SNAPSHOT_VERSION = 1
+
+# Snapshot records, a tag byte followed by big-endian lengths and payloads
+_SNAP_DATABASE = b"D"
+_SNAP_COLLECTION = b"C"
+_SNAP_DOCUMENT = b"R"
+_SNAP_NAME = struct.Struct(">I")
+_SNAP_RECORD = struct.Struct(">II")
 
 
 def is_memory_storage_set():
     return bool(_config["_"])
 
 
+class MemoryBounds(object):
+    """Eviction state of a bounded collection
+
+    Keys are kept in two orders, by the time of last write for expiring,
+    and by the time of last use for evicting least recently used ones.
+
+    Args:
+        docs (OrderedDict): Stored documents of the collection.
+        config (dict): Storage config that has the bounds.
+
+    """
+
+    def __init__(self, docs, config):
+        self.docs = docs
+        self.max_documents = config["max_documents"]
+        self.max_bytes = config["max_bytes"]
+        self.expire_after = config["expire_after_seconds"]
+
+        now = _clock()
+        self.written = OrderedDict((key, now) for key in docs)
+        self.used = OrderedDict()
+        for key, doc in docs.items():
+            if not isinstance(doc, (bytes, text_type)):
+                doc = bson.document_encode(doc)
+            self.used[key] = len(doc)
+        self.size = sum(self.used.values())
+
+    def put(self, key, doc, size):
+        """Store document and mark it as just written and used"""
+        self.docs[key] = doc
+        self.written.pop(key, None)
+        self.written[key] = _clock()
+        self.size += size - self.used.pop(key, 0)
+        self.used[key] = size
+
+    def touch(self, key):
+        if key in self.used:
+            self.used[key] = self.used.pop(key)
+
+    def remove(self, key):
+        del self.docs[key]
+        del self.written[key]
+        self.size -= self.used.pop(key)
+
+    def expire(self):
+        """Remove documents that were written too long ago"""
+        if not self.expire_after:
+            return
+        deadline = _clock() - self.expire_after
+        while self.written:
+            key, written = next(iter(self.written.items()))
+            if written > deadline:
+                break
+            self.remove(key)
+
+    def evict(self, keep=None):
+        """Remove expired, then least recently used documents over bounds
+
+        Args:
+            keep: Key that should not be evicted, e.g. just written.
+
+        """
+        self.expire()
+        while self.used and (
+            (self.max_documents and len(self.docs) > self.max_documents)
+            or (self.max_bytes and self.size > self.max_bytes)
+        ):
+            key = next(iter(self.used))
+            if key == keep:
+                if len(self.used) == 1:
+                    break
+                self.touch(key)
+                continue
+            self.remove(key)
+
+
 class MemoryStorage(AbstractStorage):
     """
     """
@@ -28,15 +127,43 @@ class MemoryStorage(AbstractStorage):
     def __init__(self, repository, storage_config):
         super(MemoryStorage, self).__init__(repository, storage_config)
         self._repo = _repo
+        self.shares_documents = storage_config.get("decoded", False)
 
     @classmethod
     def nice_name(cls):
         return "memory"
 
     @classmethod
-    def config(cls, **storage_kwargs):
+    def config(cls, decoded=False, max_documents=0, max_bytes=0,
+               expire_after_seconds=0, **storage_kwargs):
+        """
+
+        Args:
+            decoded (bool): Keep documents decoded, so they are filtered
+                without decoding, and copied only when returned to user.
+                Default False
+            max_documents (int): Max documents of each collection, least
+                recently used ones are evicted on write. 0 means no limit.
+                Default 0
+            max_bytes (int): Max encoded size of documents of each
+                collection. 0 means no limit. Default 0
+            expire_after_seconds (float): Remove documents that were not
+                written for this long. 0 means never. Default 0
+
+        """
+        storage_kwargs["decoded"] = bool(decoded)
+        storage_kwargs["max_documents"] = int(max_documents)
+        storage_kwargs["max_bytes"] = int(max_bytes)
+        storage_kwargs["expire_after_seconds"] = float(expire_after_seconds)
         return storage_kwargs
 
+    @property
+    def is_bounded(self):
+        config = self._config
+        return bool(config.get("max_documents")
+                    or config.get("max_bytes")
+                    or config.get("expire_after_seconds"))
+
     @classmethod
     def save_config(cls, repository, **storage_kwargs):
         _config["_"] = storage_kwargs
@@ -51,11 +178,120 @@ class MemoryStorage(AbstractStorage):
         # Return an instance
         return cls(repository, storage_config)
 
+    def save_snapshot(self, path):
+        """Write all databases in memory into a snapshot file
+
+        Documents are written as encoded, one length-prefixed record after
+        another, so they could be loaded back without parsing. The file is
+        written to a temporary file next to it first, then renamed over,
+        so an existing snapshot is not left half written.
+
+        Args:
+            path (str): Snapshot file path.
+
+        """
+        def name_record(tag, name):
+            name = name.encode("utf-8")
+            return tag + _SNAP_NAME.pack(len(name)) + name
+
+        header = MEMORY_SNAPSHOT_MAGIC + struct.pack(
+            ">BB", MEMORY_SNAPSHOT_VERSION, bool(bson.bson_used))
+
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=os.path.basename(path) + ".",
+            suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(header)
+                for db_name, database in self._repo.items():
+                    fp.write(name_record(_SNAP_DATABASE, db_name))
+                    for col_name, collection in database.items():
+                        fp.write(name_record(_SNAP_COLLECTION, col_name))
+                        for key, doc in collection.items():
+                            if not isinstance(doc, bytes):
+                                doc = bson.document_encode(doc)
+                            fp.write(_SNAP_DOCUMENT
+                                     + _SNAP_RECORD.pack(len(key), len(doc))
+                                     + key + doc)
+            _replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def load_snapshot(self, path):
+        """Replace all databases in memory with the ones in snapshot file
+
+        The file is read at once and documents are sliced out of it. If
+        the storage keeps documents decoded, they are decoded while loading.
+
+        Args:
+            path (str): Snapshot file path written by `save_snapshot`.
+
+        """
+        with open(path, "rb") as fp:
+            data = fp.read()
+
+        magic_end = len(MEMORY_SNAPSHOT_MAGIC)
+        if (data[:magic_end] != MEMORY_SNAPSHOT_MAGIC
+                or len(data) < magic_end + 2):
+            raise StorageError("%s is not a memory storage snapshot." % path)
+        version, bson_used = struct.unpack_from(">BB", data, magic_end)
+        if version != MEMORY_SNAPSHOT_VERSION:
+            raise StorageError("Unsupported snapshot version %d." % version)
+        if bool(bson_used) != bool(bson.bson_used):
+            raise StorageError("Snapshot %s was saved %s BSON." % (
+                path, "with" if bson_used else "without"))
+
+        decoded = self.shares_documents
+        repo = OrderedDict()
+        database = collection = None
+        view = memoryview(data)
+        offset = magic_end + 2
+        try:
+            while offset < len(data):
+                tag = data[offset:offset + 1]
+                offset += 1
+                if tag == _SNAP_DOCUMENT:
+                    key_len, doc_len = _SNAP_RECORD.unpack_from(data, offset)
+                    offset += _SNAP_RECORD.size
+                    key = data[offset:offset + key_len]
+                    offset += key_len
+                    doc = view[offset:offset + doc_len]
+                    offset += doc_len
+                    if len(doc) != doc_len:
+                        raise struct.error("Truncated document.")
+                    if decoded:
+                        doc = bson.document_decode(doc)
+                    else:
+                        doc = doc.tobytes()
+                    collection[key] = doc
+                    continue
+
+                name_len, = _SNAP_NAME.unpack_from(data, offset)
+                offset += _SNAP_NAME.size
+                name = data[offset:offset + name_len].decode("utf-8")
+                offset += name_len
+                if tag == _SNAP_DATABASE:
+                    database = repo[name] = OrderedDict()
+                elif tag == _SNAP_COLLECTION:
+                    collection = database[name] = OrderedDict()
+                else:
+                    raise struct.error("Unknown record.")
+        except (struct.error, TypeError, UnicodeDecodeError):
+            raise StorageError("Snapshot %s is corrupted." % path)
+
+        self._repo.clear()
+        self._repo.update(repo)
+        _bounds.clear()
+
     def database_create(self, db_name):
         self._repo[db_name] = OrderedDict()
 
     def database_drop(self, db_name):
         if db_name in self._repo:
+            for col_name in self._repo[db_name]:
+                _bounds.pop((db_name, col_name), None)
             del self._repo[db_name]
 
     def database_list(self):
@@ -85,6 +321,7 @@ class MemoryDatabase(AbstractDatabase):
 
     def collection_drop(self, col_name):
         if self.collection_exists(col_name):
+            _bounds.pop((self._name, col_name), None)
             del self._db[col_name]
 
     def collection_list(self):
@@ -109,40 +346,90 @@ class MemoryCollection(AbstractCollection):
     def _col_exists(self):
         return self._database.collection_exists(self._name)
 
+    @property
+    def _bounds(self):
+        """Return eviction state if the storage is bounded, or None"""
+        storage = self._database._storage
+        if not storage.is_bounded:
+            return None
+        col = self._col
+        name = (self._database._name, self._name)
+        bounds = _bounds.get(name)
+        if bounds is None or bounds.docs is not col:
+            bounds = _bounds[name] = MemoryBounds(col, storage._config)
+        return bounds
+
     def _id_unique(self, id):
         if id in self._col:
             raise StorageDuplicateKeyError()
 
+    def _put(self, bounds, b_id, doc, check_keys=False):
+        stored = self._encode_doc(doc, check_keys)
+        size = len(stored)
+        if self._database._storage.shares_documents:
+            # Decode the encoded one, so the stored document is validated,
+            # has no reference to user's, and is in the same types as the
+            # encoded ones, e.g. datetime in milliseconds.
+            stored = bson.document_decode(stored, codec_options=self.coptions)
+        if bounds is None:
+            self._col[b_id] = stored
+        else:
+            bounds.put(b_id, stored, size)
+
     def write_one(self, doc, check_keys=True):
         _id = doc["_id"]
-        b_id = bson.id_encode(_id)
+        b_id = keystring.encode(_id)
         self._id_unique(b_id)
-        self._col[b_id] = self._encode_doc(doc, check_keys)
+        bounds = self._bounds
+        self._put(bounds, b_id, doc, check_keys)
+        if bounds is not None:
+            bounds.evict(keep=b_id)
         return _id
 
     def write_many(self, docs, check_keys=True, ordered=True):
         ids = list()
+        bounds = self._bounds
         for doc in docs:
             _id = doc["_id"]
-            b_id = bson.id_encode(_id)
+            b_id = keystring.encode(_id)
             self._id_unique(b_id)
-            self._col[b_id] = self._encode_doc(doc, check_keys)
+            self._put(bounds, b_id, doc, check_keys)
+            if bounds is not None:
+                bounds.evict(keep=b_id)
             ids.append(_id)
         return ids
 
     def update_one(self, doc):
-        self._col[bson.id_encode(doc["_id"])] = self._encode_doc(doc)
+        b_id = keystring.encode(doc["_id"])
+        bounds = self._bounds
+        self._put(bounds, b_id, doc)
+        if bounds is not None:
+            bounds.evict(keep=b_id)
 
     def update_many(self, docs):
+        bounds = self._bounds
+        b_id = None
         for doc in docs:
-            self._col[bson.id_encode(doc["_id"])] = self._encode_doc(doc)
+            b_id = keystring.encode(doc["_id"])
+            self._put(bounds, b_id, doc)
+        if bounds is not None:
+            # Evict after all updated, `docs` may be scanning the collection
+            bounds.evict(keep=b_id)
 
     def delete_one(self, id):
-        del self._col[bson.id_encode(id)]
+        bounds = self._bounds
+        if bounds is None:
+            del self._col[keystring.encode(id)]
+        else:
+            bounds.remove(keystring.encode(id))
 
     def delete_many(self, ids):
+        bounds = self._bounds
         for id in ids:
-            del self._col[bson.id_encode(id)]
+            if bounds is None:
+                del self._col[keystring.encode(id)]
+            else:
+                bounds.remove(keystring.encode(id))
 
 
 MemoryDatabase.contractor_cls = MemoryCollection
@@ -152,18 +439,60 @@ class MemoryCursor(AbstractCursor):
     """
     """
 
+    def __init__(self, collection, subject):
+        super(MemoryCursor, self).__init__(collection, subject)
+        self._key_range = id_key_range(subject._spec)
+
     @property
     def _col(self):
         if self._collection._col_exists():
+            bounds = self._collection._bounds
+            if bounds is not None:
+                bounds.expire()
             return self._collection._col
         return OrderedDict()
 
+    def _decode_doc(self, doc):
+        """Decode stored document, or return it if stored decoded
+
+        Documents stored with the other `decoded` setting in this process
+        could also be read.
+
+        """
+        if isinstance(doc, (bytes, text_type)):
+            return super(MemoryCursor, self)._decode_doc(doc)
+        if self._collection._database._storage.shares_documents:
+            return doc
+        return copy_document(doc)
+
     def query(self, max_scan):
-        docs = (self._decode_doc(doc) for doc in self._col.values())
+        if self._key_range is None or max_scan:
+            docs = (self._decode_doc(doc) for doc in self._col.values())
+        else:
+            docs = (self._decode_doc(doc) for key, doc in self._col.items()
+                    if keystring.in_range(key, self._key_range))
         if not max_scan:
             return docs
         else:
             return islice(docs, max_scan)
 
+    def query_ids(self, keys):
+        col = self._col
+        docs = [self._decode_doc(col[key]) for key in keys if key in col]
+        bounds = self._collection._bounds
+        if bounds is not None:
+            # Only looked up documents are taken as used, not scanned ones
+            for key in keys:
+                bounds.touch(key)
+        return docs
+
+    def query_ordered(self, reverse=False):
+        col = self._col
+        keys = sorted(col, reverse=reverse)
+        if self._key_range is not None:
+            keys = [key for key in keys
+                    if keystring.in_range(key, self._key_range)]
+        return (self._decode_doc(col[key]) for key in keys if key in col)
+
 
 MemoryCollection.contractor_cls = MemoryCursor
@@ -0,0 +1,490 @@
+import os
+import zlib
+import heapq
+import threading
+from collections import defaultdict
+from functools import partial
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
+
+from ..configure import find_storage_cls
+from . import (
+    AbstractStorage,
+    AbstractDatabase,
+    AbstractCollection,
+    AbstractCursor,
+
+    StorageError,
+    StorageDuplicateKeyError,
+    keystring,
+)
+
+
+PARTITIONED_ENGINES = ("sqlite", "lightning")
+
+PARTITION_DIR_PREFIX = "partition-"
+
+# Documents of `insert_many` are routed to partitions in batches of this size
+PARTITIONED_WRITE_BATCH = 1000
+# Documents are pulled from each partition's scan in chunks of this size
+PARTITIONED_SCAN_BATCH = 1000
+
+
+def partition_of(key, count):
+    """Return the partition index of encoded `_id` `key`"""
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def _union(lists):
+    """Merge lists of names into one, keep the order they first appeared"""
+    merged = list()
+    seen = set()
+    for names in lists:
+        for name in names:
+            if name not in seen:
+                seen.add(name)
+                merged.append(name)
+    return merged
+
+
+class _Descending(object):
+    """Invert the order of key, for merging streams in reverse"""
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return self.key > other.key
+
+
+def merge_ordered(streams, reverse=False):
+    """Merge documents from `streams` which each sorted by `_id` key
+
+    Streams are consumed lazily, one document ahead per stream, so the
+    merged result could be stopped early like a single ordered stream.
+
+    """
+    def sort_key(doc):
+        key = keystring.encode(doc["_id"])
+        return _Descending(key) if reverse else key
+
+    heap = list()
+    for i, stream in enumerate(streams):
+        stream = iter(stream)
+        for doc in stream:
+            # Keys are unique across partitions, `i` breaks no ties but
+            # keeps documents from being compared.
+            heap.append((sort_key(doc), i, doc, stream))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, i, doc, stream = heap[0]
+        yield doc
+        for doc in stream:
+            heapq.heapreplace(heap, (sort_key(doc), i, doc, stream))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class PartitionedStorage(AbstractStorage):
+    """Storage that hash-partitions collections by `_id`
+
+    Each partition is an instance of the underlying storage engine, which
+    lives in its own sub-directory of the repository. Documents are
+    routed by the encoded `_id` key, and queries are fanned out across
+    partitions in worker threads.
+
+    """
+
+    def __init__(self, repository, storage_config):
+        super(PartitionedStorage, self).__init__(repository, storage_config)
+        engine_config = self._config.copy()
+        engine_cls = find_storage_cls(engine_config.pop("engine"))
+        count = engine_config.pop("partitions")
+        self._workers = engine_config.pop("workers") or count
+
+        existing = self._existing_partitions()
+        if existing and existing != count:
+            raise StorageError("Repository %r has %d partitions, could not be "
+                               "opened with %d." % (repository,
+                                                    existing,
+                                                    count))
+
+        self._partitions = list()
+        for i in range(count):
+            partition_path = self._partition_path(i)
+            if not os.path.isdir(partition_path):
+                os.makedirs(partition_path)
+            self._partitions.append(
+                engine_cls(partition_path, engine_cls.config(**engine_config))
+            )
+
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pool_pid = None
+
+    def _partition_path(self, index):
+        return os.path.join(self._repository,
+                            PARTITION_DIR_PREFIX + str(index))
+
+    def _existing_partitions(self):
+        if not os.path.isdir(self._repository):
+            return 0
+        return len([
+            name for name in os.listdir(self._repository)
+            if name.startswith(PARTITION_DIR_PREFIX)
+            and os.path.isdir(os.path.join(self._repository, name))
+        ])
+
+    def _get_pool(self):
+        """Return the thread pool for fanning out, or None if not needed"""
+        if self._workers < 2 or len(self._partitions) < 2:
+            return None
+        with self._lock:
+            # Worker threads are not copied into forked process
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ThreadPool(min(self._workers,
+                                            len(self._partitions)))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def _prefetch(self, produce):
+        """Stream documents of `produce()`, pulled in worker threads
+
+        The stream is opened and its first chunk is pulled right away, and
+        each following chunk is pulled while the one before is consumed,
+        so at most two chunks of `PARTITIONED_SCAN_BATCH` documents of one
+        stream are held at a time.
+
+        """
+        pool = self._get_pool()
+        if pool is None:
+            return produce()
+
+        streams = list()
+
+        def pull():
+            if not streams:
+                streams.append(iter(produce()))
+            return list(islice(streams[0], PARTITIONED_SCAN_BATCH))
+
+        def consume(pending):
+            while True:
+                chunk = pending.get()
+                if len(chunk) < PARTITIONED_SCAN_BATCH:
+                    for doc in chunk:
+                        yield doc
+                    return
+                pending = self._get_pool().apply_async(pull)
+                for doc in chunk:
+                    yield doc
+
+        return consume(pool.apply_async(pull))
+
+    @classmethod
+    def nice_name(cls):
+        return "partitioned"
+
+    @classmethod
+    def config(cls, engine="sqlite", partitions=4, workers=0, **kwargs):
+        """
+
+        Args:
+            engine (str): Default "sqlite"
+                Storage engine of each partition, "sqlite" or "lightning".
+                Other keyword arguments are passed to that engine's config.
+
+            partitions (int): Default 4
+                Number of partitions that documents are hashed into by
+                `_id`. Should not be changed once the repository has data.
+
+            workers (int): Default 0
+                Threads used to query partitions concurrently, 0 for one
+                thread per partition, 1 for querying them one by one.
+
+        """
+        if engine not in PARTITIONED_ENGINES:
+            raise ValueError("Partitioned storage engine should be one of "
+                             "%s, got %r." % (PARTITIONED_ENGINES, engine))
+
+        partitions = int(partitions)
+        if partitions < 1:
+            raise ValueError("Partitions should be at least 1, got %d."
+                             % partitions)
+        workers = int(workers)
+        if workers < 0:
+            raise ValueError("Workers should not be negative, got %d."
+                             % workers)
+
+        config = find_storage_cls(engine).config(**kwargs)
+        config.update({
+            "engine": engine,
+            "partitions": partitions,
+            "workers": workers,
+        })
+
+        return config
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None and self._pool_pid == os.getpid():
+            # Running queries are finished before workers exit
+            pool.close()
+        for partition in self._partitions:
+            partition.close()
+        super(PartitionedStorage, self).close()
+
+    def wconcern_parser(self, **client_kwargs):
+        return self._partitions[0].wconcern_parser(**client_kwargs)
+
+    def database_create(self, db_name):
+        for partition in self._partitions:
+            partition.database_create(db_name)
+
+    def database_drop(self, db_name):
+        for partition in self._partitions:
+            partition.database_drop(db_name)
+
+    def database_list(self):
+        return _union(partition.database_list()
+                      for partition in self._partitions)
+
+
+class PartitionedDatabase(AbstractDatabase):
+
+    def __init__(self, storage, subject):
+        super(PartitionedDatabase, self).__init__(storage, subject)
+        self._subject = subject
+
+    @property
+    def _partitions(self):
+        return self._storage._partitions
+
+    def collection_exists(self, col_name):
+        return any(partition.collection_exists(self._subject, col_name)
+                   for partition in self._partitions)
+
+    def collection_create(self, col_name):
+        for partition in self._partitions:
+            partition.collection_create(self._subject, col_name)
+
+    def collection_drop(self, col_name):
+        for partition in self._partitions:
+            partition.collection_drop(self._subject, col_name)
+
+    def collection_list(self):
+        return _union(partition.collection_list(self._subject)
+                      for partition in self._partitions)
+
+
+PartitionedStorage.contractor_cls = PartitionedDatabase
+
+
+class PartitionedCollection(AbstractCollection):
+
+    def __init__(self, database, subject):
+        super(PartitionedCollection, self).__init__(database, subject)
+        self._subject = subject
+
+    @property
+    def _partitions(self):
+        return self._database._partitions
+
+    def _partition_index(self, id):
+        return partition_of(keystring.encode(id), len(self._partitions))
+
+    def _partition(self, id):
+        return self._partitions[self._partition_index(id)]
+
+    def _group(self, ids):
+        """Group `ids` by partition index"""
+        groups = defaultdict(list)
+        for id in ids:
+            groups[self._partition_index(id)].append(id)
+        return sorted(groups.items())
+
+    def _write_batch(self, batch, check_keys, ordered):
+        """Insert (position, document) pairs of `batch` partition by partition
+
+        If a partition failed, documents that positioned after the failed
+        one are removed from other partitions, and the ones before are
+        still inserted, like documents were inserted in order. Position of
+        the failed document is set to `position` of duplicate key error.
+
+        This is not atomic, each partition commits on its own. If the
+        process stopped before the removal is done, documents after the
+        failed one could be left in other partitions.
+
+        """
+        groups = defaultdict(list)
+        for position, doc in batch:
+            groups[self._partition_index(doc["_id"])].append((position, doc))
+
+        written = dict()
+        failure = None
+        for i, group in sorted(groups.items()):
+            if failure is not None:
+                group = [item for item in group if item[0] < failure[0]]
+                if not group:
+                    continue
+
+            pulled = list()
+
+            def produce_docs(group=group, pulled=pulled):
+                for position, doc in group:
+                    pulled.append(position)
+                    yield doc
+
+            try:
+                self._partitions[i].write_many(self._subject,
+                                               produce_docs(),
+                                               check_keys,
+                                               ordered)
+            except Exception as e:
+                # Documents are consumed lazily, the last pulled one failed
+                position = pulled[-1] if pulled else group[0][0]
+                failure = (position, e)
+                written[i] = set(p for p, _ in group if p < position)
+            else:
+                written[i] = set(p for p, _ in group)
+
+        if failure is None:
+            return
+
+        position, error = failure
+        for i, group in groups.items():
+            ids = [doc["_id"] for p, doc in group
+                   if p > position and p in written.get(i, ())]
+            if ids:
+                self._partitions[i].delete_many(self._subject, ids)
+
+        if isinstance(error, StorageDuplicateKeyError):
+            error.position = position
+        raise error
+
+    def write_one(self, doc, check_keys=True):
+        return self._partition(doc["_id"]).write_one(self._subject,
+                                                     doc,
+                                                     check_keys)
+
+    def write_many(self, docs, check_keys=True, ordered=True):
+        """Insert documents in batches, which are split by partition
+
+        Not atomic across partitions, see `_write_batch`.
+
+        """
+        ids = list()
+        docs = iter(docs)
+
+        while True:
+            batch = list()
+            try:
+                for doc in docs:
+                    batch.append((len(ids) + len(batch), doc))
+                    if len(batch) == PARTITIONED_WRITE_BATCH:
+                        break
+            except Exception:
+                # Raised while pulling the next document, e.g. invalid
+                # `_id`, insert the ones before it first.
+                self._write_batch(batch, check_keys, ordered)
+                raise
+
+            self._write_batch(batch, check_keys, ordered)
+            ids.extend(doc["_id"] for _, doc in batch)
+            if len(batch) < PARTITIONED_WRITE_BATCH:
+                break
+
+        return ids
+
+    def update_one(self, doc):
+        self._partition(doc["_id"]).update_one(self._subject, doc)
+
+    def update_many(self, docs):
+        groups = defaultdict(list)
+        for doc in docs:
+            groups[self._partition_index(doc["_id"])].append(doc)
+        for i, group in sorted(groups.items()):
+            self._partitions[i].update_many(self._subject, group)
+
+    def delete_one(self, id):
+        self._partition(id).delete_one(self._subject, id)
+
+    def delete_many(self, ids):
+        for i, group in self._group(ids):
+            self._partitions[i].delete_many(self._subject, group)
+
+    def list_indexes(self):
+        return self._partitions[0].list_indexes(self._subject)
+
+    def create_index(self, name, keys, unique=False):
+        if unique:
+            raise NotImplementedError("'partitioned' storage does not "
+                                      "support unique index, which could "
+                                      "not be enforced across partitions.")
+        for partition in self._partitions:
+            partition.create_index(self._subject, name, keys, unique)
+
+    def drop_index(self, name):
+        for partition in self._partitions:
+            partition.drop_index(self._subject, name)
+
+
+PartitionedDatabase.contractor_cls = PartitionedCollection
+
+
+class PartitionedCursor(AbstractCursor):
+
+    def __init__(self, collection, subject):
+        super(PartitionedCursor, self).__init__(collection, subject)
+        self._subject = subject
+
+    @property
+    def _partitions(self):
+        return self._collection._partitions
+
+    @property
+    def _storage(self):
+        return self._collection._database._storage
+
+    def query(self, max_scan):
+        if max_scan:
+            # Scan partitions one by one, only until enough documents
+            docs = chain.from_iterable(
+                partition.query(self._subject, max_scan)
+                for partition in self._partitions
+            )
+            return islice(docs, max_scan)
+
+        # Merged in `_id` order, so the natural order does not depend on
+        # how documents are partitioned.
+        return merge_ordered([
+            self._storage._prefetch(partial(partition.query_ordered,
+                                            self._subject))
+            for partition in self._partitions
+        ])
+
+    def query_ids(self, keys):
+        count = len(self._partitions)
+        groups = defaultdict(list)
+        for key in keys:
+            groups[partition_of(key, count)].append(key)
+
+        docs = list()
+        for i, group in sorted(groups.items()):
+            docs.extend(self._partitions[i].query_ids(self._subject, group))
+        return docs
+
+    def query_ordered(self, reverse=False):
+        streams = [partition.query_ordered(self._subject, reverse)
+                   for partition in self._partitions]
+        if any(stream is None for stream in streams):
+            return None
+        return merge_ordered(streams, reverse)
+
+
+PartitionedCollection.contractor_cls = PartitionedCursor
@@ -1,19 +1,36 @@
 
 import os
+import json
 import shutil
 import sqlite3
+import hashlib
+import threading
+import itertools
 import contextlib
 from collections import OrderedDict
 
 from ..base import WriteConcern
-from ..types import unicode_, bson
+from ..engine.field_walker import FieldWalker
+from ..types import (
+    PY3,
+    unicode_,
+    bson,
+    string_types,
+    integer_types,
+    is_duckument_type,
+    to_bytes,
+)
 from . import (
     AbstractStorage,
     AbstractDatabase,
     AbstractCollection,
     AbstractCursor,
 
+    StorageError,
     StorageDuplicateKeyError,
+    id_lookup_keys,
+    id_key_range,
+    keystring,
 )
 
 
@@ -34,149 +51,1156 @@ sqlite_324 = sqlite3.sqlite_version_info >= (3, 24, 0)
 
 
 SQLITE_DB_EXT = ".collection"
+SQLITE_DATABASE_FILE = "collections.database"
 SQLITE_RECORD_TABLE = "documents"
+SQLITE_INDEX_TABLE = "indexes"
+SQLITE_TABLE_SEP = "$"  # not allowed in collection name
+
+
+"""Tuning profiles"""
+
+SQLITE_TUNING_PRAGMAS = (
+    "page_size",  # only effective before the file is created
+    "mmap_size",
+    "cache_size",
+    "temp_store",
+    "wal_autocheckpoint",
+)
+
+SQLITE_PROFILES = {
+    # Map database into memory and keep more pages cached
+    "read-heavy": {
+        "page_size": 4096,
+        "mmap_size": 268435456,  # 256 MiB
+        "cache_size": -65536,  # 64 MiB
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 1000,
+    },
+    # Bigger pages and cache, checkpoint WAL less often
+    "bulk-load": {
+        "page_size": 16384,
+        "mmap_size": 0,
+        "cache_size": -262144,  # 256 MiB
+        "temp_store": "MEMORY",
+        "wal_autocheckpoint": 10000,
+    },
+    # No memory-mapped I/O and keep WAL short
+    "durable": {
+        "page_size": 4096,
+        "mmap_size": 0,
+        "cache_size": -2000,  # SQLite default, 2 MiB
+        "temp_store": "FILE",
+        "wal_autocheckpoint": 100,
+    },
+}
+
+# Schema versions of collection file:
+#   0: documents in text columns
+#   1: documents in BLOB columns
+#   2: documents keyed by order-preserving `keystring`
+#   3: index entries with exact `keystring` key for unique check
+SQLITE_SCHEMA_VERSION = 3
+SQLITE_MAX_VARIABLES = 999  # bound parameter limit before SQLite 3.32.0
 
 
 """SQL"""
 
+
+def _quote(name):
+    """Quote SQL identifier `name`, e.g. table or index name"""
+    return '"' + name.replace('"', '""') + '"'
+
+
 CREATE_TABLE = """
-    CREATE TABLE [{}](
-        k text NOT NULL,
-        v text NOT NULL,
+    CREATE TABLE IF NOT EXISTS {}(
+        k blob NOT NULL,
+        v blob NOT NULL,
         PRIMARY KEY(k)
     );
 """
 
+MIGRATE_TABLE = """
+    BEGIN IMMEDIATE;
+    CREATE TABLE {1}(
+        k blob NOT NULL,
+        v blob NOT NULL,
+        PRIMARY KEY(k)
+    );
+    INSERT INTO {1}(k, v)
+        SELECT CAST(k AS BLOB), CAST(v AS BLOB) FROM {0};
+    DROP TABLE {0};
+    ALTER TABLE {1} RENAME TO {0};
+    PRAGMA user_version = {2};
+    COMMIT;
+"""
+
+CREATE_KEY_MAP = """
+    CREATE TEMP TABLE "key.map"(
+        old blob NOT NULL,
+        new blob NOT NULL,
+        PRIMARY KEY(old)
+    );
+"""
+
+INSERT_KEY_MAP = """
+    INSERT INTO "key.map"(old, new) VALUES (?, ?);
+"""
+
+DROP_KEY_MAP = """
+    DROP TABLE "key.map";
+"""
+
+REKEY_RECORD = """
+    INSERT INTO {1}(k, v)
+        SELECT m.new, t.v FROM {0} AS t JOIN "key.map" AS m ON m.old = t.k;
+"""
+
+RENAME_TABLE = """
+    ALTER TABLE {0} RENAME TO {1};
+"""
+
+REKEY_INDEX_ENTRY = """
+    UPDATE {0} SET k = (SELECT new FROM "key.map" WHERE old = {0}.k);
+"""
+
+SELECT_USER_VERSION = """
+    PRAGMA user_version;
+"""
+
+UPDATE_USER_VERSION = """
+    PRAGMA user_version = {};
+"""
+
 INSERT_RECORD = """
-    INSERT INTO [{}](k, v) VALUES (?, ?);
+    INSERT INTO {}(k, v) VALUES (?, ?);
 """
 
 UPSERT_RECORD = """
-    INSERT INTO [{}] (v, k) VALUES(?, ?)
+    INSERT INTO {} (v, k) VALUES(?, ?)
         ON CONFLICT(k)
         DO UPDATE SET v=excluded.v;
 """  # need sqlite_version >= 3.24.0
 
 UPDATE_RECORD = """
-    UPDATE [{}] SET v = (?) WHERE k = (?);
+    UPDATE {} SET v = (?) WHERE k = (?);
 """
 
 INSORE_RECORD = """
-    INSERT OR IGNORE INTO [{}](v, k) VALUES (?, ?);
+    INSERT OR IGNORE INTO {}(v, k) VALUES (?, ?);
 """  # for sqlite_version < 3.24, UPDATE + INSERT_IGNORE = UPSERT SCRIPT
 
 DELETE_RECORD = """
-    DELETE FROM [{}] WHERE k = (?);
+    DELETE FROM {} WHERE k = (?);
 """
 
 SELECT_ALL_RECORD = """
-    SELECT v FROM [{}];
+    SELECT v FROM {};
 """
 
 SELECT_LIMIT_RECORD = """
-    SELECT v FROM [{0}] LIMIT {1};
+    SELECT v FROM {0} LIMIT {1};
+"""
+
+SELECT_WHERE_RECORD = """
+    SELECT v FROM {0} WHERE {1};
+"""
+
+SELECT_ORDERED_RECORD = """
+    SELECT v FROM {0} WHERE {1} ORDER BY k {2};
+"""
+
+SELECT_ALL_ITEMS = """
+    SELECT k, v FROM {};
+"""
+
+SELECT_SCHEMA_VERSION = """
+    PRAGMA schema_version;
+"""
+
+SELECT_TABLE_EXISTS = """
+    SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = (?);
+"""
+
+SELECT_ALL_TABLES = """
+    SELECT name FROM sqlite_master WHERE type = 'table';
+"""
+
+DROP_TABLE = """
+    DROP TABLE IF EXISTS {};
+"""
+
+CREATE_INDEX_TABLE = """
+    CREATE TABLE IF NOT EXISTS {}(
+        name text NOT NULL,
+        keys text NOT NULL,
+        is_unique integer NOT NULL,
+        PRIMARY KEY(name)
+    );
+"""
+
+SELECT_ALL_INDEX = """
+    SELECT name, keys, is_unique FROM {};
+"""
+
+INSERT_INDEX = """
+    INSERT INTO {}(name, keys, is_unique) VALUES (?, ?, ?);
+"""
+
+DELETE_INDEX = """
+    DELETE FROM {} WHERE name = (?);
+"""
+
+CREATE_INDEX_ENTRY_TABLE = """
+    CREATE TABLE {0}(k NOT NULL, {1}, x NOT NULL);
+"""
+
+CREATE_INDEX_ENTRY_VALUES = """
+    CREATE INDEX {1} ON {0}({2});
 """
 
-SELECT_ALL_KEYS = """
-    SELECT k FROM [{}];
+CREATE_INDEX_ENTRY_EXACT = """
+    CREATE UNIQUE INDEX {1} ON {0}(x);
 """
 
+CREATE_INDEX_ENTRY_KEY = """
+    CREATE INDEX {1} ON {0}(k);
+"""
+
+DROP_INDEX_ENTRY_TABLE = """
+    DROP TABLE IF EXISTS {};
+"""
+
+INSERT_INDEX_ENTRY = """
+    INSERT INTO {0}(k, {1}, x) VALUES (?, {2}, ?);
+"""
+
+DELETE_INDEX_ENTRY = """
+    DELETE FROM {} WHERE k = (?);
+"""
+
+
+SQLITE_INT_RANGE = (-2 ** 63, 2 ** 63 - 1)
+
+
+if PY3:
+    def _blob(value):
+        return value
+
+    def _unblob(value):
+        return value
+else:
+    # Python 2 binds `str` as TEXT and reads BLOB as `buffer`
+    _blob = sqlite3.Binary
+    _unblob = bytes
+
+
+class SQLiteTable(object):
+    """Locate where a collection is stored
+
+    With "collection" layout, each collection has its own file and the
+    documents are in table `SQLITE_RECORD_TABLE`. With "database" layout,
+    all collections of a database are in one file, each collection has a
+    table that named after itself and other tables of that collection are
+    prefixed with the name and `SQLITE_TABLE_SEP`.
+
+    """
+
+    def __init__(self, db_file, col_name=None):
+        self.db_file = db_file
+        if col_name is None:
+            self.name = SQLITE_RECORD_TABLE
+            self.prefix = ""
+        else:
+            self.name = col_name
+            self.prefix = col_name + SQLITE_TABLE_SEP
+        self.indexes = self.prefix + SQLITE_INDEX_TABLE
+
+    @property
+    def key(self):
+        return self.db_file, self.name
+
+
+"""Secondary index"""
+
+
+def _index_value(value):
+    """Convert document field value into index entry value
+
+    Numbers and strings are kept as SQLite native values so they could be
+    compared in range, other values are stored as encoded BLOB. Numbers
+    that could not fit in int64 or double are rounded, so the lookups on
+    these values are re-checked, and unique check is done on exact keys.
+
+    """
+    if isinstance(value, bool) or value is None:
+        pass
+    elif isinstance(value, integer_types):
+        if SQLITE_INT_RANGE[0] <= value <= SQLITE_INT_RANGE[1]:
+            return value
+        return float(value)
+    elif isinstance(value, float):
+        return value if value == value else None
+    elif isinstance(value, bson.Decimal128):
+        value = float(value.to_decimal())
+        return value if value == value else None
+    elif isinstance(value, string_types):
+        return value
+
+    try:
+        return _blob(bson.id_encode(value))
+    except Exception:
+        return None
+
+
+class SQLiteIndex(object):
+    """Secondary index, which entries are stored in a side table
+
+    Each document has at least one entry row `(k, v0, v1, ..., x)` in the
+    side table, one value column per indexed field, and `x` the exact key
+    of these values encoded by `keystring`, which is unique in a unique
+    index. Array elements are indexed separately (multikey), null and
+    missing field are indexed as null.
+
+    """
+
+    def __init__(self, name, keys, unique=False, prefix=""):
+        self.name = name
+        self.keys = [(field, direction) for field, direction in keys]
+        self.unique = bool(unique)
+        self.table = (prefix + "index."
+                      + hashlib.md5(to_bytes(name)).hexdigest())
+
+    @property
+    def fields(self):
+        return [field for field, _ in self.keys]
+
+    @property
+    def document(self):
+        doc = {"v": 2, "key": OrderedDict(self.keys), "name": self.name}
+        if self.unique:
+            doc["unique"] = True
+        return doc
+
+    @property
+    def _columns(self):
+        return ["v%d" % i for i in range(len(self.keys))]
+
+    def create(self, conn):
+        columns = self._columns
+        table = _quote(self.table)
+        conn.execute(CREATE_INDEX_ENTRY_TABLE.format(
+            table, ", ".join(columns)))
+        conn.execute(CREATE_INDEX_ENTRY_VALUES.format(
+            table, _quote(self.table + ".values"), ", ".join(columns)))
+        if self.unique:
+            conn.execute(CREATE_INDEX_ENTRY_EXACT.format(
+                table, _quote(self.table + ".x")))
+        conn.execute(CREATE_INDEX_ENTRY_KEY.format(
+            table, _quote(self.table + ".k")))
+
+    def drop(self, conn):
+        conn.execute(DROP_INDEX_ENTRY_TABLE.format(_quote(self.table)))
+
+    def entries(self, doc):
+        null = (keystring.encode(None), _index_value(None))
+        field_values = list()
+        for field in self.fields:
+            values = OrderedDict()
+            fieldwalker = FieldWalker(doc)
+            for value in fieldwalker.go(field).get().value.iter_flat():
+                exact = keystring.encode(value)
+                if exact not in values:
+                    values[exact] = _index_value(value)
+            field_values.append(list(values.items()) or [null])
+
+        entries = list()
+        for row in itertools.product(*field_values):
+            # Keys are never prefix of each other, joined keys are unique
+            exact = b"".join(exact for exact, _ in row)
+            entries.append(tuple(value for _, value in row) + (_blob(exact),))
+        return entries
+
+    def insert(self, conn, key, doc):
+        columns = self._columns
+        sql = INSERT_INDEX_ENTRY.format(_quote(self.table),
+                                        ", ".join(columns),
+                                        ", ".join("?" * len(columns)))
+        try:
+            conn.executemany(sql,
+                             [(key,) + row for row in self.entries(doc)])
+        except sqlite3.IntegrityError:
+            raise StorageDuplicateKeyError(self.name)
+
+    def delete(self, conn, key):
+        conn.execute(DELETE_INDEX_ENTRY.format(_quote(self.table)), (key,))
+
+
+"""Filter pushdown"""
+
+_sqlite_json1 = {"_": None}
+
+
+def has_json1():
+    """Return True if SQLite JSON1 functions are available"""
+    if _sqlite_json1["_"] is None:
+        conn = sqlite3.connect(":memory:")
+        try:
+            conn.execute("SELECT json_extract('{\"a\": 1}', '$.a')")
+        except sqlite3.OperationalError:
+            _sqlite_json1["_"] = False
+        else:
+            _sqlite_json1["_"] = True
+        finally:
+            conn.close()
+    return _sqlite_json1["_"]
+
+
+def _json_scalar(value):
+    """Return SQL comparable `value` and its JSON types, or None"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, integer_types):
+        if SQLITE_INT_RANGE[0] <= value <= SQLITE_INT_RANGE[1]:
+            return value, ("integer", "real")
+    if isinstance(value, float) and value == value:
+        return value, ("integer", "real")
+    if isinstance(value, string_types):
+        return value, ("text",)
+    return None
+
+
+_SQL_COMPARISON = {
+    "$eq": "=",
+    "$gt": ">",
+    "$gte": ">=",
+    "$lt": "<",
+    "$lte": "<=",
+}
+
+
+def _field_conditions(field, spec):
+    """Translate one top-level field query into SQL conditions
+
+    Conditions may match more documents than the query does, array
+    values are always kept for the re-check.
+
+    """
+    if not is_duckument_type(spec):
+        spec = {"$eq": spec}
+    elif not all(op[:1] == "$" for op in spec):
+        return []  # Embedded document equality
+
+    conditions = list()
+    path = '$."{}"'.format(field)
+    for op, value in spec.items():
+        if op not in _SQL_COMPARISON:
+            continue
+        scalar = _json_scalar(value)
+        if scalar is None:
+            continue
+        value, types = scalar
+        sql = ("(json_type(CAST(v AS TEXT), ?) = 'array' OR ("
+               "json_type(CAST(v AS TEXT), ?) IN ({0}) AND "
+               "json_extract(CAST(v AS TEXT), ?) {1} ?))").format(
+                   ", ".join("'%s'" % t for t in types),
+                   _SQL_COMPARISON[op])
+        conditions.append((sql, [path, path, path, value]))
+
+    return conditions
+
+
+def _id_condition(spec):
+    """Translate `_id` query into primary key lookup or range, or None"""
+    keys = id_lookup_keys(spec)
+    if keys is not None:
+        if not keys:
+            return "0", []
+        return ("k IN ({})".format(", ".join("?" * len(keys))),
+                [_blob(key) for key in keys])
+
+    key_range = id_key_range({"_id": spec})
+    if key_range is None:
+        return None
+    lower, upper = key_range
+    if upper is None:
+        return "k >= ?", [_blob(lower)]
+    return "k >= ? AND k < ?", [_blob(lower), _blob(upper)]
+
+
+def _index_conditions(index, spec):
+    """Translate field query into lookups on index first field
+
+    Each operator gets its own lookup, since multikey entries of one
+    document may satisfy different operators.
+
+    """
+    def lookup(sql, params):
+        return ("k IN (SELECT k FROM {0} WHERE {1})".format(
+            _quote(index.table), sql), params)
+
+    def query_value(value):
+        if isinstance(value, bson.ObjectId):
+            return _blob(bson.id_encode(value)), ("blob",)
+        return _json_scalar(value)
+
+    if not is_duckument_type(spec):
+        spec = {"$eq": spec}
+    elif not all(op[:1] == "$" for op in spec):
+        return []
+
+    conditions = list()
+    for op, value in spec.items():
+        if op == "$in" and isinstance(value, (list, tuple)):
+            values = [query_value(v) for v in value]
+            if None in values or len(values) > SQLITE_MAX_VARIABLES // 2:
+                continue
+            sql = "v0 IN ({})".format(", ".join("?" * len(values)) or "NULL")
+            conditions.append(lookup(sql, [v for v, _ in values]))
+            continue
+
+        if op not in _SQL_COMPARISON:
+            continue
+        scalar = query_value(value)
+        if scalar is None:
+            continue
+        value, types = scalar
+        if op == "$eq":
+            conditions.append(lookup("v0 = ?", [value]))
+        elif types != ("blob",):
+            # Non-strict comparison, in case of rounded Decimal128 values.
+            sql = "v0 {0} ? AND typeof(v0) IN ({1})".format(
+                _SQL_COMPARISON[op][0] + "=",
+                ", ".join("'%s'" % t for t in types))
+            conditions.append(lookup(sql, [value]))
+
+    return conditions
+
+
+def _spec_conditions(spec, use_json, indexes):
+    """Return key conditions and JSON conditions of query `spec`"""
+    key_conditions = list()
+    json_conditions = list()
+
+    for field, sub_spec in spec.items():
+        if field == "$and" and isinstance(sub_spec, (list, tuple)):
+            for sub in sub_spec:
+                if is_duckument_type(sub):
+                    keys, jsons = _spec_conditions(sub, use_json, indexes)
+                    key_conditions += keys
+                    json_conditions += jsons
+            continue
+        if field[:1] == "$":
+            continue
+
+        for index in indexes:
+            if index.fields[0] == field:
+                key_conditions += _index_conditions(index, sub_spec)
+                break
+
+        if "." in field or '"' in field:
+            continue
+
+        if field == "_id":
+            condition = _id_condition(sub_spec)
+            if condition is not None:
+                key_conditions.append(condition)
+                continue
+
+        if use_json:
+            json_conditions += _field_conditions(field, sub_spec)
+
+    return key_conditions, json_conditions
+
+
+def where_clause(spec, indexes=()):
+    """Translate a safe subset of query `spec` into SQL WHERE clause
+
+    Supported queries are `_id` equality and `$in`, equality, `$in` and
+    range comparisons on the first field of `indexes`, and if documents
+    are stored as JSON, also top-level scalar equality and range
+    comparisons. Rows may match more than the query does, so documents
+    still need to be filtered by `QueryFilter`.
+
+    Returns:
+        tuple: SQL expression (empty if nothing to push down) and params
+
+    """
+    use_json = not bson.bson_used and has_json1()
+    key_conditions, json_conditions = _spec_conditions(spec or {},
+                                                       use_json,
+                                                       indexes)
+
+    expressions = list()
+    params = list()
+    for sql, values in key_conditions:
+        expressions.append(sql)
+        params += values
+
+    if json_conditions:
+        # Keep rows that JSON1 could not parse, e.g. with NaN values.
+        expressions.append("(NOT json_valid(CAST(v AS TEXT)) OR ({}))".format(
+            " AND ".join(sql for sql, _ in json_conditions)))
+        for _, values in json_conditions:
+            params += values
+
+    if not expressions or len(params) > SQLITE_MAX_VARIABLES:
+        return "", []
+
+    return " AND ".join(expressions), params
+
+
+@contextlib.contextmanager
+def _no_lock():
+    yield
+
 
 class SQLiteKVEngine(object):
 
-    def __init__(self, db_pragmas):
+    def __init__(self, db_pragmas, batch_size=0):
         self.__db_pragmas = db_pragmas
-        self.__conn = None
+        self.__batch_size = batch_size
+        self.__conns = dict()
+        self.__indexes = dict()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
 
     @property
     def db_pragmas(self):
-        return self._assemble_pragmas(self.__db_pragmas)
-
+        # page_size must be set before journal_mode=WAL, which writes the
+        # database header of a new file.
+        pragmas = sorted(self.__db_pragmas.items(),
+                         key=lambda item: item[0] != "page_size")
+        return self._assemble_pragmas(OrderedDict(pragmas))
+
+    def _wconcern_pragmas(self, wconcern=None):
+        if not wconcern:
+            return ""
+
+        wcon_doc = wconcern.document
+        # wtimeout (milliseconds) -> busy_timeout (milliseconds)
+        timeout = wcon_doc.get("wtimeout")
+        if timeout:
+            del wcon_doc["wtimeout"]
+            wcon_doc["busy_timeout"] = timeout
+
+        return self._assemble_pragmas(wcon_doc)
+
+    @contextlib.contextmanager
     def _connect(self, db_file, wconcern=None):
-        self.__conn = sqlite3.connect(db_file)
-        self.__conn.text_factory = str
+        """Yield a cached connection of `db_file`
 
-        wcon_pragmas = ""
-        if wconcern:
-            wcon_doc = wconcern.document
-            # wtimeout (milliseconds) -> busy_timeout (milliseconds)
-            timeout = wcon_doc.get("wtimeout")
-            if timeout:
-                del wcon_doc["wtimeout"]
-                wcon_doc["busy_timeout"] = timeout
+        Connections are opened once per collection file and write concern,
+        pragmas are applied when the connection is opened. Each connection
+        is guarded by its own lock so it can be shared between threads.
 
-            wcon_pragmas = self._assemble_pragmas(wcon_doc)
+        Session transaction has its own connection of each file, so other
+        threads and sessions wait on SQLite's file lock, until the busy
+        timeout, instead of waiting on each other forever.
 
+        """
+        wcon_pragmas = self._wconcern_pragmas(wconcern)
+        key = (db_file, wcon_pragmas)
+
+        with self.__lock:
+            if key not in self.__conns:
+                conn = self._open(db_file, wcon_pragmas)
+                try:
+                    self._migrate(conn, db_file)
+                except Exception:
+                    conn.close()
+                    raise
+                self.__conns[key] = (conn, threading.RLock())
+
+            conn, conn_lock = self.__conns[key]
+
+        session = self._session()
+        if session is not None:
+            # One connection per file in session transaction, or it may
+            # block itself by the other connection's write lock.
+            for session_key, session_conn in session.items():
+                if session_key[0] == db_file:
+                    conn, conn_lock = session_conn
+                    break
+            else:
+                conn = self._open(db_file, wcon_pragmas)
+                conn_lock = threading.RLock()
+                conn.execute("BEGIN")
+                session[key] = (conn, conn_lock)
+
+        with conn_lock:
+            yield conn
+
+    def _open(self, db_file, wcon_pragmas):
+        conn = sqlite3.connect(db_file, check_same_thread=False)
         # update connection pragmas and write_concern pragmas
-        self.__conn.executescript(self.db_pragmas + ";" + wcon_pragmas)
+        conn.executescript(self.db_pragmas + ";" + wcon_pragmas)
+        return conn
 
-        return contextlib.closing(self.__conn)
+    def _session(self):
+        return getattr(self.__local, "session", None)
+
+    @contextlib.contextmanager
+    def _transaction(self, conn, ddl=False):
+        """Commit on success or rollback on error
+
+        If `conn` is in session transaction, a savepoint is used instead,
+        so only this operation is rolled back on error.
+
+        """
+        session = self._session() or {}
+        if any(c is conn for c, _ in session.values()):
+            conn.execute("SAVEPOINT operation")
+            try:
+                yield
+            except Exception:
+                conn.execute("ROLLBACK TO operation")
+                conn.execute("RELEASE operation")
+                raise
+            else:
+                conn.execute("RELEASE operation")
+        else:
+            with conn:
+                if ddl:
+                    conn.execute("BEGIN")
+                yield
+
+    def begin(self):
+        """Begin session transaction in current thread
+
+        Until `commit` or `abort`, all operations from current thread are
+        made in one transaction per connection.
+
+        """
+        self.__local.session = dict()
+        self.__local.created = list()
+
+    def commit(self):
+        self._end_session(commit=True)
+
+    def abort(self):
+        self._end_session(commit=False)
+
+    def _end_session(self, commit):
+        session = self._session()
+        created = getattr(self.__local, "created", None) or []
+        self.__local.session = self.__local.created = None
+        error = None
+        for conn, _ in (session or {}).values():
+            try:
+                if commit and error is None:
+                    conn.commit()
+                else:
+                    conn.rollback()
+            except sqlite3.Error as e:
+                error = error or e
+            finally:
+                conn.close()
+        if not commit:
+            # Collection files created in the transaction
+            for db_file in created:
+                self.close(db_file)
+                if os.path.isfile(db_file):
+                    os.remove(db_file)
+        if error is not None:
+            raise error
+
+    def close(self, db_file=None):
+        """Close cached connections
+
+        Close all connections, or only the ones of `db_file` if given.
+
+        """
+        with self.__lock:
+            for key in list(self.__conns.keys()):
+                if db_file is not None and key[0] != db_file:
+                    continue
+                conn, conn_lock = self.__conns.pop(key)
+                with conn_lock:
+                    conn.close()
+                for table_key in list(self.__indexes.keys()):
+                    if table_key[0] == key[0]:
+                        del self.__indexes[table_key]
+
+            session = self._session()
+            for key in list((session or {}).keys()):
+                if db_file is None or key[0] == db_file:
+                    # Closed connection has rolled back by itself
+                    session.pop(key)[0].close()
+
+    def _migrate(self, conn, db_file):
+        """Upgrade file that saved in legacy schema
+
+        Version 0 stored documents in text columns, they are copied into
+        BLOB columns as is. Version 1 stored documents under the keys that
+        encoded by `bson.id_encode`, they are re-keyed with `keystring`,
+        so are the index entries. Before version 3, index entries had no
+        exact key, they are rebuilt. Then the file is marked with
+        `SQLITE_SCHEMA_VERSION`.
+
+        """
+        version = conn.execute(SELECT_USER_VERSION).fetchone()[0]
+        if version >= SQLITE_SCHEMA_VERSION:
+            return
+        tables = [row[0] for row in conn.execute(SELECT_ALL_TABLES)]
+        if not tables:
+            return  # new file, schema version is set in `create_table`
+
+        if version < 1 and SQLITE_RECORD_TABLE in tables:
+            conn.executescript(MIGRATE_TABLE.format(
+                _quote(SQLITE_RECORD_TABLE),
+                _quote(SQLITE_RECORD_TABLE + ".migrate"),
+                1))
+
+        if os.path.basename(db_file) == SQLITE_DATABASE_FILE:
+            record_tables = [SQLiteTable(db_file, name) for name in tables
+                             if SQLITE_TABLE_SEP not in name]
+        elif SQLITE_RECORD_TABLE in tables:
+            record_tables = [SQLiteTable(db_file)]
+        else:
+            record_tables = []
+
+        with self._transaction(conn, ddl=True):
+            for table in record_tables:
+                if version < 2:
+                    self._rekey(conn, table)
+                if version < 3:
+                    self._reindex(conn, table)
+            conn.execute(UPDATE_USER_VERSION.format(SQLITE_SCHEMA_VERSION))
+
+    def _rekey(self, conn, table):
+        """Re-key documents and index entries of `table` with `keystring`
+        """
+        conn.execute(CREATE_KEY_MAP)
+        sql = SELECT_ALL_ITEMS.format(_quote(table.name))
+        for key, encoded in conn.execute(sql):
+            doc = bson.document_decode(_unblob(encoded))
+            conn.execute(INSERT_KEY_MAP,
+                         (key, _blob(keystring.encode(doc["_id"]))))
+
+        # `executescript` would commit, run statements one by one.
+        rekeyed = table.name + ".migrate"
+        conn.execute(CREATE_TABLE.format(_quote(rekeyed)))
+        try:
+            conn.execute(REKEY_RECORD.format(_quote(table.name),
+                                             _quote(rekeyed)))
+        except sqlite3.IntegrityError:
+            # e.g. `1` and `1.0`, which were different keys before
+            raise StorageError("Documents that have equal `_id` found in "
+                               "%s, could not be migrated." % table.db_file)
+        conn.execute(DROP_TABLE.format(_quote(table.name)))
+        conn.execute(RENAME_TABLE.format(_quote(rekeyed), _quote(table.name)))
+
+        if self._table_exists(conn, table.indexes):
+            sql = SELECT_ALL_INDEX.format(_quote(table.indexes))
+            for name, keys, unique in conn.execute(sql).fetchall():
+                index = SQLiteIndex(name, json.loads(keys), unique,
+                                    table.prefix)
+                conn.execute(REKEY_INDEX_ENTRY.format(_quote(index.table)))
+
+        conn.execute(DROP_KEY_MAP)
+
+    def _reindex(self, conn, table):
+        """Rebuild secondary indexes of `table` from documents"""
+        if not self._table_exists(conn, table.indexes):
+            return
+        sql = SELECT_ALL_INDEX.format(_quote(table.indexes))
+        indexes = [SQLiteIndex(name, json.loads(keys), unique, table.prefix)
+                   for name, keys, unique in conn.execute(sql).fetchall()]
+        for index in indexes:
+            index.drop(conn)
+            index.create(conn)
+
+        sql = SELECT_ALL_ITEMS.format(_quote(table.name))
+        try:
+            for key, encoded in conn.execute(sql).fetchall():
+                doc = bson.document_decode(_unblob(encoded))
+                for index in indexes:
+                    index.insert(conn, key, doc)
+        except StorageDuplicateKeyError as e:
+            raise StorageError("Documents that have duplicated key in "
+                               "unique index %s found in %s, could not be "
+                               "migrated." % (e.index_name, table.db_file))
 
     def _assemble_pragmas(self, pragma_dict):
         return ";".join(["PRAGMA {0}={1}".format(k, v)
                          for k, v in pragma_dict.items()])
 
-    def create_table(self, db_file):
-        with self._connect(db_file) as conn:
-            with conn:
-                conn.execute(CREATE_TABLE.format(SQLITE_RECORD_TABLE))
+    def _table_exists(self, conn, name):
+        return bool(conn.execute(SELECT_TABLE_EXISTS, (name,)).fetchone())
 
-    def write_one(self, db_file, params, wconcern=None):
-        with self._connect(db_file, wconcern) as conn:
-            with conn:
-                sql = INSERT_RECORD.format(SQLITE_RECORD_TABLE)
-                conn.execute(sql, params)
+    def table_exists(self, table, wconcern=None):
+        if not os.path.isfile(table.db_file):
+            return False
+        with self._connect(table.db_file, wconcern) as conn:
+            return self._table_exists(conn, table.name)
 
-    def write_many(self, db_file, seq_params, wconcern=None):
+    def list_tables(self, db_file, wconcern=None):
+        """List collection tables in `db_file` of "database" layout"""
+        if not os.path.isfile(db_file):
+            return []
         with self._connect(db_file, wconcern) as conn:
-            with conn:
-                sql = INSERT_RECORD.format(SQLITE_RECORD_TABLE)
-                conn.executemany(sql, seq_params)
+            return [name for name, in conn.execute(SELECT_ALL_TABLES)
+                    if SQLITE_TABLE_SEP not in name]
 
-    def update_one(self, db_file, params, wconcern=None):
-        with self._connect(db_file, wconcern) as conn:
-            with conn:
-                sql = UPDATE_RECORD.format(SQLITE_RECORD_TABLE)
-                conn.execute(sql, params)
+    def drop_table(self, table, wconcern=None):
+        """Drop collection table and its index tables"""
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn, ddl=True):
+                for index in self._indexes(conn, table):
+                    index.drop(conn)
+                conn.execute(DROP_TABLE.format(_quote(table.indexes)))
+                conn.execute(DROP_TABLE.format(_quote(table.name)))
 
-    def update_many(self, db_file, seq_params, wconcern=None):
-        with self._connect(db_file, wconcern) as conn:
-            with conn:
-                sql = UPDATE_RECORD.format(SQLITE_RECORD_TABLE)
-                conn.executemany(sql, seq_params)
+    def _indexes(self, conn, table):
+        """Return secondary indexes of `table`
 
-    def delete_one(self, db_file, params, wconcern=None):
-        with self._connect(db_file, wconcern) as conn:
-            with conn:
-                sql = DELETE_RECORD.format(SQLITE_RECORD_TABLE)
-                conn.execute(sql, params)
+        Indexes are cached until the database schema version changed.
 
-    def delete_many(self, db_file, seq_params, wconcern=None):
-        with self._connect(db_file, wconcern) as conn:
-            with conn:
-                sql = DELETE_RECORD.format(SQLITE_RECORD_TABLE)
-                conn.executemany(sql, seq_params)
+        """
+        version = conn.execute(SELECT_SCHEMA_VERSION).fetchone()[0]
+        cached = self.__indexes.get(table.key)
+        if cached is None or cached[0] != version:
+            indexes = list()
+            if self._table_exists(conn, table.indexes):
+                sql = SELECT_ALL_INDEX.format(_quote(table.indexes))
+                for name, keys, unique in conn.execute(sql).fetchall():
+                    indexes.append(SQLiteIndex(name,
+                                               json.loads(keys),
+                                               unique,
+                                               table.prefix))
+            cached = self.__indexes[table.key] = (version, indexes)
+
+        return cached[1]
+
+    def _insert(self, conn, table, indexes, record):
+        key, encoded, doc = record
+        conn.execute(INSERT_RECORD.format(_quote(table.name)), (key, encoded))
+        try:
+            for index in indexes:
+                index.insert(conn, key, doc)
+        except StorageDuplicateKeyError:
+            self._delete(conn, table, indexes, key)
+            raise
+
+    def _update(self, conn, table, indexes, record):
+        key, encoded, doc = record
+        conn.execute(UPDATE_RECORD.format(_quote(table.name)), (encoded, key))
+        for index in indexes:
+            index.delete(conn, key)
+            index.insert(conn, key, doc)
+
+    def _delete(self, conn, table, indexes, key):
+        conn.execute(DELETE_RECORD.format(_quote(table.name)), (key,))
+        for index in indexes:
+            index.delete(conn, key)
+
+    def create_table(self, table):
+        """Create collection table, and the file if not exists
+
+        In session transaction, collection creation is rolled back with
+        the transaction. In "database" layout the table is created in the
+        transaction, in "collection" layout the file is the collection, it
+        is created right away and removed if the transaction is aborted.
 
-    def read_all(self, db_file, limit):
-        if not os.path.isfile(db_file):
-            return []
-        with self._connect(db_file) as conn:
-            with conn:
-                if limit:
-                    sql = SELECT_LIMIT_RECORD.format(
-                        SQLITE_RECORD_TABLE, limit)
+        """
+        session = self._session()
+        in_file = table.name != SQLITE_RECORD_TABLE
+        if session is not None and in_file:
+            self._create_file(table.db_file)
+            with self._connect(table.db_file) as conn:
+                with self._transaction(conn, ddl=True):
+                    conn.execute(CREATE_TABLE.format(_quote(table.name)))
+            return
+
+        new_file = self._create_file(table.db_file, table.name)
+        if session is not None and new_file:
+            self.__local.created.append(table.db_file)
+
+    def _create_file(self, db_file, table_name=None):
+        """Create `db_file` with table `table_name` if not exists
+
+        Not using cached connection, so creation is not made in session
+        transaction. Engine lock is held for new file so no connection
+        opened before the file is set up. Return True if file created.
+
+        """
+        new_file = not os.path.isfile(db_file)
+        if not new_file and table_name is None:
+            return False
+        with self.__lock if new_file else _no_lock():
+            conn = sqlite3.connect(db_file)
+            try:
+                page_size = self.__db_pragmas.get("page_size")
+                if new_file and page_size:
+                    conn.execute("PRAGMA page_size={}".format(page_size))
+                with conn:
+                    if table_name is not None:
+                        conn.execute(CREATE_TABLE.format(_quote(table_name)))
+                    conn.execute(
+                        UPDATE_USER_VERSION.format(SQLITE_SCHEMA_VERSION))
+            finally:
+                conn.close()
+        return new_file
+
+    def write_one(self, table, record, wconcern=None):
+        """Insert one `record`, which is a tuple of key, value and document
+        """
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn):
+                self._insert(conn, table, self._indexes(conn, table), record)
+
+    def write_many(self, table, records, wconcern=None):
+        """Insert records until the first duplicated key
+
+        `records` is consumed lazily, records inserted before the
+        duplicated one are committed and then the `IntegrityError` (or
+        `StorageDuplicateKeyError` of secondary index) is re-raised.
+
+        """
+        error = None
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn):
+                indexes = self._indexes(conn, table)
+                try:
+                    if indexes:
+                        for record in records:
+                            self._insert(conn, table, indexes, record)
+                    else:
+                        sql = INSERT_RECORD.format(_quote(table.name))
+                        conn.executemany(sql, (r[:2] for r in records))
+                except (sqlite3.IntegrityError,
+                        StorageDuplicateKeyError) as e:
+                    error = e
+        if error is not None:
+            raise error
+
+    def update_one(self, table, record, wconcern=None):
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn):
+                self._update(conn, table, self._indexes(conn, table), record)
+
+    def update_many(self, table, records, wconcern=None):
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn):
+                indexes = self._indexes(conn, table)
+                if indexes:
+                    for record in records:
+                        self._update(conn, table, indexes, record)
                 else:
-                    sql = SELECT_ALL_RECORD.format(SQLITE_RECORD_TABLE)
+                    sql = UPDATE_RECORD.format(_quote(table.name))
+                    conn.executemany(sql, ((r[1], r[0]) for r in records))
+
+    def delete_one(self, table, key, wconcern=None):
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn):
+                self._delete(conn, table, self._indexes(conn, table), key)
+
+    def delete_many(self, table, keys, wconcern=None):
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn):
+                indexes = self._indexes(conn, table)
+                if indexes:
+                    for key in keys:
+                        self._delete(conn, table, indexes, key)
+                else:
+                    sql = DELETE_RECORD.format(_quote(table.name))
+                    conn.executemany(sql, ((key,) for key in keys))
 
-                return conn.execute(sql).fetchall()
+    def read_all(self, table, limit, wconcern=None, spec=None, order=0):
+        """Stream records from `table`
 
-    def read_all_keys(self, db_file):
-        if not os.path.isfile(db_file):
+        Rows are pulled in batches of `batch_size` while the cursor stays
+        open, a non-positive `batch_size` fetches all rows at once.
+
+        Part of query `spec` will be pushed down as SQL WHERE clause if
+        given, see `where_clause`. If `order` is 1 or -1, rows are read in
+        ascending or descending primary key order.
+
+        """
+        if not os.path.isfile(table.db_file):
+            return
+
+        with self._connect(table.db_file, wconcern) as conn:
+            if not self._table_exists(conn, table.name):
+                return
+            where, params = "", ()
+            if spec:
+                where, params = where_clause(spec,
+                                             self._indexes(conn, table))
+            if order:
+                sql = SELECT_ORDERED_RECORD.format(_quote(table.name),
+                                                   where or "1",
+                                                   "DESC" if order < 0
+                                                   else "ASC")
+            elif where:
+                sql = SELECT_WHERE_RECORD.format(_quote(table.name), where)
+            elif limit:
+                sql = SELECT_LIMIT_RECORD.format(_quote(table.name), limit)
+            else:
+                sql = SELECT_ALL_RECORD.format(_quote(table.name))
+
+            cursor = conn.execute(sql, params)
+
+        try:
+            while True:
+                with self._connect(table.db_file, wconcern):
+                    if self.__batch_size > 0:
+                        rows = cursor.fetchmany(self.__batch_size)
+                    else:
+                        rows = cursor.fetchall()
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def read_keys(self, table, keys, wconcern=None):
+        """Return records stored under primary `keys` from `table`"""
+        if not keys or not os.path.isfile(table.db_file):
             return []
-        with self._connect(db_file) as conn:
-            with conn:
-                sql = SELECT_ALL_KEYS.format(SQLITE_RECORD_TABLE)
-                return conn.execute(sql).fetchall()
+
+        rows = []
+        with self._connect(table.db_file, wconcern) as conn:
+            if not self._table_exists(conn, table.name):
+                return []
+            for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+                chunk = [_blob(k) for k in keys[i:i + SQLITE_MAX_VARIABLES]]
+                where = "k IN ({})".format(", ".join("?" * len(chunk)))
+                sql = SELECT_WHERE_RECORD.format(_quote(table.name), where)
+                rows.extend(conn.execute(sql, chunk).fetchall())
+        return rows
+
+    def list_indexes(self, table, wconcern=None):
+        if not os.path.isfile(table.db_file):
+            return []
+        with self._connect(table.db_file, wconcern) as conn:
+            return list(self._indexes(conn, table))
+
+    def create_index(self, table, index, decode, wconcern=None):
+        """Create secondary `index` and index all existing documents"""
+        with self._connect(table.db_file, wconcern) as conn:
+            # DDL is not in implicit transaction, begin one explicitly
+            # so that the side table is rolled back on duplicated key.
+            with self._transaction(conn, ddl=True):
+                conn.execute(CREATE_INDEX_TABLE.format(_quote(table.indexes)))
+                index.create(conn)
+                sql = SELECT_ALL_ITEMS.format(_quote(table.name))
+                for key, encoded in conn.execute(sql):
+                    index.insert(conn, key, decode(encoded))
+                conn.execute(INSERT_INDEX.format(_quote(table.indexes)),
+                             (index.name,
+                              json.dumps(index.keys),
+                              int(index.unique)))
+
+    def drop_index(self, table, name, wconcern=None):
+        with self._connect(table.db_file, wconcern) as conn:
+            with self._transaction(conn, ddl=True):
+                for index in self._indexes(conn, table):
+                    if index.name == name:
+                        index.drop(conn)
+                        sql = DELETE_INDEX.format(_quote(table.indexes))
+                        conn.execute(sql, (name,))
 
 
 class SQLiteWriteConcern(WriteConcern):
@@ -221,7 +1245,11 @@ class SQLiteStorage(AbstractStorage):
 
     def __init__(self, repository, storage_config):
         super(SQLiteStorage, self).__init__(repository, storage_config)
-        self._conn = SQLiteKVEngine(self._config)
+        db_pragmas = self._config.copy()
+        batch_size = db_pragmas.pop("read_batch_size")
+        self._layout = db_pragmas.pop("layout")
+        db_pragmas.pop("profile", None)
+        self._conn = SQLiteKVEngine(db_pragmas, batch_size)
 
     def _db_path(self, db_name):
         """
@@ -234,7 +1262,12 @@ class SQLiteStorage(AbstractStorage):
         return "sqlite"
 
     @classmethod
-    def config(cls, journal_mode="WAL", **kwargs):
+    def config(cls,
+               journal_mode="WAL",
+               read_batch_size=1000,
+               layout="collection",
+               profile=None,
+               **kwargs):
         """
 
         Args:
@@ -242,10 +1275,70 @@ class SQLiteStorage(AbstractStorage):
                 type: string
                 enum: [DELETE, TRUNCATE, PERSIST, MEMORY, WAL, "OFF"]
 
+            read_batch_size (int): Default 1000
+                Rows fetched per batch when streaming query results,
+                0 for fetching all rows at once.
+
+            layout (str): Default "collection"
+                One SQLite file per "collection", or one file per
+                "database" which stores each collection as a table.
+                Should not be changed once the repository has data.
+
+            profile (str): Default None
+                Tuning profile, one of "read-heavy", "bulk-load" or
+                "durable", see `SQLITE_PROFILES`. Values of the profile
+                could be overridden by keyword arguments `page_size`,
+                `mmap_size`, `cache_size`, `temp_store` and
+                `wal_autocheckpoint`, which are SQLite pragmas.
+
         """
-        return {
+        if layout not in ("collection", "database"):
+            raise ValueError("SQLite layout should be 'collection' or "
+                             "'database', got %r." % layout)
+
+        tuning = dict()
+        if profile:
+            if profile not in SQLITE_PROFILES:
+                raise ValueError("Unknown SQLite profile %r, should be one "
+                                 "of %s." % (profile,
+                                             sorted(SQLITE_PROFILES)))
+            tuning.update(SQLITE_PROFILES[profile])
+
+        for pragma in SQLITE_TUNING_PRAGMAS:
+            value = kwargs.get(pragma)
+            if value is None:
+                continue
+            if pragma == "temp_store":
+                value = str(value).upper()
+                if value not in ("0", "1", "2", "DEFAULT", "FILE", "MEMORY"):
+                    raise ValueError("Invalid temp_store %r." % value)
+            else:
+                value = int(value)
+            tuning[pragma] = value
+
+        config = {
             "journal_mode": journal_mode,
+            "read_batch_size": int(read_batch_size),
+            "layout": layout,
         }
+        if profile:
+            config["profile"] = profile
+        config.update(tuning)
+
+        return config
+
+    def close(self):
+        self._conn.close()
+        super(SQLiteStorage, self).close()
+
+    def begin_transaction(self):
+        self._conn.begin()
+
+    def commit_transaction(self):
+        self._conn.commit()
+
+    def abort_transaction(self):
+        self._conn.abort()
 
     def wconcern_parser(self,
                         wtimeout=None,
@@ -264,6 +1357,7 @@ class SQLiteStorage(AbstractStorage):
     def database_drop(self, db_name):
         db_path = self._db_path(db_name)
         if os.path.isdir(db_path):
+            self._conn.close()
             shutil.rmtree(db_path)
 
     def database_list(self):
@@ -278,13 +1372,21 @@ class SQLiteDatabase(AbstractDatabase):
     def __init__(self, storage, subject):
         super(SQLiteDatabase, self).__init__(storage, subject)
         self._db_path = storage._db_path(self._name)
+        self._single_file = storage._layout == "database"
 
     def _col_path(self, col_name):
         """
         Get SQLite database file path, which is Monty collection.
         """
+        if self._single_file:
+            return os.path.join(self._db_path, SQLITE_DATABASE_FILE)
         return os.path.join(self._db_path, col_name) + SQLITE_DB_EXT
 
+    def _col_table(self, col_name):
+        if self._single_file:
+            return SQLiteTable(self._col_path(col_name), col_name)
+        return SQLiteTable(self._col_path(col_name))
+
     @property
     def _conn(self):
         return self._storage._conn
@@ -293,22 +1395,32 @@ class SQLiteDatabase(AbstractDatabase):
         return os.path.isdir(self._db_path)
 
     def collection_exists(self, col_name):
+        if self._single_file:
+            return self._conn.table_exists(self._col_table(col_name))
         return os.path.isfile(self._col_path(col_name))
 
     def collection_create(self, col_name):
         if not self.database_exists():
             self._storage.database_create(self._name)
-        self._conn.create_table(self._col_path(col_name))
+        self._conn.create_table(self._col_table(col_name))
 
     def collection_drop(self, col_name):
-        if self.collection_exists(col_name):
+        if not self.collection_exists(col_name):
+            return
+        if self._single_file:
+            self._conn.drop_table(self._col_table(col_name))
+        else:
+            self._conn.close(self._col_path(col_name))
             os.remove(self._col_path(col_name))
 
     def collection_list(self):
         if not self.database_exists():
             return []
+        if self._single_file:
+            return self._conn.list_tables(self._col_path(None))
         return [os.path.splitext(name)[0]
-                for name in os.listdir(unicode_(self._db_path))]
+                for name in os.listdir(unicode_(self._db_path))
+                if name.endswith(SQLITE_DB_EXT)]
 
 
 SQLiteStorage.contractor_cls = SQLiteDatabase
@@ -319,7 +1431,7 @@ class SQLiteCollection(AbstractCollection):
     def __init__(self, database, subject):
         super(SQLiteCollection, self).__init__(database, subject)
 
-        self._col_path = self._database._col_path(self._name)
+        self._table = self._database._col_table(self._name)
 
     def _ensure_table(func):
         def make_table(self, *args, **kwargs):
@@ -332,48 +1444,44 @@ class SQLiteCollection(AbstractCollection):
     def _conn(self):
         return self._database._conn
 
+    def _record(self, doc, check_keys=False):
+        return (_blob(keystring.encode(doc["_id"])),
+                _blob(self._encode_doc(doc, check_keys)),
+                doc)
+
     @_ensure_table
     def write_one(self, doc, check_keys=True):
         """
         """
-        _id = doc["_id"]
         try:
             self._conn.write_one(
-                self._col_path,
-                (bson.id_encode(_id),
-                 self._encode_doc(doc, check_keys),),
+                self._table,
+                self._record(doc, check_keys),
                 self.wconcern
             )
         except sqlite3.IntegrityError:
             raise StorageDuplicateKeyError()
 
-        return _id
+        return doc["_id"]
 
     @_ensure_table
     def write_many(self, docs, check_keys=True, ordered=True):
         """
         """
-        _docs = OrderedDict()
         ids = list()
-        keys = self._conn.read_all_keys(self._col_path)
-        has_duplicated_key = False
-        for doc in docs:
-            _id = doc["_id"]
-            b_id = bson.id_encode(_id)
-            if b_id in keys or b_id in _docs:
-                has_duplicated_key = True
-                break
 
-            _docs[b_id] = self._encode_doc(doc, check_keys)
-            ids.append(_id)
+        def produce_records():
+            for doc in docs:
+                yield self._record(doc, check_keys)
+                ids.append(doc["_id"])
 
-        self._conn.write_many(
-            self._col_path,
-            _docs.items(),
-            self.wconcern
-        )
-
-        if has_duplicated_key:
+        try:
+            self._conn.write_many(
+                self._table,
+                produce_records(),
+                self.wconcern
+            )
+        except sqlite3.IntegrityError:
             raise StorageDuplicateKeyError()
 
         return ids
@@ -381,36 +1489,72 @@ class SQLiteCollection(AbstractCollection):
     def update_one(self, doc):
         """
         """
-        self._conn.update_one(
-            self._col_path,
-            (self._encode_doc(doc), bson.id_encode(doc["_id"])),
-            self.wconcern
-        )
+        try:
+            self._conn.update_one(
+                self._table,
+                self._record(doc),
+                self.wconcern
+            )
+        except sqlite3.IntegrityError:
+            raise StorageDuplicateKeyError()
 
     def update_many(self, docs):
         """
         """
-        self._conn.update_many(
-            self._col_path,
-            [(self._encode_doc(doc), bson.id_encode(doc["_id"]))
-             for doc in docs],
-            self.wconcern
-        )
+        try:
+            self._conn.update_many(
+                self._table,
+                [self._record(doc) for doc in docs],
+                self.wconcern
+            )
+        except sqlite3.IntegrityError:
+            raise StorageDuplicateKeyError()
 
     def delete_one(self, id):
         self._conn.delete_one(
-            self._col_path,
-            (bson.id_encode(id),),
+            self._table,
+            _blob(keystring.encode(id)),
             self.wconcern
         )
 
     def delete_many(self, ids):
         self._conn.delete_many(
-            self._col_path,
-            [(bson.id_encode(id),) for id in ids],
+            self._table,
+            [_blob(keystring.encode(id)) for id in ids],
             self.wconcern
         )
 
+    def list_indexes(self):
+        return [index.document for index in
+                self._conn.list_indexes(self._table, self.wconcern)]
+
+    @_ensure_table
+    def create_index(self, name, keys, unique=False):
+        """Create secondary index and index existing documents
+
+        Args:
+            name (str): Index name.
+            keys (list): List of (field, direction) pairs.
+            unique (bool): Reject documents that have duplicated keys.
+
+        """
+        def decode(encoded):
+            return bson.document_decode(_unblob(encoded),
+                                        codec_options=self.coptions)
+
+        try:
+            self._conn.create_index(
+                self._table,
+                SQLiteIndex(name, keys, unique, self._table.prefix),
+                decode,
+                self.wconcern
+            )
+        except sqlite3.IntegrityError:
+            raise StorageDuplicateKeyError()
+
+    def drop_index(self, name):
+        self._conn.drop_index(self._table, name, self.wconcern)
+
 
 SQLiteDatabase.contractor_cls = SQLiteCollection
 
@@ -419,18 +1563,38 @@ class SQLiteCursor(AbstractCursor):
 
     def __init__(self, collection, subject):
         super(SQLiteCursor, self).__init__(collection, subject)
+        self._spec = subject._spec
 
     @property
     def _conn(self):
         return self._collection._conn
 
     @property
-    def _col_path(self):
-        return self._collection._col_path
+    def _table(self):
+        return self._collection._table
 
     def query(self, max_scan):
-        docs = self._conn.read_all(self._col_path, max_scan)
-        return (self._decode_doc(doc[0]) for doc in docs)
+        # Documents scanned should not be reduced when `max_scan` is set.
+        spec = None if max_scan else self._spec
+        docs = self._conn.read_all(self._table,
+                                   max_scan,
+                                   self._collection.wconcern,
+                                   spec)
+        return (self._decode_doc(_unblob(doc[0])) for doc in docs)
+
+    def query_ids(self, keys):
+        docs = self._conn.read_keys(self._table,
+                                    keys,
+                                    self._collection.wconcern)
+        return [self._decode_doc(_unblob(doc[0])) for doc in docs]
+
+    def query_ordered(self, reverse=False):
+        docs = self._conn.read_all(self._table,
+                                   0,
+                                   self._collection.wconcern,
+                                   self._spec,
+                                   -1 if reverse else 1)
+        return (self._decode_doc(_unblob(doc[0])) for doc in docs)
 
 
 SQLiteCollection.contractor_cls = SQLiteCursor
@@ -18,6 +18,7 @@ from .helper import (
     RE_PATTERN_TYPE,
     to_bytes,
     compare_documents,
+    copy_document,
     is_duckument_type,
     is_integer_type,
     is_numeric_type,
@@ -48,6 +49,7 @@ __all__ = [
     "RE_PATTERN_TYPE",
     "to_bytes",
     "compare_documents",
+    "copy_document",
     "is_duckument_type",
     "is_integer_type",
     "is_numeric_type",
@@ -1,6 +1,12 @@
 from __future__ import absolute_import
 import types
 
+try:
+    from bson import decode as _decode_buffer
+except ImportError:
+    # pymongo < 3.9
+    _decode_buffer = None
+
 
 class BSON_(types.ModuleType):
 
@@ -61,6 +67,11 @@ class BSON_(types.ModuleType):
 
     @classmethod
     def document_decode(cls, doc, codec_options=DEFAULT_CODEC_OPTIONS):
+        if not isinstance(doc, bytes):
+            if _decode_buffer is not None:
+                # Buffer (e.g. memoryview), decode it without copying to bytes
+                return _decode_buffer(doc, codec_options)
+            doc = bytes(doc)
         return cls.BSON(doc).decode(codec_options)
 
     @classmethod
@@ -24,6 +24,7 @@ def _mock(name):
 
 class NoBSON(types.ModuleType):
     import re
+    import codecs
     import datetime
     import calendar
     from collections import OrderedDict
@@ -192,6 +193,10 @@ class NoBSON(types.ModuleType):
     def document_decode(cls, serialized, codec_options=None, *args, **kwargs):
         from json import loads as _loads
 
+        if not isinstance(serialized, (bytes, cls._string_types)):
+            # Buffer (e.g. memoryview), decode it without copying to bytes
+            serialized = cls.codecs.decode(serialized, "utf-8")
+
         opts = codec_options or cls.DEFAULT_CODEC_OPTIONS
         dcls = opts.document_class
         return _loads(
@@ -53,6 +53,26 @@ def compare_documents(this, that):
         return _compare_doc_in_strict_order(this, that)
 
 
+def copy_document(doc):
+    """Return a copy of `doc` that shares no mutable value with it
+
+    Much cheaper than `copy.deepcopy` for decoded documents, which only
+    contain mappings, lists and immutable values. Tuples are copied into
+    lists, as they would be decoded.
+
+    """
+    if isinstance(doc, dict):
+        new_doc = doc.__class__()
+        for key, value in doc.items():
+            new_doc[key] = copy_document(value)
+        return new_doc
+    if isinstance(doc, (list, tuple)):
+        return [copy_document(value) for value in doc]
+    if bson.bson_used and isinstance(doc, bson.Code) and doc.scope is not None:
+        return bson.Code(doc, copy_document(doc.scope))
+    return doc
+
+
 def is_duckument_type(obj):
     """Internal mapping type checker
 
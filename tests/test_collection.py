@@ -12,6 +12,7 @@ from pymongo.errors import (
 from montydb.errors import (
     DuplicateKeyError as monty_dup_key_err,
     BulkWriteError as monty_bulkw_err,
+    WriteError as monty_write_err,
 )
 
 
@@ -100,6 +101,27 @@ def test_collection_find_one_with_id(monty_collection):
     assert result["qty"] == 7
 
 
+def test_collection_find_by_id_lookup(monty_collection):
+    monty_collection.insert_many([
+        {"_id": "b", "qty": 1},
+        {"_id": 2, "qty": 2},
+        {"_id": "a", "qty": 3},
+        {"_id": 1.5, "qty": 4},
+    ])
+    result = monty_collection.find({"_id": {"$in": ["a", 2.0, "b", "z"]}})
+    assert [doc["qty"] for doc in result] == [2, 3, 1]
+
+    assert monty_collection.count_documents({"_id": {"$eq": 2}}) == 1
+    assert monty_collection.count_documents({"_id": {"$in": []}}) == 0
+    assert monty_collection.count_documents(
+        {"_id": {"$in": ["a", "b"], "$ne": "a"}}) == 1
+
+    monty_collection.update_one({"_id": 1.5}, {"$set": {"qty": 5}})
+    assert monty_collection.find_one({"_id": 1.5})["qty"] == 5
+    monty_collection.delete_many({"_id": {"$in": ["a", "b"]}})
+    assert monty_collection.count_documents({}) == 2
+
+
 def test_collection_get_collection(monty_collection):
     sub_col = monty_collection.sub_col
     assert sub_col.name == "test_col.sub_col"
@@ -188,3 +210,42 @@ def test_collection_count_documents(monty_collection, mongo_collection):
     mongo_res = mongo_collection.count_documents({"a": 1})
 
     assert monty_res == mongo_res
+
+
+def test_collection_insert_array_id(monty_collection, mongo_collection):
+    docs = [{"_id": 1}, {"_id": [2, 3]}, {"_id": 4}]
+
+    with pytest.raises(mongo_bulkw_err) as mongo_err:
+        mongo_collection.insert_many(docs)
+
+    with pytest.raises(monty_bulkw_err) as monty_err:
+        monty_collection.insert_many(docs)
+
+    assert mongo_err.value.details["nInserted"] == monty_err.value.details["nInserted"]
+    assert monty_err.value.details["writeErrors"][0]["code"] == 2
+
+    with pytest.raises(monty_write_err):
+        monty_collection.insert_one({"_id": [5]})
+
+    assert count_documents(monty_collection.find()) == 1
+
+
+def test_collection_insert_many_stops_at_array_id(monty_collection):
+    docs = [{"_id": 0}, {"_id": 1}, {"_id": [2]}, {"_id": 3}]
+
+    with pytest.raises(monty_bulkw_err) as monty_err:
+        monty_collection.insert_many(docs)
+
+    assert monty_err.value.details["nInserted"] == 2
+    assert [doc["_id"] for doc in monty_collection.find()] == [0, 1]
+
+
+def test_collection_insert_equal_number_id(monty_collection, mongo_collection):
+    mongo_collection.insert_one({"_id": 1})
+    monty_collection.insert_one({"_id": 1})
+
+    with pytest.raises(mongo_dup_key_err):
+        mongo_collection.insert_one({"_id": 1.0})
+
+    with pytest.raises(monty_dup_key_err):
+        monty_collection.insert_one({"_id": 1.0})
@@ -1,8 +1,11 @@
 
 import pytest
 
-from montydb.errors import OperationFailure
+from montydb.errors import DuplicateKeyError, OperationFailure
 from montydb.cursor import MontyCursor
+from montydb.types import bson
+
+from .conftest import skip_if_no_bson
 
 
 @pytest.fixture
@@ -147,3 +150,46 @@ def test_cursor_rewind(monty_collection):
         assert next(cur)["doc"] == 1
         cur.rewind()
         assert next(cur)["doc"] == 0
+
+
+def test_cursor_sort_by_id_streamed(monty_database, monkeypatch):
+    monty_database.drop_collection("for_cursor_test")
+    col = monty_database.for_cursor_test
+    ids = [3, "b", -1.5, 2 ** 60 + 1, "a", 2 ** 60, None, {"a": 1}]
+    col.insert_many([{"_id": id} for id in ids])
+
+    def no_ordering(*args, **kwargs):
+        raise AssertionError("Documents should be sorted by storage.")
+
+    monkeypatch.setattr("montydb.cursor.ordering", no_ordering)
+
+    expected = [None, -1.5, 3, 2 ** 60, 2 ** 60 + 1, "a", "b", {"a": 1}]
+    assert [doc["_id"] for doc in col.find().sort("_id", 1)] == expected
+    assert [doc["_id"] for doc in col.find().sort("_id", -1)] == \
+        expected[::-1]
+
+    cur = col.find({"_id": {"$gt": 0}}).sort([("_id", -1), ("x", 1)])
+    assert [doc["_id"] for doc in cur.limit(2)] == [2 ** 60 + 1, 2 ** 60]
+    cur = col.find({"_id": {"$gte": "a", "$lt": "b"}}).sort("_id", 1)
+    assert [doc["_id"] for doc in cur] == ["a"]
+    cur = col.find({"_id": {"$in": ["b", 3, "a"]}}).sort("_id", -1)
+    assert [doc["_id"] for doc in cur.skip(1)] == ["a", 3]
+
+
+@skip_if_no_bson
+def test_cursor_sort_by_decimal_id_beyond_double(monty_database):
+    monty_database.drop_collection("for_cursor_test")
+    col = monty_database.for_cursor_test
+    D = bson.Decimal128
+    ids = [D("Infinity"), D("2E+400"), D("-1E-400"), 0, D("1E-400"),
+           D("1E+400"), D("-1E+400"), 1.7976931348623157e308]
+    col.insert_many([{"_id": id} for id in ids])
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": D("10E-401")})
+
+    expected = [D("-1E+400"), D("-1E-400"), 0, D("1E-400"),
+                1.7976931348623157e308, D("1E+400"), D("2E+400"),
+                D("Infinity")]
+    assert [doc["_id"] for doc in col.find().sort("_id", 1)] == expected
+    assert [doc["_id"] for doc in col.find({"_id": D("1E+400")})] == \
+        [D("1E+400")]
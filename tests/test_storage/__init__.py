@@ -0,0 +1 @@
+# For pytest-cov working on travis-ci
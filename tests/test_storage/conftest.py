@@ -0,0 +1,42 @@
+import os
+import pytest
+import shutil
+
+import montydb
+
+from ..conftest import set_bson
+
+
+@pytest.fixture
+def storage_repo(tmp_monty_repo):
+    tmp_dir = os.path.join(tmp_monty_repo, "monty.storage")
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    yield tmp_dir
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+
+@pytest.fixture
+def make_client(storage_repo, use_bson):
+    set_bson(use_bson)
+    clients = []
+
+    def _make_client(storage, **storage_kwargs):
+        repository = ":memory:" if storage == "memory" else storage_repo
+        montydb.set_storage(repository,
+                            storage,
+                            use_bson=use_bson,
+                            **storage_kwargs)
+        client = montydb.MontyClient(repository)
+        clients.append(client)
+        return client
+
+    yield _make_client
+
+    for client in clients:
+        if client.address == ":memory:":
+            for db in client.list_database_names():
+                client.drop_database(db)
+            montydb.set_storage(":memory:", "memory", use_bson=use_bson)
+        client.close()
@@ -0,0 +1,291 @@
+import os
+import time
+import pytest
+import montydb
+import threading
+
+from montydb.types import bson
+from montydb.storage import flatfile
+from montydb.storage.flatfile import (
+    FLATFILE_DB_EXT,
+    FLATFILE_JOURNAL_EXT,
+    FlatFileKVEngine,
+)
+
+
+def engine_db_file(client, db_name, col_name):
+    return os.path.join(client.address, db_name, col_name) + FLATFILE_DB_EXT
+
+
+def read_lines(file_path):
+    with open(file_path, "r") as fp:
+        return fp.readlines()
+
+
+def test_flatfile_journal_append(make_client):
+    client = make_client("flatfile", journal=True)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": 0} for i in range(5)])
+    col.update_one({"_id": 1}, {"$set": {"a": 1}})
+    col.delete_one({"_id": 2})
+
+    db_file = engine_db_file(client, "db", "col")
+    assert read_lines(db_file) == []
+    assert len(read_lines(db_file + FLATFILE_JOURNAL_EXT)) == 7
+    assert client.db.list_collection_names() == ["col"]
+
+    # Opened by other client before the journal is folded
+    other = montydb.MontyClient(client.address)
+    docs = list(other.db.col.find())
+    assert docs == [{"_id": 0, "a": 0},
+                    {"_id": 1, "a": 1},
+                    {"_id": 3, "a": 0},
+                    {"_id": 4, "a": 0}]
+
+
+def test_flatfile_journal_compact(make_client):
+    client = make_client("flatfile", journal=True, journal_limit=5)
+    col = client.db.col
+    for i in range(8):
+        col.insert_one({"_id": i})
+
+    db_file = engine_db_file(client, "db", "col")
+    journal_file = db_file + FLATFILE_JOURNAL_EXT
+    # Folded once after the 6th record
+    assert len(read_lines(journal_file)) == 2
+    assert len(read_lines(db_file)) == 8
+
+    col.delete_many({"_id": {"$gt": 3}})
+    client.close()
+    assert not os.path.isfile(journal_file)
+    assert col.count_documents({}) == 4
+
+
+def test_flatfile_journal_interrupted(make_client):
+    client = make_client("flatfile", journal=True)
+    col = client.db.col
+    col.insert_many([{"_id": 0}, {"_id": 1}])
+
+    journal_file = engine_db_file(client, "db", "col") + FLATFILE_JOURNAL_EXT
+    with open(journal_file, "a") as fp:
+        fp.write('{"put": {"_id": 2')
+
+    other = montydb.MontyClient(client.address)
+    assert other.db.col.count_documents({}) == 2
+
+    col.insert_one({"_id": 3})
+    other = montydb.MontyClient(client.address)
+    assert [doc["_id"] for doc in other.db.col.find()] == [0, 1, 3]
+
+
+def test_flatfile_journal_utf8(make_client):
+    client = make_client("flatfile", journal=True)
+    col = client.db.col
+    col.insert_many([{"_id": 0, "s": u"\u00e9\u4e2d"}, {"_id": 1}])
+
+    journal_file = engine_db_file(client, "db", "col") + FLATFILE_JOURNAL_EXT
+    with open(journal_file, "ab") as fp:
+        # Interrupted in the middle of a character
+        fp.write(u'{"put": {"_id": 2, "s": "\u4e2d'.encode("utf-8")[:-1])
+
+    other = montydb.MontyClient(client.address)
+    assert list(other.db.col.find()) == [{"_id": 0, "s": u"\u00e9\u4e2d"},
+                                         {"_id": 1}]
+
+
+def test_flatfile_journal_compact_unloaded(make_client):
+    client = make_client("flatfile", journal=True, memory_budget=100)
+    client.db.a.insert_many([{"_id": i} for i in range(2)])
+    client.db.b.insert_one({"_id": 0, "s": "b" * 100})
+    client.db.b.find_one()
+
+    engines = client._storage._cache_manager["db"]
+    assert not engines["a"].is_loaded
+    journal_file = engine_db_file(client, "db", "a") + FLATFILE_JOURNAL_EXT
+    assert os.path.isfile(journal_file)
+
+    client.close()
+    assert not os.path.isfile(journal_file)
+    assert len(read_lines(engine_db_file(client, "db", "a"))) == 4
+
+
+def test_flatfile_journal_write_failed(make_client, monkeypatch):
+    client = make_client("flatfile", journal=True, cache_modified=100)
+    col = client.db.col
+    col.insert_many([{"_id": 0}, {"_id": 1}])
+    engine = client._storage._cache_manager["db"]["col"]
+    write_journal = flatfile._write_journal
+
+    def fail(*args):
+        raise IOError("Disk full.")
+
+    monkeypatch.setattr(flatfile, "_write_journal", fail)
+    with pytest.raises(IOError):
+        engine.flush()
+    col.update_one({"_id": 1}, {"$set": {"a": 1}})
+    assert engine.modified_count == 3
+
+    # Failed changes are kept and written with the newer one
+    monkeypatch.setattr(flatfile, "_write_journal", write_journal)
+    engine.flush()
+    other = montydb.MontyClient(client.address)
+    assert list(other.db.col.find()) == [{"_id": 0}, {"_id": 1, "a": 1}]
+
+
+def test_flatfile_load_line_by_line(make_client, monkeypatch):
+    client = make_client("flatfile")
+    col = client.db.col
+    col.insert_many([{"_id": i, "s": "a,\n]"} for i in range(3)])
+
+    def read_json(file_path):
+        raise AssertionError("Should not read the whole file.")
+
+    monkeypatch.setattr(flatfile, "_read_json", read_json)
+    other = montydb.MontyClient(client.address)
+    assert list(other.db.col.find()) == [{"_id": i, "s": "a,\n]"}
+                                         for i in range(3)]
+
+
+def test_flatfile_load_other_layout(make_client):
+    client = make_client("flatfile")
+    client.db.create_collection("col")
+
+    db_file = engine_db_file(client, "db", "col")
+    with open(db_file, "w") as fp:
+        fp.write('[{"_id": 0},\n  {"_id": 1,\n   "a": [1,\n 2]}]')
+
+    assert list(client.db.col.find()) == [{"_id": 0}, {"_id": 1, "a": [1, 2]}]
+
+
+def test_flatfile_flush_in_background(make_client, monkeypatch):
+    flushed_by = set()
+    write_pretty = flatfile._write_pretty
+
+    def record_thread(*args):
+        flushed_by.add(threading.current_thread().name)
+        write_pretty(*args)
+
+    monkeypatch.setattr(flatfile, "_write_pretty", record_thread)
+    client = make_client("flatfile", flush_interval=0.01, cache_modified=100)
+    col = client.db.col
+    col.insert_many([{"_id": i} for i in range(3)])
+
+    db_file = engine_db_file(client, "db", "col")
+    for _ in range(100):
+        if len(read_lines(db_file)) == 5:
+            break
+        time.sleep(0.01)
+    assert len(read_lines(db_file)) == 5
+    assert flushed_by == set(["montydb-flatfile-flusher"])
+
+    col.insert_one({"_id": 3})
+    client.close()
+    assert len(read_lines(db_file)) == 6
+
+
+def test_flatfile_write_while_flushing(make_client):
+    client = make_client("flatfile", flush_interval=0.001)
+    errors = []
+
+    def work(n):
+        try:
+            col = client.db.col
+            for i in range(50):
+                col.insert_one({"_id": "%d-%d" % (n, i)})
+                col.update_one({"_id": "%d-%d" % (n, i)}, {"$set": {"a": 1}})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    client.db.other.insert_one({"_id": 0})
+    client.db.drop_collection("other")
+    client.close()
+
+    assert errors == []
+    other = montydb.MontyClient(client.address)
+    assert other.db.col.count_documents({"a": 1}) == 200
+    assert other.db.list_collection_names() == ["col"]
+
+
+def test_flatfile_write_failed_keeps_file(make_client):
+    client = make_client("flatfile")
+    client.db.col.insert_many([{"_id": 0}, {"_id": 1}])
+    db_file = engine_db_file(client, "db", "col")
+    written = read_lines(db_file)
+
+    class Documents(object):
+        def values(self):
+            yield bson.document_encode({"_id": 2})
+            raise IOError("Disk full.")
+
+    with pytest.raises(IOError):
+        flatfile._write_pretty(db_file, Documents())
+    assert read_lines(db_file) == written
+    assert os.listdir(os.path.dirname(db_file)) == ["col" + FLATFILE_DB_EXT]
+
+
+def test_flatfile_load_on_first_use(make_client):
+    client = make_client("flatfile")
+    client.db.col.insert_one({"_id": 0})
+    client.close()
+
+    engine = FlatFileKVEngine(engine_db_file(client, "db", "col"),
+                              client._storage._config)
+    assert not engine.is_loaded
+    assert engine.document_count == 1
+    assert engine.is_loaded
+
+
+def test_flatfile_unload_over_memory_budget(make_client):
+    client = make_client("flatfile", cache_modified=100, memory_budget=100)
+    client.db.a.insert_many([{"_id": i} for i in range(2)])
+    client.db.b.insert_one({"_id": 0, "s": "b" * 100})
+
+    engines = client._storage._cache_manager["db"]
+    assert engines["a"].is_loaded
+    client.db.b.find_one()
+    # Over budget, the least recently used is flushed and unloaded
+    assert not engines["a"].is_loaded
+    assert len(read_lines(engine_db_file(client, "db", "a"))) == 4
+    assert engines["b"].is_loaded
+
+    client.db.b.delete_one({"_id": 0})
+    assert client.db.a.count_documents({}) == 2
+    client.db.b.find_one()
+    # Within budget
+    assert engines["a"].is_loaded
+
+
+@pytest.mark.parametrize("compression", ["gzip", "lzma"])
+def test_flatfile_compression(make_client, compression):
+    client = make_client("flatfile", compression=compression)
+    col = client.db.col
+    col.insert_many([{"_id": i, "s": "x" * 100} for i in range(100)])
+
+    db_file = engine_db_file(client, "db", "col")
+    assert os.path.getsize(db_file) < 100 * 100
+
+    other = montydb.MontyClient(client.address)
+    assert other.db.col.count_documents({"s": "x" * 100}) == 100
+
+
+def test_flatfile_compression_changed(make_client):
+    client = make_client("flatfile")
+    client.db.col.insert_one({"_id": 0})
+    client.close()
+
+    # Written in plain, read and then written in gzip
+    other = make_client("flatfile", compression="gzip")
+    other.db.col.insert_one({"_id": 1})
+    with open(engine_db_file(client, "db", "col"), "rb") as fp:
+        assert fp.read(2) == b"\x1f\x8b"
+
+    other = make_client("flatfile")
+    assert [doc["_id"] for doc in other.db.col.find()] == [0, 1]
+
+    with pytest.raises(ValueError):
+        make_client("flatfile", compression="zip")
@@ -0,0 +1,403 @@
+import os
+import lmdb
+import pytest
+import threading
+
+from montydb.errors import DuplicateKeyError, OperationFailure
+from montydb.types import bson
+from montydb.storage import lightning, keystring
+from montydb.storage.lightning import (
+    LMDB_DB_EXT,
+    LMDB_LOCK_EXT,
+    LMDB_MAX_DBS,
+    LMDB_MAX_INDEXES,
+    LMDB_META_DB,
+    LMDB_INDEX_FORMAT,
+    LMDBIndex,
+    environments,
+)
+
+
+def engine_db_file(client, db_name, col_name):
+    return os.path.join(client.address, db_name, col_name) + LMDB_DB_EXT
+
+
+def test_lightning_environment_reused(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+
+    db_file = engine_db_file(client, "db", "col")
+    first = environments._envs[db_file]
+
+    col.insert_many([{"_id": 1}, {"_id": 2}])
+    col.update_many({}, {"$set": {"a": 1}})
+    col.delete_one({"_id": 2})
+    assert list(col.find({"a": 1})) == [{"_id": 0, "a": 1}, {"_id": 1, "a": 1}]
+
+    assert environments._envs[db_file] is first
+
+
+def test_lightning_collections_in_threads(make_client):
+    client = make_client("lightning")
+    errors = []
+
+    def work(n):
+        try:
+            for i in range(20):
+                # alternate between collections in every thread
+                for name in ("a", "b"):
+                    col = client.db[name]
+                    col.insert_one({"_id": "%d-%d" % (n, i)})
+                    col.update_one({"_id": "%d-%d" % (n, i)},
+                                   {"$set": {"name": name}})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for name in ("a", "b"):
+        col = client.db[name]
+        assert col.count_documents({"name": name}) == 80
+
+
+def test_lightning_close_and_reopen(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+    client.close()
+    db_file = engine_db_file(client, "db", "col")
+    assert db_file not in environments._envs
+
+    col.insert_one({"_id": 1})
+    assert col.count_documents({}) == 2
+
+
+def test_lightning_drop_collection(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+    client.db.drop_collection("col")
+
+    db_file = engine_db_file(client, "db", "col")
+    assert not os.path.isfile(db_file)
+    assert not os.path.isfile(db_file + LMDB_LOCK_EXT)
+    assert client.db.list_collection_names() == []
+
+    col.insert_one({"_id": 1})
+    assert list(col.find()) == [{"_id": 1}]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Require os.fork.")
+def test_lightning_environment_after_fork(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            col.insert_one({"_id": 1})
+            if col.count_documents({}) == 2:
+                code = 0
+        finally:
+            os._exit(code)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WEXITSTATUS(status) == 0
+    assert col.count_documents({}) == 2
+
+
+def test_lightning_map_grows_when_full(make_client):
+    client = make_client("lightning", map_size=65536)
+    col = client.db.col
+    docs = [{"_id": i, "data": "x" * 1024} for i in range(200)]
+    col.insert_many(docs)
+    col.update_many({}, {"$set": {"more": "y" * 1024}})
+
+    assert col.count_documents({}) == 200
+    assert client._storage.map_resize_count > 0
+
+
+def test_lightning_map_growth_ceiling(make_client):
+    client = make_client("lightning", map_size=65536, max_map_size=131072)
+    col = client.db.col
+    with pytest.raises(lmdb.MapFullError):
+        for i in range(200):
+            col.insert_one({"_id": i, "data": "x" * 1024})
+
+    assert client._storage.map_resize_count == 1
+    assert 0 < col.count_documents({}) < 200
+
+
+def test_lightning_scan_in_batches(make_client, monkeypatch):
+    monkeypatch.setattr(lightning, "LMDB_SCAN_BATCH", 3)
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 2} for i in range(10)])
+
+    assert sorted(doc["_id"] for doc in col.find({"a": 1})) == [1, 3, 5, 7, 9]
+
+    # writes between batches
+    for doc in col.find():
+        col.delete_one({"_id": doc["_id"]})
+    assert col.count_documents({}) == 0
+
+
+def test_lightning_index_create_list_drop(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 3, "b": str(i)} for i in range(9)])
+
+    assert col.create_index("a") == "a_1"
+    assert col.create_index([("a", 1), ("b", -1)]) == "a_1_b_-1"
+    assert col.create_index("a") == "a_1"
+
+    info = col.index_information()
+    assert sorted(info) == ["_id_", "a_1", "a_1_b_-1"]
+    assert info["a_1_b_-1"]["key"] == [("a", 1), ("b", -1)]
+
+    col.drop_index("a_1")
+    assert sorted(col.index_information()) == ["_id_", "a_1_b_-1"]
+    assert col.count_documents({"a": 1}) == 3
+
+    client.close()
+    assert sorted(col.index_information()) == ["_id_", "a_1_b_-1"]
+    col.drop_indexes()
+    assert sorted(col.index_information()) == ["_id_"]
+
+
+def test_lightning_index_unique(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_many([{"_id": 0, "a": 1}, {"_id": 1, "a": 1}])
+
+    with pytest.raises(DuplicateKeyError):
+        col.create_index("a", unique=True)
+    assert sorted(col.index_information()) == ["_id_"]
+
+    col.update_one({"_id": 1}, {"$set": {"a": 2}})
+    col.create_index("a", unique=True)
+
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": 2, "a": 2.0})
+    assert col.count_documents({}) == 2
+
+    with pytest.raises(DuplicateKeyError):
+        col.update_one({"_id": 0}, {"$set": {"a": 2}})
+    assert col.find_one({"_id": 0})["a"] == 1
+
+    # Keys longer than LMDB key size are compared in full
+    col.insert_one({"_id": 3, "a": "x" * 1000 + "a"})
+    col.insert_one({"_id": 4, "a": "x" * 1000 + "b"})
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": 5, "a": "x" * 1000 + "b"})
+
+
+def test_lightning_index_unique_exact(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.create_index("a", unique=True)
+
+    # Rounded to the same double, but not equal
+    col.insert_one({"_id": 0, "a": 2 ** 53})
+    col.insert_one({"_id": 1, "a": 2 ** 53 + 1})
+    col.insert_one({"_id": 2, "a": {"b": 1}})
+    col.insert_one({"_id": 3, "a": {"b": 2}})
+    if bson.bson_used:
+        col.insert_one({"_id": 4, "a": bson.Decimal128("1.00000000000000000001")})
+        col.insert_one({"_id": 5, "a": bson.Decimal128("1.00000000000000000002")})
+        with pytest.raises(DuplicateKeyError):
+            col.insert_one({"_id": 6, "a": bson.Decimal128("9007199254740993")})
+
+    with pytest.raises(DuplicateKeyError) as exc:
+        col.insert_one({"_id": 7, "a": 2.0 ** 53})
+    assert "index: a_1" in str(exc.value)
+    assert [doc["_id"] for doc in col.find({"a": 2 ** 53 + 1})] == [1]
+    assert [doc["_id"] for doc in col.find({"a": {"$gt": 2 ** 53}})] == [1]
+
+    if bson.bson_used:
+        # Rounded to zero or infinity
+        col.insert_one({"_id": 20, "a": bson.Decimal128("1E-400")})
+        col.insert_one({"_id": 21, "a": 0})
+        col.insert_one({"_id": 22, "a": bson.Decimal128("1E+400")})
+        col.insert_one({"_id": 23, "a": bson.Decimal128("2E+400")})
+        col.insert_one({"_id": 24, "a": bson.Decimal128("Infinity")})
+        with pytest.raises(DuplicateKeyError):
+            col.insert_one({"_id": 25, "a": bson.Decimal128("10E-401")})
+
+
+def test_lightning_index_query(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.create_index("a")
+    col.create_index("b.c")
+    col.insert_many([
+        {"_id": 0, "a": 1, "b": {"c": "x"}},
+        {"_id": 1, "a": [0, 5], "b": [{"c": "y"}, {"c": "z"}]},
+        {"_id": 2, "a": "1"},
+        {"_id": 3, "a": None},
+        {"_id": 4, "a": 2.5},
+        {"_id": 5, "a": "x" * 1000},
+    ])
+
+    def find_ids(spec):
+        return sorted(doc["_id"] for doc in col.find(spec))
+
+    assert find_ids({"a": 1}) == [0]
+    assert find_ids({"a": {"$in": [0, "1"]}}) == [1, 2]
+    # Multikey, each element could match on different bound
+    assert find_ids({"a": {"$gt": 1, "$lt": 3}}) == [1, 4]
+    assert find_ids({"a": {"$lte": 0}}) == [1]
+    assert find_ids({"a": None}) == [3]
+    assert find_ids({"a": {"$gte": "1"}}) == [2, 5]
+    assert find_ids({"a": "x" * 1000}) == [5]
+    assert find_ids({"b.c": {"$gte": "y"}}) == [1]
+
+    col.update_one({"_id": 4}, {"$set": {"a": 1}})
+    col.delete_one({"_id": 0})
+    assert find_ids({"a": 1}) == [4]
+
+
+def test_lightning_index_query_null_as_scan(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_many([
+        {"_id": 0, "a": [{"b": 1}, {"c": 2}]},
+        {"_id": 1, "a": [{"b": 1}]},
+        {"_id": 2, "a": {"b": None}},
+        {"_id": 3},
+        {"_id": 4, "a": [{"b": [None]}]},
+    ])
+    specs = [
+        {"a.b": None},
+        {"a.b": {"$in": [None, 1]}},
+        {"a.b": {"$eq": None}},
+        {"a.b": {"$gte": None}},
+        {"a.b": 1},
+    ]
+
+    def find_ids(spec):
+        return sorted(doc["_id"] for doc in col.find(spec))
+
+    scanned = [find_ids(spec) for spec in specs]
+    col.create_index("a.b")
+    assert [find_ids(spec) for spec in specs] == scanned
+
+
+def test_lightning_index_too_many(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+    for i in range(LMDB_MAX_INDEXES):
+        col.create_index("f%d" % i)
+
+    with pytest.raises(OperationFailure) as exc:
+        col.create_index("g")
+    assert "too many indexes" in str(exc.value)
+    assert len(col.index_information()) == LMDB_MAX_INDEXES + 1
+
+    col.drop_index("f0_1")
+    col.create_index("g")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Require os.fork.")
+def test_lightning_index_created_by_other_process(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_one({"_id": 0, "a": 1})
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            col.create_index("a")
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    col.insert_one({"_id": 1, "a": 1})
+    assert sorted(col.index_information()) == ["_id_", "a_1"]
+    assert col.count_documents({"a": 1}) == 2
+
+
+def test_lightning_migrate_keys(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.create_index("a")
+    ids = [10, 2, "x", -1]
+    col.insert_many([{"_id": id, "a": i % 2} for i, id in enumerate(ids)])
+    client.close()
+
+    # Downgrade to keys that encoded by `bson.id_encode`, without format
+    keys = dict((keystring.encode(id), bson.id_encode(id)) for id in ids)
+    env = lmdb.open(engine_db_file(client, "db", "col"),
+                    subdir=False,
+                    max_dbs=LMDB_MAX_DBS)
+    docs_db = env.open_db(b"documents")
+    index_db = env.open_db(LMDBIndex("a_1", [("a", 1)]).dbname, dupsort=True)
+    meta_db = env.open_db(LMDB_META_DB)
+    with env.begin(write=True) as txn:
+        docs = list(txn.cursor(db=docs_db))
+        entries = list(txn.cursor(db=index_db))
+        txn.drop(docs_db, delete=False)
+        txn.drop(index_db, delete=False)
+        for key, value in docs:
+            txn.put(keys[key], value, db=docs_db)
+        for key, value in entries:
+            txn.put(key, keys[value], db=index_db)
+        txn.drop(meta_db, delete=False)
+    env.close()
+
+    assert [doc["_id"] for doc in col.find().sort("_id", -1)] == \
+        ["x", 10, 2, -1]
+    assert [doc["_id"] for doc in col.find({"a": 1})] == [-1, 2]
+    col.delete_one({"_id": 2})
+    assert [doc["_id"] for doc in col.find({"a": 1})] == [-1]
+
+
+def test_lightning_migrate_index_keys(make_client):
+    client = make_client("lightning")
+    col = client.db.col
+    col.create_index("a", unique=True)
+    col.insert_many([{"_id": i, "a": i} for i in range(3)])
+    client.close()
+
+    # Downgrade to entries in other format, without index format
+    env = lmdb.open(engine_db_file(client, "db", "col"),
+                    subdir=False,
+                    max_dbs=LMDB_MAX_DBS)
+    index_db = env.open_db(LMDBIndex("a_1", [("a", 1)]).dbname, dupsort=True)
+    meta_db = env.open_db(LMDB_META_DB)
+    with env.begin(write=True) as txn:
+        entries = list(txn.cursor(db=index_db))
+        txn.drop(index_db, delete=False)
+        for key, value in entries:
+            txn.put(b"\x10" + key, value, db=index_db)
+        txn.delete(LMDB_INDEX_FORMAT, db=meta_db)
+    env.close()
+
+    assert [doc["_id"] for doc in col.find({"a": {"$gte": 1}})] == [1, 2]
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": 3, "a": 2})
+
+
+def test_lightning_scan_id_range(make_client, monkeypatch):
+    monkeypatch.setattr(lightning, "LMDB_SCAN_BATCH", 3)
+    client = make_client("lightning")
+    col = client.db.col
+    col.insert_many([{"_id": i} for i in range(10)]
+                    + [{"_id": str(i)} for i in range(10)])
+
+    def find_ids(spec, direction):
+        return [doc["_id"] for doc in col.find(spec).sort("_id", direction)]
+
+    assert find_ids({"_id": {"$gte": 3, "$lt": 8}}, 1) == [3, 4, 5, 6, 7]
+    assert find_ids({"_id": {"$gt": 3, "$lte": 8}}, -1) == [8, 7, 6, 5, 4]
+    assert find_ids({"_id": {"$gt": "7"}}, -1) == ["9", "8"]
+    assert find_ids({"_id": {"$lt": 2}}, -1) == [1, 0]
@@ -0,0 +1,205 @@
+import os
+import pytest
+from datetime import datetime
+
+from montydb.errors import OperationFailure, WriteError
+from montydb.types import bson
+from montydb.storage import StorageError, memory
+
+
+def test_memory_decoded_copy_on_read(make_client):
+    client = make_client("memory", decoded=True)
+    col = client.db.col
+    doc = {"_id": 0, "a": {"b": [1, 2]}, "c": (3, 4)}
+    col.insert_one(doc)
+
+    # Stored in the same types as encoded
+    found = col.find_one()
+    assert found == {"_id": 0, "a": {"b": [1, 2]}, "c": [3, 4]}
+
+    # Neither inserted nor returned document is the stored one
+    doc["a"]["b"].append(5)
+    found["a"]["b"].append(6)
+    col.find_one({}, {"a.b": 1})["a"]["b"].append(7)
+    col.distinct("a")[0]["b"].append(8)
+    assert col.find_one()["a"] == {"b": [1, 2]}
+
+
+def test_memory_decoded_update(make_client):
+    client = make_client("memory", decoded=True)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": {"b": [i]}} for i in range(3)])
+
+    col.update_many({}, {"$push": {"a.b": 9}})
+    col.update_one({"_id": 0}, {"$set": {"a.c": 1}})
+    assert list(col.find({"a.b": 9}, {"_id": 0})) == [
+        {"a": {"b": [0, 9], "c": 1}},
+        {"a": {"b": [1, 9]}},
+        {"a": {"b": [2, 9]}},
+    ]
+
+    # Failed update leaves stored document untouched
+    with pytest.raises(WriteError):
+        col.update_one({"_id": 1}, {"$set": {"a.c": 1}, "$inc": {"a.b": 1}})
+    assert col.find_one({"_id": 1}) == {"_id": 1, "a": {"b": [1, 9]}}
+
+
+def test_memory_decoded_write_validated(make_client):
+    client = make_client("memory", decoded=True)
+    col = client.db.col
+    col.insert_one({"_id": 0, "a": 1})
+
+    with pytest.raises((bson.InvalidDocument, TypeError)):
+        col.update_one({"_id": 0}, {"$set": {"a": object()}})
+    with pytest.raises(bson.InvalidDocument):
+        col.insert_one({"_id": 1, "$a": 1})
+    assert list(col.find()) == [{"_id": 0, "a": 1}]
+
+    # Stored as encoded, datetime in milliseconds
+    microseconds = datetime(2020, 1, 1, 0, 0, 0, 1500)
+    col.update_one({"_id": 0}, {"$set": {"d": microseconds}})
+    assert col.find_one()["d"] == datetime(2020, 1, 1, 0, 0, 0, 1000)
+
+
+def test_memory_decoded_setting_changed(make_client):
+    client = make_client("memory")
+    client.db.col.insert_one({"_id": 0})
+
+    client = make_client("memory", decoded=True)
+    client.db.col.insert_one({"_id": 1})
+    assert client.db.col.count_documents({}) == 2
+
+    client = make_client("memory")
+    doc = client.db.col.find_one({"_id": 1})
+    doc["x"] = 1
+    assert list(client.db.col.find()) == [{"_id": 0}, {"_id": 1}]
+
+
+@pytest.mark.parametrize("decoded", [False, True])
+def test_memory_snapshot(make_client, storage_repo, decoded):
+    os.makedirs(storage_repo)
+    snapshot = os.path.join(storage_repo, "memory.snapshot")
+
+    client = make_client("memory", decoded=decoded)
+    client.db.a.insert_many([{"_id": i, "s": u"\u00e9" * i} for i in range(3)])
+    client.db.b.insert_one({"_id": "x", "a": [{"b": None}]})
+    client.other.c.insert_one({"_id": 0})
+    client.save_snapshot(snapshot)
+
+    client.drop_database("db")
+    client.other.c.insert_one({"_id": 1})
+    client.load_snapshot(snapshot)
+
+    assert client.list_database_names() == ["db", "other"]
+    assert client.db.list_collection_names() == ["a", "b"]
+    assert list(client.db.a.find({"_id": {"$gt": 0}})) == [
+        {"_id": 1, "s": u"\u00e9"},
+        {"_id": 2, "s": u"\u00e9\u00e9"},
+    ]
+    assert client.db.b.find_one() == {"_id": "x", "a": [{"b": None}]}
+    assert client.other.c.count_documents({}) == 1
+
+    # Loaded in the same types as written
+    stored = client._storage._repo["db"]["b"].values()
+    assert all(isinstance(doc, dict if decoded else bytes) for doc in stored)
+
+
+def test_memory_snapshot_save_failed(make_client, storage_repo, monkeypatch):
+    os.makedirs(storage_repo)
+    snapshot = os.path.join(storage_repo, "memory.snapshot")
+
+    client = make_client("memory", decoded=True)
+    client.db.col.insert_one({"_id": 0})
+    client.save_snapshot(snapshot)
+    client.db.col.insert_one({"_id": 1})
+
+    def document_encode(*args, **kwargs):
+        raise IOError("Disk full.")
+
+    monkeypatch.setattr(memory.bson, "document_encode", document_encode)
+    with pytest.raises(IOError):
+        client.save_snapshot(snapshot)
+    monkeypatch.undo()
+
+    # Previous snapshot is kept, and no temporary file is left
+    assert os.listdir(storage_repo) == ["memory.snapshot"]
+    client.load_snapshot(snapshot)
+    assert [doc["_id"] for doc in client.db.col.find()] == [0]
+
+
+def test_memory_snapshot_invalid(make_client, storage_repo):
+    os.makedirs(storage_repo)
+    snapshot = os.path.join(storage_repo, "memory.snapshot")
+
+    client = make_client("memory")
+    client.db.col.insert_one({"_id": 0})
+    client.save_snapshot(snapshot)
+    with open(snapshot, "rb") as fp:
+        data = fp.read()
+
+    for broken in (b"not a snapshot", data[:-1]):
+        with open(snapshot, "wb") as fp:
+            fp.write(broken)
+        with pytest.raises(StorageError):
+            client.load_snapshot(snapshot)
+    # Nothing loaded from the broken file
+    assert client.db.col.count_documents({}) == 1
+
+
+def test_memory_snapshot_other_storage(make_client, storage_repo):
+    client = make_client("flatfile")
+    snapshot = os.path.join(storage_repo, "memory.snapshot")
+    with pytest.raises(OperationFailure):
+        client.save_snapshot(snapshot)
+    with pytest.raises(OperationFailure):
+        client.load_snapshot(snapshot)
+    assert not os.path.isfile(snapshot)
+
+
+def test_memory_max_documents(make_client):
+    client = make_client("memory", max_documents=3)
+    col = client.db.col
+    col.insert_many([{"_id": i} for i in range(3)])
+
+    col.find_one({"_id": 0})  # used recently
+    col.update_one({"_id": 1}, {"$set": {"a": 1}})
+    col.insert_one({"_id": 3})
+    assert [doc["_id"] for doc in col.find()] == [0, 1, 3]
+
+    col.insert_many([{"_id": i} for i in range(4, 8)])
+    assert [doc["_id"] for doc in col.find()] == [5, 6, 7]
+    # Other collections are bounded on their own
+    client.db.other.insert_one({"_id": 0})
+    assert col.count_documents({}) == 3
+
+
+def test_memory_max_bytes(make_client):
+    client = make_client("memory", max_bytes=300)
+    col = client.db.col
+    col.insert_many([{"_id": i, "s": "x" * 60} for i in range(3)])
+    assert col.count_documents({}) == 3
+
+    col.update_many({}, {"$set": {"s": "x" * 100}})
+    assert col.count_documents({}) == 2
+    # Document larger than the bound is kept, as the only one
+    col.insert_one({"_id": 9, "s": "x" * 400})
+    assert [doc["_id"] for doc in col.find()] == [9]
+
+
+def test_memory_expire_after_seconds(make_client, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(memory, "_clock", lambda: now[0])
+    client = make_client("memory", expire_after_seconds=10)
+    col = client.db.col
+    col.insert_many([{"_id": 0}, {"_id": 1}])
+
+    now[0] += 5
+    col.update_one({"_id": 1}, {"$set": {"a": 1}})
+    col.insert_one({"_id": 2})
+    now[0] += 5
+    # Expired documents are not returned, even before next write
+    assert [doc["_id"] for doc in col.find()] == [1, 2]
+    assert col.find_one({"_id": 0}) is None
+
+    now[0] += 10
+    assert col.count_documents({}) == 0
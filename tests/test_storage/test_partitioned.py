@@ -0,0 +1,167 @@
+import os
+import pytest
+import threading
+
+from montydb.errors import BulkWriteError, DuplicateKeyError
+from montydb.storage import StorageError, keystring, partitioned
+from montydb.storage.partitioned import (
+    PARTITION_DIR_PREFIX,
+    merge_ordered,
+    partition_of,
+)
+
+
+def partition_ids(client, index, count=3):
+    return [doc["_id"] for doc in client.db.col.find()
+            if partition_of(keystring.encode(doc["_id"]), count) == index]
+
+
+@pytest.mark.parametrize("engine", ["sqlite", "lightning"])
+def test_partitioned_documents_spread(make_client, engine):
+    client = make_client("partitioned", partitions=3, engine=engine)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 2} for i in range(30)])
+
+    partitions = client._storage._partitions
+    assert len(partitions) == 3
+    for index in range(3):
+        path = os.path.join(client.address, PARTITION_DIR_PREFIX + str(index))
+        assert partitions[index].repository == path
+        assert len(partition_ids(client, index)) > 0
+
+    # Scanned from all partitions, and merged in `_id` order
+    assert [doc["_id"] for doc in col.find({"a": 1})] == \
+        list(range(1, 30, 2))
+    assert [doc["_id"] for doc in col.find().sort("_id", -1).limit(3)] == \
+        [29, 28, 27]
+    assert col.count_documents({"_id": {"$in": [3, 7, 99]}}) == 2
+
+    col.update_many({"a": 1}, {"$set": {"b": 1}})
+    col.delete_many({"a": 0})
+    assert col.count_documents({}) == col.count_documents({"b": 1}) == 15
+
+
+def test_partitioned_insert_many_duplicated(make_client):
+    client = make_client("partitioned", partitions=3)
+    col = client.db.col
+    col.insert_many([{"_id": i} for i in range(0, 20, 2)])
+
+    docs = [{"_id": i} for i in range(1, 20, 2)]
+    docs.insert(5, {"_id": 12})
+    with pytest.raises(BulkWriteError) as err:
+        col.insert_many(docs)
+
+    # Documents after the duplicated one are not kept in any partition
+    assert err.value.details["nInserted"] == 5
+    assert "{ : \"12\" }" in err.value.details["writeErrors"][0]["errmsg"]
+    assert sorted(doc["_id"] for doc in col.find({"_id": {"$mod": [2, 1]}})) \
+        == [1, 3, 5, 7, 9]
+
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": 1})
+
+
+def test_partitioned_scan_in_chunks(make_client, monkeypatch):
+    monkeypatch.setattr(partitioned, "PARTITIONED_SCAN_BATCH", 2)
+    client = make_client("partitioned", partitions=3)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 2} for i in range(30)])
+    assert [doc["_id"] for doc in col.find({"a": 1})] == \
+        list(range(1, 30, 2))
+
+    pulled = []
+
+    def produce():
+        for i in range(9):
+            pulled.append(i)
+            yield {"_id": i}
+
+    # No more than the consumed chunk and the next one are pulled
+    docs = client._storage._prefetch(produce)
+    assert next(docs) == {"_id": 0}
+    assert len(pulled) <= 4
+    assert [doc["_id"] for doc in docs] == list(range(1, 9))
+
+
+def test_partitioned_collections_and_databases(make_client):
+    client = make_client("partitioned", partitions=3)
+    client.db.create_collection("empty")
+    client.db.col.insert_one({"_id": 0})
+    client.other.col.insert_one({"_id": 1})
+
+    assert sorted(client.list_database_names()) == ["db", "other"]
+    assert sorted(client.db.list_collection_names()) == ["col", "empty"]
+
+    client.db.drop_collection("col")
+    assert client.db.list_collection_names() == ["empty"]
+    client.drop_database("other")
+    assert client.list_database_names() == ["db"]
+
+
+def test_partitioned_index(make_client):
+    client = make_client("partitioned", partitions=3)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 3} for i in range(9)])
+
+    col.create_index("a")
+    assert sorted(col.index_information()) == ["_id_", "a_1"]
+    assert [doc["_id"] for doc in col.find({"a": 1})] == [1, 4, 7]
+
+    with pytest.raises(NotImplementedError):
+        col.create_index("b", unique=True)
+
+    col.drop_index("a_1")
+    assert sorted(col.index_information()) == ["_id_"]
+
+
+def test_partitioned_query_in_threads(make_client):
+    client = make_client("partitioned", partitions=4, workers=2)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 5} for i in range(500)])
+    errors = []
+
+    def work():
+        try:
+            for _ in range(10):
+                assert col.count_documents({"a": 2}) == 100
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    client.close()
+    assert col.count_documents({"a": 2}) == 100
+
+
+def test_partitioned_count_changed(make_client):
+    client = make_client("partitioned", partitions=3)
+    client.db.col.insert_one({"_id": 0})
+    client.close()
+
+    with pytest.raises(StorageError):
+        make_client("partitioned", partitions=4)
+
+
+def test_partitioned_config_invalid(make_client):
+    with pytest.raises(ValueError):
+        make_client("partitioned", engine="flatfile")
+    with pytest.raises(ValueError):
+        make_client("partitioned", partitions=0)
+
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_partitioned_merge_ordered(reverse):
+    ids = [[0, 3, "a"], [], [1, 2.5, 4, "b"], [-1]]
+    streams = [sorted(({"_id": id} for id in group),
+                      key=lambda doc: keystring.encode(doc["_id"]),
+                      reverse=reverse)
+               for group in ids]
+
+    merged = [doc["_id"] for doc in merge_ordered(streams, reverse)]
+    expected = [-1, 0, 1, 2.5, 3, 4, "a", "b"]
+    assert merged == (expected[::-1] if reverse else expected)
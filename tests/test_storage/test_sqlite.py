@@ -0,0 +1,527 @@
+import os
+import pytest
+import sqlite3
+import montydb
+import threading
+
+from montydb.errors import (
+    BulkWriteError,
+    DuplicateKeyError,
+    InvalidOperation,
+    OperationFailure,
+)
+from montydb.types import bson
+from montydb.storage import keystring
+from montydb.storage.sqlite import (
+    SQLITE_DB_EXT,
+    SQLITE_DATABASE_FILE,
+    SQLITE_SCHEMA_VERSION,
+    SQLiteStorage,
+    where_clause,
+)
+
+from ..conftest import set_bson
+
+
+def engine_db_file(client, db_name, col_name):
+    return os.path.join(client.address, db_name, col_name) + SQLITE_DB_EXT
+
+
+def test_sqlite_connection_reused(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+    col.insert_one({"_id": 1})
+    col.update_one({"_id": 0}, {"$set": {"a": 1}})
+
+    engine = client._storage._conn
+    db_file = engine_db_file(client, "db", "col")
+    with engine._connect(db_file, col.write_concern) as first:
+        pass
+    col.insert_one({"_id": 2})
+    with engine._connect(db_file, col.write_concern) as second:
+        pass
+    assert first is second
+
+
+def test_sqlite_drop_collection_with_open_connection(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+    client.db.drop_collection("col")
+
+    assert client.db.list_collection_names() == []
+    col.insert_one({"_id": 0})
+    assert col.count_documents({}) == 1
+    assert client.db.list_collection_names() == ["col"]
+
+
+def test_sqlite_close_and_reopen(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_one({"_id": 0})
+    client.close()
+    col.insert_one({"_id": 1})
+    assert col.count_documents({}) == 2
+
+
+@pytest.mark.parametrize("layout", ["collection", "database"])
+def test_sqlite_threads_share_client(make_client, layout):
+    client = make_client("sqlite", layout=layout)
+    col = client.db.col
+
+    def insert(n):
+        for i in range(20):
+            col.insert_one({"_id": "%d-%d" % (n, i)})
+
+    threads = [threading.Thread(target=insert, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert col.count_documents({}) == 80
+
+
+def test_sqlite_streaming_read(make_client):
+    client = make_client("sqlite", read_batch_size=3)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 2} for i in range(10)])
+
+    assert [d["_id"] for d in col.find({"a": 1}).limit(2)] == [1, 3]
+    assert col.find({"a": 1}).limit(2).count() == 5
+    assert col.count_documents({"a": 0}) == 5
+
+
+def test_sqlite_streaming_read_fetch_all(make_client):
+    client = make_client("sqlite", read_batch_size=0)
+    col = client.db.col
+    col.insert_many([{"_id": i} for i in range(10)])
+
+    assert col.count_documents({}) == 10
+
+
+@pytest.mark.parametrize("layout", ["collection", "database"])
+def test_sqlite_update_while_streaming(make_client, layout):
+    client = make_client("sqlite",
+                         journal_mode="DELETE",
+                         read_batch_size=2,
+                         layout=layout)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": 0} for i in range(10)])
+
+    col.update_many({"a": 0}, {"$inc": {"a": 1}})
+    col.delete_one({"a": 1})
+
+    assert col.count_documents({"a": 1}) == 9
+
+
+def test_sqlite_write_many_duplicated_key(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_many([{"_id": i} for i in range(5)])
+
+    with pytest.raises(BulkWriteError) as exc:
+        col.insert_many([{"_id": 10}, {"_id": 11}, {"_id": 3}, {"_id": 12}])
+
+    assert exc.value.details["writeErrors"][0]["index"] == 2
+    assert exc.value.details["nInserted"] == 2
+    assert col.count_documents({}) == 7
+
+    with pytest.raises(BulkWriteError) as exc:
+        col.insert_many([{"_id": 20}, {"_id": 20}])
+
+    assert exc.value.details["writeErrors"][0]["index"] == 1
+    assert col.count_documents({"_id": 20}) == 1
+
+
+def test_sqlite_filter_pushdown(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_many([
+        {"_id": 0, "a": 1},
+        {"_id": 1, "a": [0, 1]},
+        {"_id": 2, "a": "1"},
+        {"_id": 3},
+        {"_id": "4", "a": 2.0},
+    ])
+
+    def find_ids(spec):
+        return sorted(str(doc["_id"]) for doc in col.find(spec))
+
+    assert find_ids({"_id": 1}) == ["1"]
+    assert find_ids({"_id": "4"}) == ["4"]
+    assert find_ids({"_id": {"$in": [1, 3, "5"]}}) == ["1", "3"]
+    assert find_ids({"_id": {"$in": []}}) == []
+    assert find_ids({"a": 1}) == ["0", "1"]
+    assert find_ids({"a": "1"}) == ["2"]
+    assert find_ids({"a": {"$gt": 0, "$lte": 2}}) == ["0", "1", "4"]
+    assert find_ids({"$and": [{"a": {"$gte": 1}}, {"_id": 0}]}) == ["0"]
+
+
+def test_sqlite_where_clause(use_bson):
+    set_bson(use_bson)
+
+    sql, params = where_clause({"_id": "abc"})
+    assert sql == "k IN (?)"
+    assert params == [keystring.encode("abc")]
+
+    sql, params = where_clause({"_id": {"$gt": 1, "$lte": 5}})
+    assert sql == "k >= ? AND k < ?"
+    assert params == [keystring.encode(1),
+                      keystring.encode(5) + keystring.END]
+
+    assert where_clause({}) == ("", [])
+    assert where_clause({"$or": [{"_id": 0}]}) == ("", [])
+    assert where_clause({"_id": {"$regex": "^a"}}) == ("", [])
+
+
+@pytest.mark.parametrize("layout", ["collection", "database"])
+def test_sqlite_index_create_list_drop(make_client, layout):
+    client = make_client("sqlite", layout=layout)
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": i % 3, "b": str(i)} for i in range(9)])
+
+    assert col.create_index("a") == "a_1"
+    assert col.create_index([("a", 1), ("b", -1)]) == "a_1_b_-1"
+    assert col.create_index("a") == "a_1"
+    assert col.create_index("_id") == "_id_"
+
+    info = col.index_information()
+    assert sorted(info) == ["_id_", "a_1", "a_1_b_-1"]
+    assert info["a_1_b_-1"]["key"] == [("a", 1), ("b", -1)]
+
+    with pytest.raises(OperationFailure) as exc:
+        col.create_index("b", name="a_1")
+    assert exc.value.code == 85
+
+    col.drop_index("a_1")
+    assert sorted(col.index_information()) == ["_id_", "a_1_b_-1"]
+
+    with pytest.raises(OperationFailure) as exc:
+        col.drop_index("a_1")
+    assert exc.value.code == 27
+
+    col.drop_indexes()
+    assert sorted(col.index_information()) == ["_id_"]
+
+
+def test_sqlite_index_unique(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_many([{"_id": 0, "a": 1}, {"_id": 1, "a": 1}])
+
+    with pytest.raises(DuplicateKeyError):
+        col.create_index("a", unique=True)
+    assert sorted(col.index_information()) == ["_id_"]
+
+    col.update_one({"_id": 1}, {"$set": {"a": 2}})
+    col.create_index("a", unique=True)
+
+    with pytest.raises(DuplicateKeyError):
+        col.insert_one({"_id": 2, "a": 2})
+    assert col.count_documents({}) == 2
+
+    with pytest.raises(DuplicateKeyError):
+        col.update_one({"_id": 0}, {"$set": {"a": 2}})
+    assert col.find_one({"_id": 0})["a"] == 1
+
+
+def test_sqlite_index_unique_exact(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.create_index("a", unique=True)
+
+    # Rounded to the same double, but not equal
+    col.insert_one({"_id": 0, "a": 2 ** 53})
+    col.insert_one({"_id": 1, "a": 2 ** 53 + 1})
+    if bson.bson_used:
+        col.insert_one({"_id": 4, "a": bson.Decimal128("1.00000000000000000001")})
+        col.insert_one({"_id": 5, "a": bson.Decimal128("1.00000000000000000002")})
+        with pytest.raises(DuplicateKeyError):
+            col.insert_one({"_id": 6, "a": bson.Decimal128("9007199254740993")})
+    else:
+        # Beyond int64, only stored without BSON
+        col.insert_one({"_id": 2, "a": 2 ** 64 + 1})
+        col.insert_one({"_id": 3, "a": 2 ** 64 + 2})
+
+    with pytest.raises(DuplicateKeyError) as exc:
+        col.insert_one({"_id": 7, "a": 2.0 ** 53})
+    assert "index: a_1" in str(exc.value)
+    assert col.count_documents({"a": 2 ** 53 + 1}) == 1
+
+    with pytest.raises(BulkWriteError) as exc:
+        col.insert_many([{"_id": 8, "a": 8}, {"_id": 9, "a": 2 ** 53 + 1}])
+    assert "index: a_1" in exc.value.details["writeErrors"][0]["errmsg"]
+    assert exc.value.details["nInserted"] == 1
+
+    if bson.bson_used:
+        # Rounded to zero or infinity
+        col.insert_one({"_id": 20, "a": bson.Decimal128("1E-400")})
+        col.insert_one({"_id": 21, "a": 0})
+        col.insert_one({"_id": 22, "a": bson.Decimal128("1E+400")})
+        col.insert_one({"_id": 23, "a": bson.Decimal128("2E+400")})
+        col.insert_one({"_id": 24, "a": bson.Decimal128("Infinity")})
+        with pytest.raises(DuplicateKeyError):
+            col.insert_one({"_id": 25, "a": bson.Decimal128("10E-401")})
+
+
+@pytest.mark.parametrize("layout", ["collection", "database"])
+def test_sqlite_index_query(make_client, layout):
+    client = make_client("sqlite", layout=layout)
+    col = client.db.col
+    col.create_index("a")
+    col.create_index("b.c")
+    col.insert_many([
+        {"_id": 0, "a": 1, "b": {"c": "x"}},
+        {"_id": 1, "a": [0, 5], "b": [{"c": "y"}, {"c": "z"}]},
+        {"_id": 2, "a": "1"},
+        {"_id": 3, "a": None},
+        {"_id": 4, "a": 2.5},
+    ])
+
+    def find_ids(spec):
+        return sorted(doc["_id"] for doc in col.find(spec))
+
+    assert find_ids({"a": 1}) == [0]
+    assert find_ids({"a": {"$in": [0, "1"]}}) == [1, 2]
+    # Multikey, each element could match on different bound
+    assert find_ids({"a": {"$gt": 1, "$lt": 3}}) == [1, 4]
+    assert find_ids({"a": None}) == [3]
+    assert find_ids({"b.c": {"$gte": "y"}}) == [1]
+
+    col.update_one({"_id": 4}, {"$set": {"a": 1}})
+    col.delete_one({"_id": 0})
+    assert find_ids({"a": 1}) == [4]
+
+
+def test_sqlite_blob_schema(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_one({"_id": "a", "b": 1})
+
+    conn = sqlite3.connect(engine_db_file(client, "db", "col"))
+    try:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == \
+            SQLITE_SCHEMA_VERSION
+        types = conn.execute("SELECT typeof(k), typeof(v) FROM documents")
+        assert types.fetchall() == [("blob", "blob")]
+    finally:
+        conn.close()
+
+
+def test_sqlite_migrate_text_schema(make_client, storage_repo, use_bson):
+    set_bson(use_bson)
+    db_dir = os.path.join(storage_repo, "db")
+    os.makedirs(db_dir)
+
+    # Collection file that written by previous version
+    conn = sqlite3.connect(os.path.join(db_dir, "col") + SQLITE_DB_EXT)
+    conn.execute("CREATE TABLE documents("
+                 "k text NOT NULL, v text NOT NULL, PRIMARY KEY(k))")
+    for i in range(3):
+        doc = {"_id": i, "a": str(i)}
+        conn.execute("INSERT INTO documents VALUES "
+                     "(CAST(? AS TEXT), CAST(? AS TEXT))",
+                     (bson.id_encode(i), bson.document_encode(doc)))
+    conn.commit()
+    conn.close()
+
+    client = make_client("sqlite")
+    col = client.db.col
+    assert sorted(doc["_id"] for doc in col.find()) == [0, 1, 2]
+    assert col.find_one({"_id": 1}) == {"_id": 1, "a": "1"}
+
+    col.update_one({"_id": 2}, {"$set": {"a": "x"}})
+    assert col.find_one({"a": "x"})["_id"] == 2
+    assert col.count_documents({}) == 3
+
+
+@pytest.mark.parametrize("layout", ["collection", "database"])
+def test_sqlite_migrate_keys(make_client, layout):
+    client = make_client("sqlite", layout=layout)
+    col = client.db.col
+    col.create_index("a")
+    ids = [10, 2, "x", -1]
+    col.insert_many([{"_id": id, "a": i % 2} for i, id in enumerate(ids)])
+    if layout == "collection":
+        db_file = engine_db_file(client, "db", "col")
+    else:
+        db_file = os.path.join(client.address, "db", SQLITE_DATABASE_FILE)
+    client.close()
+
+    # Downgrade to keys that encoded by `bson.id_encode`
+    conn = sqlite3.connect(db_file)
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")]
+    for id in ids:
+        old, new = bson.id_encode(id), keystring.encode(id)
+        for table in tables:
+            if table in ("documents", "col") or "index." in table:
+                conn.execute("UPDATE [%s] SET k = ? WHERE k = ?" % table,
+                             (old, new))
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+
+    assert [doc["_id"] for doc in col.find().sort("_id", -1)] == \
+        ["x", 10, 2, -1]
+    assert [doc["_id"] for doc in col.find({"a": 1})] == [-1, 2]
+    col.delete_one({"_id": 2})
+    assert [doc["_id"] for doc in col.find({"a": 1})] == [-1]
+
+
+def test_sqlite_session_transaction(make_client):
+    client = make_client("sqlite")
+    col = client.db.col
+    col.insert_many([{"_id": i, "a": 0} for i in range(10)])
+
+    with client.start_session() as session:
+        with session.start_transaction():
+            for i in range(10):
+                col.update_one({"_id": i}, {"$inc": {"a": 1}})
+            client.db.other.insert_one({"_id": 0})
+            assert col.count_documents({"a": 1}) == 10
+
+        assert not session.in_transaction
+
+    assert session.has_ended
+    assert col.count_documents({"a": 1}) == 10
+    assert client.db.other.count_documents({}) == 1
+
+
+@pytest.mark.parametrize("layout", ["collection", "database"])
+def test_sqlite_session_transaction_abort(make_client, layout):
+    client = make_client("sqlite", layout=layout)
+    col = client.db.col
+    col.insert_one({"_id": 0})
+
+    session = client.start_session()
+    with pytest.raises(ValueError):
+        with session.start_transaction():
+            col.insert_one({"_id": 1})
+            client.db.new.insert_one({"_id": 0})
+            with pytest.raises(DuplicateKeyError):
+                col.insert_one({"_id": 0})
+            col.insert_one({"_id": 2})
+            raise ValueError
+
+    assert col.count_documents({}) == 1
+    # Collection created in the transaction is rolled back in any layout
+    assert client.db.list_collection_names() == ["col"]
+    assert client.db.new.count_documents({}) == 0
+    client.db.new.insert_one({"_id": 0})
+
+    session.start_transaction()
+    with pytest.raises(InvalidOperation):
+        session.start_transaction()
+    col.delete_one({"_id": 0})
+    session.end_session()
+
+    assert col.count_documents({}) == 1
+    with pytest.raises(InvalidOperation):
+        session.start_transaction()
+
+
+def test_sqlite_session_transactions_crossed(make_client):
+    client = make_client("sqlite")
+    client.db.a.insert_one({"_id": 0})
+    client.db.b.insert_one({"_id": 0})
+    # Short busy timeout, the waiting one gives up quickly
+    client = montydb.MontyClient(client.address, wtimeout=100)
+    written = [threading.Event(), threading.Event()]
+    errors = []
+
+    def work(n, first, second):
+        try:
+            with client.start_session() as session:
+                with session.start_transaction():
+                    first.update_one({"_id": 0}, {"$inc": {"x": 1}})
+                    written[n].set()
+                    written[1 - n].wait(5)
+                    second.update_one({"_id": 0}, {"$inc": {"x": 1}})
+        except sqlite3.OperationalError as e:
+            errors.append(e)
+
+    threads = [
+        threading.Thread(target=work, args=(0, client.db.a, client.db.b)),
+        threading.Thread(target=work, args=(1, client.db.b, client.db.a)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+
+    # Locked in opposite order, at least one failed instead of deadlock
+    assert not any(thread.is_alive() for thread in threads)
+    assert len(errors) >= 1
+    total = sum(client.db[name].find_one().get("x", 0) for name in "ab")
+    assert total == 2 * (2 - len(errors))
+
+
+def test_sqlite_database_layout(make_client):
+    client = make_client("sqlite", layout="database")
+    db = client.db
+    db.a.insert_one({"_id": 0})
+    db["b.c"].insert_one({"_id": 0})
+    db.a.create_index("x")
+
+    files = os.listdir(os.path.join(client.address, "db"))
+    assert "collections.database" in files
+    assert not any(name.endswith(SQLITE_DB_EXT) for name in files)
+    assert sorted(db.list_collection_names()) == ["a", "b.c"]
+
+    db.drop_collection("a")
+    assert db.list_collection_names() == ["b.c"]
+    assert db.a.count_documents({}) == 0
+    assert db.a.index_information() == {
+        "_id_": {"v": 2, "key": [("_id", 1)]}
+    }
+    db.a.insert_one({"_id": 0})
+    assert sorted(db.list_collection_names()) == ["a", "b.c"]
+
+
+def test_sqlite_database_layout_quoted_names(make_client):
+    client = make_client("sqlite", layout="database")
+    db = client.db
+    names = ["a]b", 'a"b', "x]; DROP TABLE [y"]
+    db.y.insert_one({"_id": 0})
+    for name in names:
+        db[name].insert_one({"_id": 0, "v": 1})
+        db[name].create_index("v", unique=True)
+        db[name].update_one({"_id": 0}, {"$set": {"v": 2}})
+        assert db[name].find_one({"v": 2}) == {"_id": 0, "v": 2}
+
+    assert sorted(db.list_collection_names()) == sorted(names + ["y"])
+    for name in names:
+        db.drop_collection(name)
+    assert db.list_collection_names() == ["y"]
+
+
+def test_sqlite_tuning_profile(make_client):
+    client = make_client("sqlite", profile="bulk-load", cache_size=-1000)
+    col = client.db.col
+    col.insert_one({"_id": 0})
+
+    config = SQLiteStorage.launch(client.address)._config
+    assert config["profile"] == "bulk-load"
+    assert config["cache_size"] == -1000
+    assert config["page_size"] == 16384
+
+    engine = client._storage._conn
+    db_file = engine_db_file(client, "db", "col")
+    with engine._connect(db_file, col.write_concern) as conn:
+        def pragma(name):
+            return conn.execute("PRAGMA %s" % name).fetchone()[0]
+
+        assert pragma("page_size") == 16384
+        assert pragma("cache_size") == -1000
+        assert pragma("temp_store") == 2
+        assert pragma("wal_autocheckpoint") == 10000
+
+
+def test_sqlite_tuning_profile_invalid():
+    with pytest.raises(ValueError):
+        SQLiteStorage.config(profile="fast")
+    with pytest.raises(ValueError):
+        SQLiteStorage.config(temp_store="RAM")